@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+
+# * mpdbench.py
+# Benchmarks for mpdsync, run against simulated MPD servers (see
+# mpdsim.py).  Results are printed (or written) as JSON so runs can be
+# compared.  Requires Python 3.7+.
+
+# ** Imports
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import sys
+import threading
+import time
+
+import mpdsim
+import mpdsync
+import mpdtools
+
+# ** Constants
+
+DEFAULT_PORT = 16600
+
+# Skew in seconds at which slaves count as synced
+CONVERGED_SKEW = 0.030
+
+# How long slaves must stay synced to count as converged
+CONVERGED_HOLD = 1.0
+
+# How often to sample the simulated players' positions
+SAMPLE_INTERVAL = 0.05
+
+# Number of tracks appended in the playlist benchmark
+PLAYLIST_APPEND = 100
+
+# Seconds in a simulated day of the soak test
+DAY = 86400
+
+
+# ** Classes
+class BenchSeeker(mpdsync.Seeker):
+    '''Seeker that records how much CPU time each tick takes.'''
+
+    def __init__(self, *args, **kwargs):
+        super(BenchSeeker, self).__init__(*args, **kwargs)
+
+        self.tickTimes = []
+
+    def tick(self):
+        start = time.thread_time()
+        sleepTime = super(BenchSeeker, self).tick()
+        self.tickTimes.append(time.thread_time() - start)
+
+        return sleepTime
+
+
+class BenchMaster(mpdsync.Master):
+    '''Master that uses BenchSeeker, and keeps the tick times of seekers
+    that have been stopped.'''
+
+    def __init__(self, *args, **kwargs):
+        super(BenchMaster, self).__init__(*args, **kwargs)
+
+        self.tickTimes = []
+
+    def startSeeker(self):
+        self.seeker = BenchSeeker(self)
+        self.seeker.tickTimes = self.tickTimes
+        self.seeker.connect()
+        self.seeker.start_loop()
+
+
+class Bench(object):
+    '''Runs mpdsync against one simulated master and SLAVES simulated
+    slaves, recording the true skew between them.'''
+
+    def __init__(self, name, slaves=2, port=DEFAULT_PORT, librarySize=200,
+                 settle=20.0, threshold=CONVERGED_SKEW, **settings):
+        self.log = logging.getLogger('mpdbench').getChild(name)
+
+        self.name = name
+        self.settle = settle
+        self.threshold = threshold
+        self.settings = settings
+
+        self.servers = mpdsim.makeServers(slaves + 1, port=port,
+                                          librarySize=librarySize, **settings)
+        self.masterServer = self.servers[0]
+        self.slaveServers = self.servers[1:]
+        self.serverThread = mpdsim.ServerThread(self.servers)
+
+        self.master = None
+        self.running = False
+
+        self.startTime = None
+        self.events = []
+        self.samples = []
+
+    # *** Setup
+
+    def __enter__(self):
+        self.serverThread.start()
+
+        # Give the master a queue and start it playing
+        self.command(self.masterServer, 'clear')
+        for file in sorted(self.masterServer.library)[:20]:
+            self.command(self.masterServer, 'add', file)
+        self.command(self.masterServer, 'play', '0')
+
+        return self
+
+    def __exit__(self, *args):
+        self.stopSync()
+        self.serverThread.stop()
+
+    def startSync(self):
+        "Connect mpdsync and run its event loop in a thread, like main()."
+
+        log = logging.getLogger('mpdsync')
+
+        self.master = BenchMaster(host='127.0.0.1:%s' % self.masterServer.port,
+                                  adjustLatency=True, logger=log)
+        self.master.connect()
+        for server in self.slaveServers:
+            self.master.addSlave('127.0.0.1:%s' % server.port)
+
+        self.event('start')
+
+        self.master.syncAll()
+
+        events = mpdsync.queue.Queue()
+        self.eventQueue = events
+        self.watcher = mpdsync.IdleWatcher(self.master, events,
+                                           subsystems=['playlist', 'player', 'options'])
+        self.watcher.start()
+        self.coalescer = mpdsync.EventCoalescer(events)
+
+        self.running = True
+        self.eventThread = threading.Thread(target=self._eventLoop)
+        self.eventThread.daemon = True
+        self.eventThread.start()
+
+    def stopSync(self):
+        if not self.running:
+            return
+
+        self.running = False
+        self.watcher.stop()
+        self.eventQueue.put((None, []))
+        self.eventThread.join()
+
+        self.master.stopSeeker()
+
+    def _eventLoop(self):
+        while self.running:
+            changes = self.coalescer.get()
+            if self.running:
+                self.master.handleEvents(changes[self.master])
+
+    # *** Scenario steps
+
+    def command(self, server, command, *args):
+        "Run COMMAND on simulated SERVER, as if from another client."
+
+        return self.serverThread.call(server.execute, None, command, list(args))
+
+    def event(self, name, server=None, command=None, *args):
+        '''Record an event, running COMMAND on SERVER (default: the master)
+        if given.  Convergence is measured from each event.'''
+
+        if command:
+            self.command(server or self.masterServer, command, *args)
+
+        self.log.info("Event: %s", name)
+        self.events.append({'name': name, 'time': time.time()})
+
+    def reboot(self, num):
+        "Reboot slave server NUM."
+
+        server = self.slaveServers[num]
+        self.serverThread.call(server.reboot)
+
+        self.log.info("Event: reboot %s", server.name)
+        self.events.append({'name': 'reboot', 'time': time.time()})
+
+    def run(self, seconds=None):
+        "Sample skew for SECONDS (default: the settle time)."
+
+        end = time.time() + (seconds or self.settle)
+        while time.time() < end:
+            self.samples.append(self.sample())
+            time.sleep(SAMPLE_INTERVAL)
+
+    def sample(self):
+        '''Return (time, [skew of each slave]).  A slave that isn't playing
+        the master's song at all has infinite skew.'''
+
+        now = time.time()
+        master = self.masterServer.player
+
+        skews = []
+        for server in self.slaveServers:
+            player = server.player
+            if master.state != 'play':
+                skews.append(0.0 if player.state != 'play' else float('inf'))
+            elif player.state != 'play' or player.song != master.song:
+                skews.append(float('inf'))
+            else:
+                skews.append(player.elapsed(now) - master.elapsed(now))
+
+        return now, skews
+
+    # *** Results
+
+    def results(self):
+        "Return results as a dict."
+
+        duration = self.samples[-1][0] - self.startTime if self.samples else 0
+
+        # Time to converge after each event
+        events = []
+        for num, event in enumerate(self.events):
+            end = (self.events[num + 1]['time'] if num + 1 < len(self.events)
+                   else float('inf'))
+            events.append({'name': event['name'],
+                           'at': round(event['time'] - self.startTime, 3),
+                           'convergeTime': self._convergeTime(event['time'], end)})
+
+        # Skew from when slaves converged until the next event
+        steady = []
+        for event in events:
+            if event['convergeTime'] is None:
+                continue
+            start = self.startTime + event['at'] + event['convergeTime']
+            end = next((e['at'] + self.startTime for e in events if e['at'] > event['at']),
+                       float('inf'))
+            steady.extend(abs(skew) for t, skews in self.samples
+                          if start <= t < end for skew in skews)
+
+        commands = sum(server.stats['commands'] for server in self.servers)
+        tickTimes = self.master.tickTimes if self.master else []
+
+        return {'scenario': self.name,
+                'slaves': len(self.slaveServers),
+                'settings': self.settings,
+                'duration': round(duration, 3),
+                'events': events,
+                'steadySkew': percentiles(steady),
+                'reseeks': sum(sum(slave.corrections.values()) for slave in self.master.slaves),
+                'recoveries': dict(self.master.recoveries),
+                'commandsPerMinute': round(commands / (duration / 60), 1) if duration else None,
+                'cpuPerTick': dict(percentiles(tickTimes), ticks=len(tickTimes))}
+
+    def _convergeTime(self, start, end):
+        '''Return seconds from START until all slaves were within the
+        threshold for CONVERGED_HOLD seconds, or None if that didn't happen before END.'''
+
+        syncedSince = None
+        for t, skews in self.samples:
+            if t < start or t >= end:
+                continue
+
+            if all(abs(skew) <= self.threshold for skew in skews):
+                if syncedSince is None:
+                    syncedSince = t
+                if t - syncedSince >= CONVERGED_HOLD:
+                    return round(syncedSince - start, 3)
+            else:
+                syncedSince = None
+
+        return None
+
+
+# ** Scenarios
+
+def scenarioStartup(bench):
+    "mpdsync starts while the master is already playing."
+
+    bench.startSync()
+    bench.run()
+
+def scenarioTrackChange(bench):
+    "The user skips tracks, and a track ends by itself."
+
+    bench.startSync()
+    bench.run()
+
+    for i in range(2):
+        bench.event('next', None, 'next')
+        bench.run()
+
+    song = bench.masterServer.player.song
+    duration = bench.masterServer.queue[song].duration
+    bench.event('natural', None, 'seek', str(song), str(duration - 3))
+    bench.run()
+
+def scenarioSeek(bench):
+    "The user seeks around in the current track."
+
+    bench.startSync()
+    bench.run()
+
+    for position in ['60', '30', '90']:
+        song = str(bench.masterServer.player.song)
+        bench.event('seek', None, 'seek', song, position)
+        bench.run()
+
+def scenarioPause(bench):
+    "The user pauses and resumes."
+
+    bench.startSync()
+    bench.run()
+
+    bench.event('pause', None, 'pause', '1')
+    bench.run(bench.settle / 2)
+    bench.event('resume', None, 'pause', '0')
+    bench.run()
+
+def scenarioReboot(bench):
+    "A slave's MPD restarts."
+
+    bench.startSync()
+    bench.run()
+
+    bench.reboot(0)
+    bench.run()
+
+SCENARIOS = {'startup': (scenarioStartup, {}),
+             'trackchange': (scenarioTrackChange, {}),
+             'seek': (scenarioSeek, {}),
+             'pause': (scenarioPause, {}),
+             'reboot': (scenarioReboot, {}),
+             'many': (scenarioStartup, {'slaves': 20})}
+
+
+# ** Playlist sync
+
+def playlistWorker(connection, masterPort, slavePorts):
+    '''Runs mpdsync's side of the playlist benchmark.  This runs in its own
+    process, so its peak RSS is mpdsync's alone.  Each message received
+    on CONNECTION (until None) makes it sync the playlists once and send
+    back the time it took and its peak RSS.'''
+
+    log = logging.getLogger('mpdsync')
+    log.setLevel(logging.CRITICAL)
+
+    master = mpdsync.Master(host='127.0.0.1:%s' % masterPort, logger=log)
+    master.connect()
+    for port in slavePorts:
+        master.addSlave('127.0.0.1:%s' % port)
+
+    connection.send('ready')
+
+    while connection.recv() is not None:
+        start = time.time()
+        master.syncPlaylists()
+        wall = time.time() - start
+
+        connection.send({'wall': round(wall, 6),
+                         'peakRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+def runPlaylistBench(size, slaves, port=DEFAULT_PORT, **settings):
+    '''Return results of syncing a SIZE-track queue to SLAVES slaves, and
+    then syncing an append, a delete from the middle, and a move.'''
+
+    log = logging.getLogger('mpdbench').getChild('playlist')
+
+    servers = mpdsim.makeServers(slaves + 1, port=port,
+                                 librarySize=size + PLAYLIST_APPEND, **settings)
+    masterServer = servers[0]
+    files = sorted(masterServer.library)
+
+    # Each operation changes the master's queue before syncing
+    middle = size // 2
+    operations = [('initial', lambda: masterServer.load(files[:size])),
+                  ('append', lambda: [masterServer._add(f) for f in files[size:]]),
+                  ('delete', lambda: masterServer._delete(middle, middle + 1)),
+                  ('reorder', lambda: masterServer._move(middle, middle + 1, 0))]
+
+    results = []
+    with mpdsim.ServerThread(servers) as serverThread:
+        context = multiprocessing.get_context('spawn')
+        connection, workerConnection = context.Pipe()
+        worker = context.Process(target=playlistWorker,
+                                 args=(workerConnection, masterServer.port,
+                                       [server.port for server in servers[1:]]))
+        worker.start()
+
+        try:
+            connection.recv()
+
+            for name, operation in operations:
+                serverThread.call(operation)
+
+                before = dict((key, sum(server.stats[key] for server in servers))
+                              for key in ['commands', 'bytesIn', 'bytesOut'])
+
+                connection.send(name)
+                result = connection.recv()
+
+                after = dict((key, sum(server.stats[key] for server in servers))
+                             for key in before)
+
+                masterQueue = [song.file for song in masterServer.queue]
+                correct = all([song.file for song in server.queue] == masterQueue
+                              for server in servers[1:])
+
+                result.update({'size': size, 'slaves': slaves, 'operation': name,
+                               'commands': after['commands'] - before['commands'],
+                               'bytes': (after['bytesIn'] - before['bytesIn']
+                                         + after['bytesOut'] - before['bytesOut']),
+                               'correct': correct})
+                results.append(result)
+
+                log.info("%s", result)
+
+            connection.send(None)
+        finally:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+
+    return results
+
+
+# ** Functions
+
+def percentiles(values):
+    "Return p50/p90/p95/p99/max of VALUES."
+
+    values = sorted(values)
+    if not values:
+        return {}
+
+    result = {}
+    for p in [50, 90, 95, 99]:
+        result['p%s' % p] = round(values[min(len(values) - 1, int(len(values) * p / 100.0))], 6)
+    result['max'] = round(values[-1], 6)
+
+    return result
+
+def runScenario(name, port=DEFAULT_PORT, settle=20.0, threshold=CONVERGED_SKEW,
+                slaves=None, **settings):
+    function, options = SCENARIOS[name]
+    if slaves is not None:
+        options = dict(options, slaves=slaves)
+
+    with Bench(name, port=port, settle=settle, threshold=threshold,
+               **dict(options, **settings)) as bench:
+        bench.startTime = time.time()
+        function(bench)
+
+    return bench.results()
+
+def currentRss():
+    "Return current RSS in KiB, or the peak RSS where that isn't available."
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def soakWorker(connection, days, memoryBudget, seed):
+    '''Runs the Seeker against a simulated slave for DAYS days of
+    simulated playback, in its own process so its RSS is mpdsync's
+    alone.  Sends back the RSS after each day.'''
+
+    log = logging.getLogger('mpdsync')
+    log.setLevel(logging.CRITICAL)
+
+    model = mpdtools.SimulatedSlave()
+    model.start(random.Random(seed), songs=int(days * DAY / model.songLength) + 1)
+    seeker, slave = mpdtools.simulation(model, log, memoryBudget=memoryBudget)
+
+    rss = [currentRss()]
+    start = time.time()
+    for day in range(days):
+        while model.now < (day + 1) * DAY:
+            model.advance(seeker.tick())
+
+        rss.append(currentRss())
+
+    connection.send({'rss': rss, 'songs': model.song,
+                     'corrections': sum(slave.corrections.values()),
+                     'wall': round(time.time() - start, 3)})
+
+def runSoak(days, memoryBudget, seed=0):
+    '''Return RSS over DAYS days of simulated playback, with or without
+    MEMORYBUDGET.'''
+
+    context = multiprocessing.get_context('spawn')
+    connection, workerConnection = context.Pipe()
+    worker = context.Process(target=soakWorker,
+                             args=(workerConnection, days, memoryBudget, seed))
+    worker.start()
+
+    try:
+        result = connection.recv()
+    finally:
+        worker.join()
+
+    rss = result['rss']
+
+    # Growth over the second half shows whether memory use levels off
+    # once the history is full
+    half = len(rss) // 2
+
+    return {'benchmark': 'soak', 'days': days, 'memoryBudget': memoryBudget,
+            'songs': result['songs'], 'corrections': result['corrections'],
+            'wall': result['wall'], 'rssKiB': rss,
+            'secondHalfGrowthKiB': rss[-1] - rss[half]}
+
+def main():
+
+    # Parse args
+    parser = argparse.ArgumentParser(
+        description='Benchmarks mpdsync against simulated MPD servers.')
+    parser.add_argument('-P', '--port', type=int, default=DEFAULT_PORT,
+                        help='First port for simulated servers (default: %s)' % DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.002, metavar='SECONDS')
+    parser.add_argument('--jitter', type=float, default=0.001, metavar='SECONDS')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write JSON results to FILE instead of stdout')
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose",
+                        help="Be verbose, up to -vv")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    sync = subparsers.add_parser('sync', help='Measure how well slaves are kept in sync')
+    sync.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                      help='Scenarios to run (default: all): %s' % ', '.join(sorted(SCENARIOS)))
+    sync.add_argument('-n', '--slaves', type=int, default=None,
+                      help='Number of slaves (default depends on scenario)')
+    sync.add_argument('--settle', type=float, default=20.0, metavar='SECONDS',
+                      help='Time to let slaves settle after each event (default: 20)')
+    sync.add_argument('-t', '--threshold', type=float, default=CONVERGED_SKEW, metavar='SECONDS',
+                      help='Skew at which slaves count as converged (default: %s)' % CONVERGED_SKEW)
+    sync.add_argument('--play-delay', type=float, default=0.050, metavar='SECONDS',
+                      dest='playDelay')
+    sync.add_argument('--seek-delay', type=float, default=0.020, metavar='SECONDS',
+                      dest='seekDelay')
+    sync.add_argument('--seek-granularity', type=float, default=0.026, metavar='SECONDS',
+                      dest='seekGranularity')
+    sync.add_argument('--drift', type=float, default=30.0, metavar='PPM')
+
+    playlist = subparsers.add_parser('playlist', help='Measure playlist sync throughput')
+    playlist.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                          metavar='TRACKS', help='Queue sizes (default: 1000 10000 100000)')
+    playlist.add_argument('--slaves', type=int, nargs='+', default=[1, 4, 16],
+                          metavar='COUNT', help='Numbers of slaves (default: 1 4 16)')
+
+    soak = subparsers.add_parser('soak', help='Measure memory use over a long simulated session')
+    soak.add_argument('--days', type=int, default=30,
+                      help='Days of playback to simulate (default: 30)')
+    soak.add_argument('--seed', type=int, default=0,
+                      help='Random seed for the simulation (default: 0)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(name)s: %(message)s")
+    logging.getLogger('mpdbench').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('mpdsync').setLevel(logging.DEBUG if args.verbose >= 2 else logging.CRITICAL)
+
+    results = []
+    if args.benchmark == 'sync':
+        for name in args.scenarios:
+            if name not in SCENARIOS:
+                parser.error('Unknown scenario: %s' % name)
+
+        for name in args.scenarios or sorted(SCENARIOS):
+            results.append(runScenario(name, port=args.port, settle=args.settle,
+                                       threshold=args.threshold, slaves=args.slaves,
+                                       latency=args.latency, jitter=args.jitter,
+                                       playDelay=args.playDelay, seekDelay=args.seekDelay,
+                                       seekGranularity=args.seekGranularity, drift=args.drift))
+
+    elif args.benchmark == 'playlist':
+        for size in args.sizes:
+            for slaves in args.slaves:
+                results.extend(runPlaylistBench(size, slaves, port=args.port,
+                                                latency=args.latency, jitter=args.jitter))
+
+    elif args.benchmark == 'soak':
+        for memoryBudget in [False, True]:
+            results.append(runSoak(args.days, memoryBudget, seed=args.seed))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,932 @@
+#!/usr/bin/env python3
+
+# * mpdsim.py
+# Simulated MPD servers with virtual playback clocks, for testing and
+# benchmarking mpdsync on one machine without real MPD boxes.  Only
+# the commands mpdsync uses are implemented.  Requires Python 3.5+
+# (asyncio).
+
+# ** Imports
+import argparse
+import asyncio
+from collections import defaultdict
+import logging
+import random
+import shlex
+import sys
+import threading
+import time
+
+# ** Constants
+
+DEFAULT_PORT = 6600
+PROTOCOL_VERSION = '0.21.0'
+
+# MPD error codes
+ACK_ERROR_ARG = 2
+ACK_ERROR_PASSWORD = 3
+ACK_ERROR_UNKNOWN = 5
+ACK_ERROR_NO_EXIST = 50
+
+SUBSYSTEMS = ['database', 'update', 'stored_playlist', 'playlist', 'player',
+              'mixer', 'output', 'options', 'partition', 'sticker',
+              'subscription', 'message']
+
+
+# ** Classes
+class Settings(object):
+    '''Behavior of a simulated server.  All times are in seconds.'''
+
+    def __init__(self, latency=0.0, jitter=0.0, playDelay=0.0, seekDelay=0.0,
+                 seekGranularity=0.0, drift=0.0, dropRate=0.0, password=None):
+
+        # Round-trip network latency, plus up to JITTER more at random
+        self.latency = latency
+        self.jitter = jitter
+
+        # Time from a play or seek command until playback (re)starts
+        self.playDelay = playDelay
+        self.seekDelay = seekDelay
+
+        # Seeks land on a multiple of this (e.g. the frame size)
+        self.seekGranularity = seekGranularity
+
+        # Clock drift in parts per million
+        self.drift = drift
+
+        # Chance of dropping the connection on each command
+        self.dropRate = dropRate
+
+        self.password = password
+
+    def __str__(self):
+        return ' '.join('%s:%s' % (k, v) for k, v in sorted(vars(self).items()))
+
+
+class CommandError(Exception):
+    def __init__(self, code, message):
+        super(CommandError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class Song(object):
+    def __init__(self, file, duration=None, tags=None):
+        self.file = file
+        self.duration = duration
+        self.tags = tags or {}
+
+        # Set when added to the queue
+        self.id = None
+
+    def copy(self):
+        return Song(self.file, self.duration, dict(self.tags))
+
+    def info(self, pos):
+        lines = ['file: %s' % self.file]
+        for tag, value in sorted(self.tags.items()):
+            lines.append('%s: %s' % (tag.capitalize(), value))
+        if self.duration is not None:
+            lines.append('Time: %d' % round(self.duration))
+            lines.append('duration: %.3f' % self.duration)
+        lines.append('Pos: %d' % pos)
+        lines.append('Id: %d' % self.id)
+
+        return lines
+
+
+class Player(object):
+    '''Virtual playback clock.  Elapsed time is calculated from the
+    (drifting) clock instead of being ticked, so reading it is exact
+    at any instant.'''
+
+    def __init__(self, settings, clock=time.time):
+        self.settings = settings
+        self.clock = clock
+        self.rate = 1 + settings.drift / 1e6
+
+        self.state = 'stop'
+        self.song = None
+
+        # Playback position at startedAt, and when it started (or
+        # will start) moving
+        self.position = 0.0
+        self.startedAt = None
+
+    def elapsed(self, now=None):
+        if now is None:
+            now = self.clock()
+
+        if self.state != 'play' or now < self.startedAt:
+            return self.position
+
+        return self.position + (now - self.startedAt) * self.rate
+
+    def play(self, position=None, delay=0.0):
+        now = self.clock()
+        if position is None:
+            position = self.elapsed(now)
+
+        self.state = 'play'
+        self.position = position
+        self.startedAt = now + delay
+
+    def pause(self):
+        self.position = self.elapsed()
+        self.state = 'pause'
+
+    def stop(self):
+        self.state = 'stop'
+        self.song = None
+        self.position = 0.0
+
+    def seek(self, position, delay=0.0):
+        granularity = self.settings.seekGranularity
+        if granularity:
+            position = int(position / granularity) * granularity
+
+        if self.state == 'play':
+            self.play(position, delay)
+        else:
+            self.position = position
+
+    def endsIn(self, duration):
+        '''Returns seconds of real time until the position reaches
+        DURATION, or None if not playing.'''
+
+        if self.state != 'play' or duration is None:
+            return None
+
+        now = self.clock()
+        untilStart = max(0, self.startedAt - now)
+
+        return untilStart + max(0, duration - self.elapsed(now)) / self.rate
+
+
+class Server(object):
+    '''A simulated MPD server.  Runs in an asyncio event loop; see
+    ServerThread for using servers from blocking code.'''
+
+    def __init__(self, name, port, settings=None, library=None, seed=None):
+        self.log = logging.getLogger('mpdsim').getChild(name)
+
+        self.name = name
+        self.port = port
+        self.settings = settings or Settings()
+        self.random = random.Random(seed)
+
+        # Database: file -> Song
+        self.library = dict((song.file, song) for song in (library or []))
+        self.dbUpdate = int(time.time())
+
+        self.queue = []
+        self.playlistVersion = 1
+
+        # (version, start, end) of each change to the queue, for
+        # plchanges.  END is None when the change shifted every song
+        # after START.
+        self.changes = []
+        self.nextId = 1
+        self.options = dict((option, False)
+                            for option in ['repeat', 'random', 'single', 'consume'])
+
+        self.player = Player(self.settings)
+        self.endTimer = None
+
+        self.connections = set()
+        self.server = None
+
+        # Counters
+        self.stats = defaultdict(int)
+
+    # *** Server
+
+    async def start(self, host='127.0.0.1'):
+        self.server = await asyncio.start_server(self._handle, host, self.port)
+
+        self.log.debug("Listening on %s:%s (%s)", host, self.port, self.settings)
+
+    async def stop(self):
+        self.dropConnections()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def dropConnections(self):
+        "Close all client connections."
+
+        for connection in list(self.connections):
+            connection.close()
+
+    def reboot(self):
+        "Drop connections and stop playing, like a restarted MPD."
+
+        self.dropConnections()
+        self._stop()
+        self.notify('player')
+
+    # *** Idle
+
+    def notify(self, *subsystems):
+        for connection in list(self.connections):
+            connection.notify(subsystems)
+
+    # *** Playback
+
+    @property
+    def currentSong(self):
+        if self.player.song is None or self.player.song >= len(self.queue):
+            return None
+
+        return self.queue[self.player.song]
+
+    def _play(self, song, position=0.0, delay=None):
+        if delay is None:
+            delay = self.settings.playDelay
+
+        self.player.song = song
+        self.player.play(position, delay)
+        self._scheduleEnd()
+
+    def _stop(self):
+        self.player.stop()
+        self._scheduleEnd()
+
+    def _scheduleEnd(self):
+        "Schedule the switch to the next song at the end of this one."
+
+        if self.endTimer:
+            self.endTimer.cancel()
+            self.endTimer = None
+
+        song = self.currentSong
+        if song is None:
+            return
+
+        endsIn = self.player.endsIn(song.duration)
+        if endsIn is not None:
+            self.endTimer = asyncio.get_event_loop().call_later(endsIn, self._songEnded)
+
+    def _songEnded(self):
+        self.endTimer = None
+
+        # Songs are gapless, so the next one starts where this one
+        # should have ended, even if the timer fired late
+        song = self.currentSong
+        overshoot = max(0, self.player.elapsed() - song.duration) / self.player.rate
+
+        nextSong = self.player.song + 1
+        if self.options['consume']:
+            self._delete(self.player.song, self.player.song + 1)
+            nextSong -= 1
+
+        if self.options['single'] or nextSong >= len(self.queue):
+            if self.options['repeat'] and self.queue and not self.options['single']:
+                nextSong = 0
+            else:
+                self._stop()
+                self.notify('player')
+
+                return
+
+        self._play(nextSong, overshoot * self.player.rate, delay=0)
+        self.notify('player')
+
+    # *** Queue
+
+    def _add(self, file, pos=None):
+        if '://' in file:
+            song = Song(file)
+        elif file in self.library:
+            song = self.library[file].copy()
+        else:
+            raise CommandError(ACK_ERROR_NO_EXIST, 'No such directory')
+
+        song.id = self.nextId
+        self.nextId += 1
+
+        if pos is None:
+            pos = len(self.queue)
+        elif pos > len(self.queue):
+            raise CommandError(ACK_ERROR_ARG, 'Bad song index')
+
+        self.queue.insert(pos, song)
+        if self.player.song is not None and pos <= self.player.song:
+            self.player.song += 1
+
+        self._changed(pos)
+
+        return song
+
+    def _delete(self, start, end):
+        if start >= len(self.queue) or end > len(self.queue) or start >= end:
+            raise CommandError(ACK_ERROR_ARG, 'Bad song index')
+
+        del self.queue[start:end]
+
+        current = self.player.song
+        if current is not None:
+            if start <= current < end:
+                # Deleting the current song moves on to the next one
+                if start < len(self.queue) and self.player.state == 'play':
+                    self._play(start)
+                else:
+                    self._stop()
+                self.notify('player')
+            elif current >= end:
+                self.player.song -= end - start
+
+        self._changed(start)
+
+    def _move(self, start, end, to):
+        songs = self.queue[start:end]
+        del self.queue[start:end]
+        self.queue[to:to] = songs
+
+        current = self.player.song
+        if current is not None:
+            if start <= current < end:
+                self.player.song = to + (current - start)
+            else:
+                if current >= end:
+                    current -= end - start
+                if current >= to:
+                    current += end - start
+                self.player.song = current
+
+        self._changed(min(start, to))
+
+    def _changed(self, start, end=None):
+        "Bump the playlist version for songs from START to END."
+
+        self.playlistVersion += 1
+        self.changes.append((self.playlistVersion, start, end))
+
+        self.notify('playlist')
+
+    def load(self, files):
+        '''Replace the queue with FILES at once, which is much faster than
+        adding them one at a time.'''
+
+        self.queue = []
+        self._stop()
+        for file in files:
+            song = self.library[file].copy()
+            song.id = self.nextId
+            self.nextId += 1
+            self.queue.append(song)
+
+        self._changed(0)
+
+    # *** Commands
+
+    def execute(self, connection, command, args):
+        "Execute a command and return response lines."
+
+        self.stats['commands'] += 1
+
+        method = getattr(self, 'cmd_' + command, None)
+        if not method:
+            raise CommandError(ACK_ERROR_UNKNOWN, 'unknown command "%s"' % command)
+
+        if (self.settings.password and not connection.authenticated
+                and command not in ('password', 'ping', 'close')):
+            raise CommandError(ACK_ERROR_PASSWORD, 'you don\'t have permission for "%s"' % command)
+
+        try:
+            return method(connection, *args) or []
+        except (ValueError, TypeError, IndexError):
+            raise CommandError(ACK_ERROR_ARG, 'Bad arguments')
+
+    def cmd_ping(self, connection):
+        pass
+
+    def cmd_password(self, connection, password):
+        if password != self.settings.password:
+            raise CommandError(ACK_ERROR_PASSWORD, 'incorrect password')
+        connection.authenticated = True
+
+    def cmd_status(self, connection):
+        lines = ['volume: 100']
+        for option in ['repeat', 'random', 'single', 'consume']:
+            lines.append('%s: %d' % (option, self.options[option]))
+        lines += ['playlist: %d' % self.playlistVersion,
+                  'playlistlength: %d' % len(self.queue),
+                  'state: %s' % self.player.state]
+
+        song = self.currentSong
+        if song is not None:
+            lines += ['song: %d' % self.player.song,
+                      'songid: %d' % song.id]
+            if self.player.state != 'stop':
+                elapsed = self.player.elapsed()
+                duration = song.duration or 0
+                lines += ['time: %d:%d' % (elapsed, round(duration)),
+                          'elapsed: %.3f' % elapsed]
+                if song.duration is not None:
+                    lines.append('duration: %.3f' % song.duration)
+
+        return lines
+
+    def cmd_stats(self, connection):
+        return ['artists: 0', 'albums: 0', 'songs: %d' % len(self.library),
+                'uptime: 0', 'playtime: 0', 'db_playtime: 0',
+                'db_update: %d' % self.dbUpdate]
+
+    def cmd_currentsong(self, connection):
+        song = self.currentSong
+        return song.info(self.player.song) if song else []
+
+    def cmd_playlist(self, connection):
+        return ['%d:file: %s' % (pos, song.file) for pos, song in enumerate(self.queue)]
+
+    def cmd_playlistinfo(self, connection, pos=None):
+        if pos is not None:
+            start, end = self._range(pos)
+        else:
+            start, end = 0, len(self.queue)
+
+        lines = []
+        for num in range(start, end):
+            lines += self.queue[num].info(num)
+        return lines
+
+    def cmd_plchanges(self, connection, version):
+        version = int(version)
+
+        # Every position covered by a newer change
+        changed = set()
+        start = len(self.queue)
+        for changeVersion, changeStart, changeEnd in reversed(self.changes):
+            if changeVersion <= version:
+                break
+            if changeEnd is None:
+                start = min(start, changeStart)
+            else:
+                changed.update(range(changeStart, changeEnd))
+
+        changed.update(range(start, len(self.queue)))
+
+        lines = []
+        for pos in sorted(changed):
+            if pos < len(self.queue):
+                lines += self.queue[pos].info(pos)
+        return lines
+
+    def cmd_add(self, connection, uri):
+        self._add(uri)
+
+    def cmd_addid(self, connection, uri, pos=None):
+        song = self._add(uri, None if pos is None else int(pos))
+        return ['Id: %d' % song.id]
+
+    def cmd_addtagid(self, connection, songId, tag, value):
+        for song in self.queue:
+            if song.id == int(songId):
+                song.tags[tag.lower()] = value
+                pos = self.queue.index(song)
+                self._changed(pos, pos + 1)
+                return
+
+        raise CommandError(ACK_ERROR_NO_EXIST, 'No such song')
+
+    def cmd_clear(self, connection):
+        self.queue = []
+        self._stop()
+        self._changed(0)
+        self.notify('player')
+
+    def cmd_delete(self, connection, pos):
+        self._delete(*self._range(pos))
+
+    def cmd_deleteid(self, connection, songId):
+        pos = self._posForId(songId)
+        self._delete(pos, pos + 1)
+
+    def cmd_move(self, connection, pos, to):
+        start, end = self._range(pos)
+        self._move(start, end, int(to))
+
+    def cmd_play(self, connection, pos=None):
+        if pos is None:
+            if self.player.state == 'play':
+                # Already playing, maybe after a seek; MPD keeps going
+                return
+            if self.player.state == 'pause':
+                self.player.play(delay=self.settings.playDelay)
+                self._scheduleEnd()
+                self.notify('player')
+                return
+            pos = self.player.song if self.player.song is not None else 0
+        pos = int(pos)
+
+        if pos >= len(self.queue):
+            raise CommandError(ACK_ERROR_ARG, 'Bad song index')
+
+        self._play(pos)
+        self.notify('player')
+
+    def cmd_playid(self, connection, songId=None):
+        self.cmd_play(connection, None if songId is None else self._posForId(songId))
+
+    def cmd_pause(self, connection, pause=None):
+        if pause is None:
+            pause = self.player.state == 'play'
+        else:
+            pause = pause == '1'
+
+        if pause and self.player.state == 'play':
+            self.player.pause()
+        elif not pause and self.player.state == 'pause':
+            self.player.play(delay=self.settings.playDelay)
+        else:
+            return
+
+        self._scheduleEnd()
+        self.notify('player')
+
+    def cmd_stop(self, connection):
+        self._stop()
+        self.notify('player')
+
+    def cmd_next(self, connection):
+        if self.player.song is None:
+            return
+        if self.player.song + 1 < len(self.queue):
+            self._play(self.player.song + 1)
+        else:
+            self._stop()
+        self.notify('player')
+
+    def cmd_previous(self, connection):
+        if self.player.song is None:
+            return
+        self._play(max(0, self.player.song - 1))
+        self.notify('player')
+
+    def cmd_seek(self, connection, pos, position):
+        pos = int(pos)
+        if pos >= len(self.queue):
+            raise CommandError(ACK_ERROR_ARG, 'Bad song index')
+
+        if pos != self.player.song or self.player.state == 'stop':
+            # Seeking a stopped player (or another song) selects the
+            # song and starts playing it, like MPD
+            self.player.song = pos
+            self.player.state = 'play'
+            self.player.startedAt = self.player.clock()
+
+        self.player.seek(float(position), self.settings.seekDelay)
+        self._scheduleEnd()
+        self.notify('player')
+
+    def cmd_seekid(self, connection, songId, position):
+        self.cmd_seek(connection, self._posForId(songId), position)
+
+    def cmd_seekcur(self, connection, position):
+        self.cmd_seek(connection, self.player.song, position)
+
+    def _option(self, option, value):
+        self.options[option] = value == '1'
+        self.notify('options')
+
+    def cmd_repeat(self, connection, value):
+        self._option('repeat', value)
+
+    def cmd_random(self, connection, value):
+        self._option('random', value)
+
+    def cmd_single(self, connection, value):
+        self._option('single', value)
+
+    def cmd_consume(self, connection, value):
+        self._option('consume', value)
+
+    def cmd_lsinfo(self, connection, uri=''):
+        return self._list(uri, recursive=False)
+
+    def cmd_listall(self, connection, uri=''):
+        return self._list(uri, recursive=True)
+
+    def cmd_update(self, connection, uri=None):
+        self.dbUpdate = int(time.time())
+        self.notify('update', 'database')
+        return ['updating_db: 1']
+
+    def _list(self, uri, recursive):
+        prefix = uri.rstrip('/') + '/' if uri else ''
+
+        directories = set()
+        files = []
+        for file in sorted(self.library):
+            if not file.startswith(prefix):
+                continue
+
+            parts = file[len(prefix):].split('/')
+            if recursive:
+                for num in range(1, len(parts)):
+                    directories.add(prefix + '/'.join(parts[:num]))
+                files.append(file)
+            elif len(parts) > 1:
+                directories.add(prefix + parts[0])
+            else:
+                files.append(file)
+
+        return (['directory: %s' % d for d in sorted(directories)]
+                + ['file: %s' % f for f in files])
+
+    def _range(self, arg):
+        if ':' in arg:
+            start, end = arg.split(':')
+            start = int(start)
+            end = int(end) if end else len(self.queue)
+        else:
+            start = int(arg)
+            end = start + 1
+        return start, end
+
+    def _posForId(self, songId):
+        for pos, song in enumerate(self.queue):
+            if song.id == int(songId):
+                return pos
+
+        raise CommandError(ACK_ERROR_NO_EXIST, 'No such song')
+
+    # *** Connections
+
+    async def _handle(self, reader, writer):
+        connection = Connection(self, reader, writer)
+        self.connections.add(connection)
+        self.stats['connections'] += 1
+
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+
+
+class Connection(object):
+    '''One client connection to a simulated server.'''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+
+        self.authenticated = False
+
+        # Pending idle events, and the subsystems being idled on
+        self.events = set()
+        self.idling = None
+
+    def close(self):
+        self.writer.close()
+
+    def notify(self, subsystems):
+        self.events.update(subsystems)
+
+        if self.idling is not None:
+            self._finishIdle()
+
+    def _finishIdle(self):
+        subsystems = self.idling or SUBSYSTEMS
+        changed = sorted(s for s in self.events if s in subsystems)
+        if not changed:
+            return
+
+        self.events.difference_update(changed)
+        self.idling = None
+        self._write(['changed: %s' % s for s in changed] + ['OK'])
+
+    def _write(self, lines):
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        self.server.stats['bytesOut'] += len(data)
+        self.writer.write(data)
+
+    async def _delay(self):
+        "Sleep for half a round trip."
+
+        settings = self.server.settings
+        delay = (settings.latency + self.server.random.uniform(0, settings.jitter)) / 2
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def run(self):
+        self._write(['OK MPD %s' % PROTOCOL_VERSION])
+
+        commandList = None
+        listOk = False
+
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+
+            self.server.stats['bytesIn'] += len(line)
+            line = line.decode('utf-8').rstrip('\n')
+
+            if self.idling is not None:
+                if line == 'noidle':
+                    self.idling = None
+                    self._write(['OK'])
+                else:
+                    # Real MPD disconnects clients that do this
+                    break
+                continue
+
+            if line == 'noidle':
+                # Ignored when not idling
+                continue
+
+            try:
+                words = shlex.split(line)
+            except ValueError:
+                self._write(['ACK [%d@0] {} Invalid quoting' % ACK_ERROR_ARG])
+                continue
+            if not words:
+                continue
+            command, args = words[0], words[1:]
+
+            if command in ('command_list_begin', 'command_list_ok_begin'):
+                commandList = []
+                listOk = command == 'command_list_ok_begin'
+                continue
+
+            if command == 'command_list_end':
+                commands, commandList = commandList or [], None
+                ok = listOk
+            elif commandList is not None:
+                commandList.append((command, args))
+                continue
+            else:
+                commands = [(command, args)]
+                ok = False
+
+            await self._delay()
+
+            if self.server.random.random() < self.server.settings.dropRate:
+                self.server.stats['drops'] += 1
+                break
+
+            if command == 'close':
+                break
+
+            if command == 'idle' and len(commands) == 1:
+                self.idling = args
+                if self.events:
+                    self._finishIdle()
+                continue
+
+            lines = []
+            for num, (command, args) in enumerate(commands):
+                try:
+                    lines += self.server.execute(self, command, args)
+                except CommandError as e:
+                    lines.append('ACK [%d@%d] {%s} %s' % (e.code, num, command, e.message))
+                    break
+                if ok:
+                    lines.append('list_OK')
+            else:
+                lines.append('OK')
+
+            await self._delay()
+
+            self._write(lines)
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                break
+
+        self.writer.close()
+
+
+class ServerThread(object):
+    '''Runs simulated servers in an event loop in a background thread, so
+    they can be used from blocking code like mpdsync.'''
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.thread.start()
+        for server in self.servers:
+            self.run(server.start())
+
+    def stop(self):
+        for server in self.servers:
+            self.run(server.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def run(self, coroutine):
+        "Run COROUTINE in the loop and return its result."
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call(self, function, *args):
+        "Call FUNCTION in the loop and return its result."
+
+        async def wrapper():
+            return function(*args)
+
+        return self.run(wrapper())
+
+
+# ** Functions
+
+def makeLibrary(size, seed=0):
+    '''Return a list of SIZE songs in a fake directory tree, with durations
+    between 2 and 6 minutes.'''
+
+    rand = random.Random(seed)
+
+    return [Song('artist%03d/album%02d/track%05d.%s'
+                 % (num // 100, num // 10 % 10, num, rand.choice(['flac', 'mp3', 'ogg'])),
+                 duration=rand.uniform(120, 360))
+            for num in range(size)]
+
+def makeServers(count, port=DEFAULT_PORT, librarySize=1000, seed=0, **settings):
+    '''Return COUNT servers on consecutive ports from PORT, sharing one
+    library.  Each server's clock drifts by a random amount of up to
+    SETTINGS['drift'] ppm either way.'''
+
+    library = makeLibrary(librarySize, seed)
+    rand = random.Random(seed)
+
+    servers = []
+    for num in range(count):
+        serverSettings = Settings(**settings)
+        serverSettings.drift = rand.uniform(-1, 1) * serverSettings.drift
+        servers.append(Server('sim%d' % num, port + num, serverSettings,
+                              library=library, seed=seed + num))
+
+    return servers
+
+def main():
+
+    # Parse args
+    parser = argparse.ArgumentParser(
+        description='Runs simulated MPD servers for testing mpdsync.')
+    parser.add_argument('-n', '--count', type=int, default=2,
+                        help='Number of servers to run (default: 2)')
+    parser.add_argument('-P', '--port', type=int, default=DEFAULT_PORT,
+                        help='Port of the first server; the rest use the following ports')
+    parser.add_argument('--library', type=int, default=1000, metavar='SONGS',
+                        help='Number of songs in the fake database (default: 1000)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help='Round-trip network latency')
+    parser.add_argument('--jitter', type=float, default=0.0, metavar='SECONDS',
+                        help='Random extra latency, up to this much')
+    parser.add_argument('--play-delay', type=float, default=0.0, metavar='SECONDS',
+                        dest='playDelay', help='Delay before playback starts')
+    parser.add_argument('--seek-delay', type=float, default=0.0, metavar='SECONDS',
+                        dest='seekDelay', help='Delay before playback resumes after seeking')
+    parser.add_argument('--seek-granularity', type=float, default=0.0, metavar='SECONDS',
+                        dest='seekGranularity', help='Seeks land on multiples of this')
+    parser.add_argument('--drift', type=float, default=0.0, metavar='PPM',
+                        help='Max clock drift either way, in parts per million')
+    parser.add_argument('--drop-rate', type=float, default=0.0, metavar='CHANCE',
+                        dest='dropRate', help='Chance of dropping the connection on each command')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose",
+                        help="Be verbose")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(levelname)s: %(name)s: %(message)s")
+
+    servers = makeServers(args.count, port=args.port, librarySize=args.library, seed=args.seed,
+                          latency=args.latency, jitter=args.jitter, playDelay=args.playDelay,
+                          seekDelay=args.seekDelay, seekGranularity=args.seekGranularity,
+                          drift=args.drift, dropRate=args.dropRate)
+
+    async def run():
+        for server in servers:
+            await server.start()
+            logging.info("%s listening on port %s", server.name, server.port)
+        await asyncio.Event().wait()
+
+    # Not asyncio.run(), which needs Python 3.7
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
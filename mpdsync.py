@@ -7,14 +7,37 @@
 # ** Imports
 import argparse
 from collections import defaultdict
+import functools
+import inspect
+import json
 import logging
+import math
+import os
 import re
+import signal
+import socket
 import sys
-from threading import Thread
+from threading import Lock, RLock, Thread, current_thread
 import time
 
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socketserver
+except ImportError:
+    # Python 2
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import SocketServer as socketserver
+
 import mpd  # Using python-mpd2
 
+try:
+    from mpd.base import mpd_command_provider
+except ImportError:
+    # Older python-mpd2
+    mpd_command_provider = None
+
 # Verify python-mpd2 is being used
 if mpd.VERSION < (0, 5, 4):
     print('ERROR: This script requires python-mpd2 >= 0.5.4.')
@@ -31,9 +54,137 @@ MAX_ADJUSTMENTS = 5
 # Max adjustment size in ms (larger than this will trigger an adjustment by ping)
 MAX_ADJUSTMENT = 0.300
 
-# Stop reseeking when average difference gets below:
+# Stop reseeking when average difference gets below (the check is
+# disabled for now), and never let the max difference get below this:
 MIN_DIFFERENCE = 0.030
 
+# Before there are enough measurements, the max difference is the ping
+# multiplied by this, but no more than MAX_PING_DIFFERENCE
+PING_MULTIPLIER = 30.0
+MAX_PING_DIFFERENCE = 0.200
+
+# After this many adjustments to a song, widen the max difference by
+# WIDENING for each further adjustment
+WIDENING_AFTER = 3
+WIDENING = 0.025
+
+# Largest amount in seconds a slave can be ahead of the master for it
+# to be corrected by pausing it instead of seeking
+MAX_PAUSE_CORRECTION = 0.500
+
+# Max difference in seconds between when a song was predicted to end
+# and when the next one started for it to count as a natural track
+# change
+TRANSITION_TOLERANCE = 1.0
+
+# Percentiles of skew to estimate for each slave and file type (see
+# SkewSketch)
+SKEW_PERCENTILES = (50, 95, 99)
+
+# Measurements whose round-trip time (the master's and slave's status
+# latencies) is more than RTT_REJECT_SIGMAS standard deviations (as
+# estimated from the median absolute deviation) above the median of the
+# last RTT_WINDOW, and more than RTT_SLACK seconds above their minimum,
+# are rejected (see RttFilter).  The first RTT_WARMUP are always kept.
+RTT_WINDOW = 20
+RTT_WARMUP = 5
+RTT_REJECT_SIGMAS = 3.0
+RTT_SLACK = 0.005
+
+# Starts of each file type to remember, and to have seen before
+# trusting them, when predicting how long a daemon takes to start
+# playing (see StartLatencies)
+START_LATENCY_LENGTH = 20
+START_LATENCY_MIN = 2
+
+# Remote streams (e.g. internet radio) can't be seeked, so slaves are
+# started together instead, each one earlier by its buffering delay
+# (see Master._startStreams).  Until a slave's delay has been measured,
+# STREAM_BUFFERING seconds is assumed.  Slaves' statuses are polled
+# every STREAM_POLL seconds, for up to STREAM_TIMEOUT seconds, to
+# measure it.
+STREAM_BUFFERING = 1.0
+STREAM_POLL = 0.05
+STREAM_TIMEOUT = 10.0
+
+# With --burst, after a song starts or a slave is corrected, the Seeker
+# measures again after BURST_SETTLE seconds, taking BURST_SAMPLES
+# measurements back to back and keeping the BURST_KEEP with the shortest
+# round-trip times (see Master._burst)
+BURST_SETTLE = 0.5
+BURST_SAMPLES = 6
+BURST_KEEP = 3
+
+# How much each measurement moves a slave's offset in GroupSkew, which
+# smooths them like an exponential moving average
+GROUP_SKEW_SMOOTHING = 0.3
+
+# With --memory-budget, the most songs to keep adjustments and
+# differences for, adjustments to keep for each file type, and
+# differences to keep for the current song
+BUDGET_SONGS = 50
+BUDGET_ADJUSTMENTS = 100
+BUDGET_DIFFERENCES = 300
+
+# Idle events from a slave within this many seconds of mpdsync
+# changing it are most likely caused by mpdsync itself, so they are
+# ignored (see Master.checkSlave)
+SLAVE_EVENT_GRACE = 1.0
+
+# Seconds to wait before reconnecting a slave's idle connection
+SLAVE_WATCH_RETRY = 5.0
+
+# Seconds to wait for an idle thread to stop (see IdleWatcher.stop)
+IDLE_STOP_TIMEOUT = 5.0
+
+# With --failover, masters are pinged every FAILOVER_INTERVAL seconds,
+# and one that misses FAILOVER_MISSES pings in a row is replaced by its
+# best-synced slave; while it's gone, it's tried again every
+# FAILOVER_INTERVAL seconds (see Zones.failOver and Heartbeat)
+FAILOVER_INTERVAL = 1.0
+FAILOVER_MISSES = 2
+
+# Seconds between timing updates sent by a relay (see RelayServer),
+# seconds after which a downstream stops trusting the last update, and
+# seconds to wait before reconnecting to an upstream relay
+RELAY_INTERVAL = 1.0
+RELAY_STALE = 10.0
+RELAY_RETRY = 5.0
+
+# Seconds a control command waits for the event loop to run it before
+# it's answered with an error (see ControlServer)
+CONTROL_TIMEOUT = 30.0
+
+# Seconds between writes of the metrics textfile
+METRICS_TEXTFILE_INTERVAL = 15
+
+# Number of buckets per power of 2 in LatencyHistograms, which makes
+# their values accurate to within 1/16 (about 6%)
+LATENCY_SUB_BUCKETS = 16
+
+# Histogram buckets for durations in seconds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# ** Decorators
+
+def traced(method):
+    '''Records a span for each call of METHOD while tracing (see Tracer),
+    tagged with the slave if the first argument is one.'''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not tracer.enabled:
+            return method(self, *args, **kwargs)
+
+        spanArgs = {}
+        if args and isinstance(args[0], Client):
+            spanArgs['slave'] = args[0].address
+
+        with tracer.span('%s.%s' % (self.__class__.__name__, method.__name__), **spanArgs):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 # ** Classes
 class MyFloat(float):
     '''Rounds and pads to 3 decimal places when printing.  Also overrides
@@ -113,6 +264,11 @@ class AveragedList(list):
     def append(self, arg):
         arg = MyFloat(arg)
         super(AveragedList, self).append(arg)
+
+        # Remove the oldest elements if length is limited
+        while (self.length
+               and len(self) > self.length):
+            self.pop(0)
         self._updateStats()
 
     def clear(self):
@@ -156,1121 +312,4673 @@ class AveragedList(list):
             self.log.debug(self)
 
 
-class Client(mpd.MPDClient):
-    '''Subclasses mpd.MPDClient, keeping state data, reconnecting as
-    needed, etc.'''
+class P2Quantile(object):
+    '''Estimates quantile P (0-1) of a stream of values in constant
+    memory, with the P-squared algorithm (Jain and Chlamtac, 1985): five
+    markers track the minimum, the maximum, the quantile, and the
+    quantiles halfway to each side, and are moved with piecewise
+    parabolic interpolation as values arrive.'''
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+
+        # Marker heights, positions, desired positions, and increments
+        # of the desired positions
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        self.count += 1
+
+        heights = self.heights
+        if len(heights) < 5:
+            # Not enough values for the markers yet
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, extending the extremes
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
 
-    initAttrs = {None: ['currentStatus', 'lastSong',
-                        'currentSongFiletype', 'playlist',
-                        'playlistVersion', 'playlistLength',
-                        'song', 'duration', 'elapsed', 'state',
-                        'hasBeenSynced', 'playing', 'paused'],
-                 False: ['consume', 'random', 'repeat',
-                         'single']}
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
 
-    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
-                 logger=None):
+        # Move the middle markers if they're off their desired
+        # positions
+        for i in range(1, 4):
+            offset = self.desired[i] - positions[i]
 
-        super(Client, self).__init__()
+            if ((offset >= 1 and positions[i + 1] - positions[i] > 1)
+                or (offset <= -1 and positions[i - 1] - positions[i] < -1)):
+                step = 1 if offset > 0 else -1
 
-        # Command timeout
-        self.timeout = 10
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
 
-        # Split host/latency
-        if '/' in host:
-            host, latency = host.split('/')
+                heights[i] = height
+                positions[i] += step
 
-        if latency is not None:
-            self.latency = float(latency)
-        else:
-            self.latency = None
+    def value(self):
+        "Return the estimate, or None if there are no values yet."
 
-        # Split host/port
-        if ':' in host:
-            host, port = host.split(':')
+        if not self.count:
+            return None
 
-        self.host = host
-        self.port = port
-        self.password = password
+        if self.count < 5:
+            # Exact, from the values so far
+            return self.heights[min(len(self.heights) - 1, int(self.p * len(self.heights)))]
 
-        self.log = logger.getChild('%s(%s)' %
-                                   (self.__class__.__name__, self.host))
+        return self.heights[2]
 
-        self.syncLoopLocked = False
-        self.playedSinceLastPlaylistUpdate = False
+    def _parabolic(self, i, step):
+        q, n = self.heights, self.positions
 
-        self.currentSongShouldSeek = True
-        self.currentSongAdjustments = None
-        self.currentSongDifferences = AveragedList(
-            name='currentSongDifferences')
+        return q[i] + step / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
 
-        self.pings = AveragedList(name='%s.pings' % self.host, length=10)
-        self.adjustments = AveragedList(name='%sadjustments' % self.host,
-                                        length=20)
-        self.initialPlayTimes = AveragedList(name='%s.initialPlayTimes'
-                                             % self.host, length=20,
-                                             printDebug=True)
+    def _linear(self, i, step):
+        q, n = self.heights, self.positions
 
-        # MAYBE: Should I reset this in _initAttrs() ?
-        self.reSeekedTimes = 0
+        return q[i] + step * (q[i + step] - q[i]) / float(n[i + step] - n[i])
 
-        # Record adjustments by file type to see if there's a pattern
-        self.fileTypeAdjustments = defaultdict(AveragedList)
 
-        # TODO: Record each song's number of adjustments in a list (by
-        # filename), and print on exit.  This way I can play a short
-        # playlist in a loop and see if there is a pattern with
-        # certain songs being consistently bad at syncing and seeking.
-        self.song_adjustments = []
+class SkewSketch(object):
+    '''Percentiles (see SKEW_PERCENTILES) and maximum of the absolute
+    differences between a slave and the master, in constant memory.'''
 
-        self.song_differences = []
+    def __init__(self):
+        self.quantiles = [(percentile, P2Quantile(percentile / 100.0))
+                          for percentile in SKEW_PERCENTILES]
+        self.count = 0
+        self.max = 0
 
-    def ping(self):
-        '''Pings the daemon and records how long it took.'''
+    def __str__(self):
+        return ' '.join('%s:%s' % (key, value) for key, value in sorted(self.summary().items()))
 
-        self.pings.insert(0, timeFunction(super(Client, self).ping))
+    def add(self, difference):
+        difference = abs(difference)
 
-    def checkConnection(self):
-        '''Pings the daemon and tries to reconnect if necessary.'''
+        self.count += 1
+        self.max = max(self.max, difference)
+        for percentile, quantile in self.quantiles:
+            quantile.add(difference)
 
-        # I don't know why this is necessary, but for some reason the
-        # slave connections tend to get dropped.
-        try:
-            self.ping()
+    def summary(self):
+        summary = {'count': self.count, 'max': round(self.max, 6)}
+        for percentile, quantile in self.quantiles:
+            value = quantile.value()
+            summary['p%s' % percentile] = round(value, 6) if value is not None else None
 
-        except Exception as e:
-            self.log.debug('Connection to "%s" seems to be down.  '
-                           'Trying to reconnect...', self.host)
+        return summary
 
-            # Try to disconnect first
-            try:
-                self.disconnect()  # Maybe this will help it reconnect
-            except Exception as e:
-                self.log.exception("Couldn't DISconnect from client %s: %s",
-                                   self.host, e)
 
-            # Try to reconnect
-            try:
-                self.connect()
-            except Exception as e:
-                self.log.critical('Unable to reconnect to "%s"', self.host)
+class RttFilter(object):
+    '''Rejects measurements taken while the link to a slave was slower
+    than usual (e.g. during Wi-Fi hiccups), since it's unknown when
+    during the round trip the slave's position was taken.  Every
+    round-trip time goes into the window, so a link that stays slower
+    soon becomes the new normal.'''
 
-                return False
-            else:
-                self.log.debug('Reconnected to "%s"', self.host)
+    def __init__(self, window=RTT_WINDOW):
+        self.window = window
+        self.rtts = []
 
-                return True
+        self.accepted = 0
+        self.rejected = 0
 
-        else:
-            self.log.debug("Connection still up to %s", self.host)
+    def __str__(self):
+        return 'accepted:%s rejected:%s limit:%s' % (self.accepted, self.rejected, self.limit())
 
-            return True
+    def accept(self, rtt):
+        "Return True if a measurement with round-trip time RTT can be trusted."
 
-    def connect(self):
-        '''Connects to the daemon, sets the password if necessary, and tests
-        the ping time.'''
+        limit = self.limit()
 
-        # Reset initial values
-        for val, attrs in self.initAttrs.items():
-            for attr in attrs:
-                setattr(self, attr, val)
+        self.add(rtt)
 
-        super(Client, self).connect(self.host, self.port)
+        if limit is not None and rtt > limit:
+            self.rejected += 1
 
-        if self.password:
-            super(Client, self).password(self.password)
+            return False
 
-        self.testPing()
+        self.accepted += 1
 
-        self.log.debug("Connected.")
+        return True
 
-    def disconnect(self):
-        "Disconnect from MPD."
+    def add(self, rtt):
+        "Add round-trip time RTT to the window without judging a measurement by it."
 
-        super(Client, self).disconnect()
+        self.rtts.append(rtt)
+        if len(self.rtts) > self.window:
+            self.rtts.pop(0)
 
-        self.log.debug("Disconnected.")
+    def limit(self):
+        "Return the largest round-trip time accepted now, or None during warmup."
 
-    def getPlaylist(self):
-        '''Gets the playlist from the daemon.'''
+        if len(self.rtts) < RTT_WARMUP:
+            return None
 
-        self.playlist = super(Client, self).playlist()
+        rtts = sorted(self.rtts)
+        median = rtts[len(rtts) // 2]
+        mad = sorted(abs(rtt - median) for rtt in rtts)[len(rtts) // 2]
 
-        self.log.debug("Got playlist")
+        # 1.4826 MADs are one standard deviation of normal noise
+        return max(median + RTT_REJECT_SIGMAS * 1.4826 * mad, rtts[0] + RTT_SLACK)
 
-    def pause(self):
-        '''Pauses the daemon and tracks the playing state.'''
 
-        super(Client, self).pause()
-        self.playing = False
-        self.paused = True
+class StartLatencies(object):
+    '''How long a daemon takes to start playing, by file type (i.e.
+    decoder) and whether the file is remote, learned from each time it
+    was started (see Master.syncPlayer).'''
 
-    def play(self, initial=False):
-        '''Plays the daemon, adjusting starting position as necessary.'''
+    def __init__(self, length=START_LATENCY_LENGTH):
+        # (file type, remote): AveragedList
+        self.latencies = defaultdict(lambda: AveragedList(length=length))
 
-        # FIXME: I was checking if (self.playedSinceLastPlaylistUpdate
-        # == False), but I removed that code.  I'm not sure if it's
-        # still necessary.
+    def __str__(self):
+        return ' '.join('%s%s:%s' % (fileType, '(remote)' if remote else '', latencies.average)
+                        for (fileType, remote), latencies in sorted(self.latencies.items(),
+                                                                    key=lambda i: str(i[0])))
 
-        if initial:
-            # Slave is not already playing, or is playing a different song
-            self.log.debug("%s.play(initial=True)", self.host)
+    @staticmethod
+    def key(uri):
+        "Return (file type, remote) of URI, which may have a \"file: \" prefix."
 
-            # Calculate adjustment
-            if self.latency is not None:
-                # Use user-set adjustment
-                offset = self.latency
-            elif self.initialPlayTimes.average:
-                self.log.debug("Adjusting by average initial play time")
+        uri = FILE_PREFIX_RE.sub('', uri)
+        name = uri.split('?')[0].rsplit('/', 1)[-1]
+        fileType = name.rsplit('.', 1)[-1].lower() if '.' in name else None
 
-                offset = self.initialPlayTimes.average
-            else:
-                self.log.debug("Adjusting by average ping")
+        return fileType, isRemote(uri)
 
-                offset = self.pings.average
+    def update(self, uri, latency):
+        self.latencies[self.key(uri)].insert(0, latency)
 
-            self.log.debug('Adjusting initial play by %s seconds', offset)
+    def estimate(self, uri):
+        "Return how long URI will probably take to start, or None if unknown."
 
-            # Update status (not sure if this is still necessary, but
-            # it might help avoid race conditions or something)
-            self.status()
+        latencies = self.latencies.get(self.key(uri))
+        if latencies and len(latencies) >= START_LATENCY_MIN:
+            return latencies.average
 
-            # Execute in command list
-            # TODO: Is a command list necessary or helpful here?
-            try:
-                self.command_list_ok_begin()
-            except mpd.CommandListError as e:
-                # Server was already in a command list; probably a
-                # lost client connection, so try again
-                self.log.exception("mpd.CommandListError: %s", e)
 
-                self.command_list_end()
-                self.command_list_ok_begin()
+class GroupSkew(object):
+    '''How far apart a group of slaves are: the smallest and largest of
+    their offsets from the master (each smoothed over its recent
+    measurements), the spread between them, and percentiles of the
+    spread, in constant memory.  Updating a slave's offset is O(1),
+    except when it was the smallest or largest and moves inward, or is
+    removed, and the new extreme has to be found among the others.'''
 
-            # Adjust starting position if necessary
-            # TODO: Is it necessary or good to make sure it's a
-            # positive adjustment?  There seem to be some tracks that
-            # require negative adjustments, but I don't know if that
-            # would be the case when playing from a stop
-            if offset > 0:
-                tries = 0
+    def __init__(self):
+        # Address: smoothed offset
+        self.offsets = {}
 
-                # Wait for the server to...catch up?  I don't remember
-                # exactly why this code is here, because it seems like
-                # the master shouldn't be behind the slaves, but I
-                # suppose it could happen on song changes
-                while self.elapsed is None and tries < 10:
-                    time.sleep(0.2)
-                    self.status()
-                    self.log.debug(self.song)
-                    tries += 1
+        # (offset, address) of the extremes, or None without slaves
+        self.min = self.max = None
 
-                # Seek to the adjusted playing position
-                self.seek(self.song, self.elapsed + offset)
+        self.spread = SkewSketch()
+        self.lock = Lock()
 
-            # Issue the play command
-            super(Client, self).play()
+    def __str__(self):
+        if not self.offsets:
+            return 'no slaves'
 
-            # Execute command list
-            try:
-                result = self.command_list_end()
-            except mpd.ProtocolError:
-                self.log.exception("Unable to play client: %s.  Trying to resync...", self.host)
+        return 'min:%s max:%s spread:%s (%s)' % (round(self.min[0], 6), round(self.max[0], 6),
+                                                 round(self.max[0] - self.min[0], 6), self.spread)
 
-                return False
+    def update(self, address, difference):
+        "Add a measured DIFFERENCE of slave at ADDRESS from the master."
 
-        else:
-            # Slave is already playing current song
-            self.log.debug("%s.play(initial=False)", self.host)
+        with self.lock:
+            previous = self.offsets.get(address)
+            if previous is None:
+                offset = difference
+            else:
+                offset = previous + GROUP_SKEW_SMOOTHING * (difference - previous)
+            self.offsets[address] = offset
 
-            # Issue the play command
-            result = super(Client, self).play()
+            if self.min is None or offset <= self.min[0]:
+                self.min = (offset, address)
+            elif self.min[1] == address:
+                self._findExtremes()
 
-        # TODO: Not sure if this is still necessary to track...
-        self.playedSinceLastPlaylistUpdate = True
+            if self.max is None or offset >= self.max[0]:
+                self.max = (offset, address)
+            elif self.max[1] == address:
+                self._findExtremes()
 
-        return result
+            if len(self.offsets) > 1:
+                self.spread.add(self.max[0] - self.min[0])
 
-    def seek(self, song, elapsed):
-        '''Seeks daemon to a position and updates local attributes for current
-        song and elapsed time.'''
+    def remove(self, address):
+        "Forget slave at ADDRESS, e.g. until it has measurements for a new song."
 
-        self.song = song
-        self.elapsed = elapsed
-        super(Client, self).seek(self.song, self.elapsed)
+        with self.lock:
+            if self.offsets.pop(address, None) is None:
+                return
 
-    def status(self):
-        '''Gets daemon's status and updates local attributes.'''
+            if address in (self.min[1], self.max[1]):
+                self._findExtremes()
 
-        self.currentStatus = super(Client, self).status()
+    def median(self):
+        "Return the median offset, or None without slaves."
 
-        # Wrap whole thing in try/except because of MPD protocol
-        # errors.  But I may have fixed this by "locking" each client
-        # in the loop, so this may not be necessary anymore.
-        try:
+        with self.lock:
+            offsets = sorted(self.offsets.values())
 
-            # Not sure why, but sometimes this ends up as None when
-            # the track or playlist is changed...?
-            if self.currentStatus:
-                # Status response received
+        if not offsets:
+            return None
 
-                # Set playlist attrs
-                self.playlistLength = int(self.currentStatus['playlistlength'])
-                if self.playlist:
-                    if self.song:
-                        if int(self.song) >= len(self.playlist):
-                            self.log.exception(
-                                'Current song number > (playlist length - 1)'
-                                ' (%s>%s).  What is causing this pesky bug?',
-                                int(self.song), len(self.playlist))
-                        else:
-                            self.currentSongFiletype = (
-                                self.playlist[int(self.song)].split('.')[-1])
-                    else:
-                        self.currentSongFiletype = None
+        middle = len(offsets) // 2
+        if len(offsets) % 2:
+            return offsets[middle]
+        else:
+            return (offsets[middle - 1] + offsets[middle]) / 2
 
-                    self.log.debug('Current filetype: %s',
-                                   self.currentSongFiletype)
+    def _findExtremes(self):
+        if self.offsets:
+            self.min = min((offset, address) for address, offset in self.offsets.items())
+            self.max = max((offset, address) for address, offset in self.offsets.items())
+        else:
+            self.min = self.max = None
 
-                # Set True/False attrs
-                for attr in self.initAttrs[False]:
-                    val = (True
-                           if self.currentStatus[attr] == '1'
-                           else False)
-                    setattr(self, attr, val)
 
-                # Set playing state attrs
-                self.state = self.currentStatus['state']
-                self.playing = (True
-                                if self.state == 'play'
-                                else False)
-                self.paused = (True
-                               if self.state == 'pause'
-                               else False)
+class SlaveDatabase(object):
+    '''Index of the files available in a slave's database.  Used to keep
+    missing files out of the command lists sent to the slave, because
+    one bad path makes MPD reject the whole list.'''
 
-                # Set song attrs
-                self.song = (self.currentStatus['song']
-                             if 'song' in self.currentStatus
-                             else None)
-                for attr in ['duration', 'elapsed']:
-                    val = (MyFloat(self.currentStatus[attr])
-                           if attr in self.currentStatus
-                           else None)
-                    setattr(self, attr, val)
+    def __init__(self, client, cacheDir=None):
+        self.log = client.log.getChild(self.__class__.__name__)
 
-            else:
-                # None?  Sigh...  This shouldn't happen...if it does
-                # I'll need to reconnect, I think...
-                self.log.error("No status received for client %s", self.host)
+        self.client = client
+        self.cacheDir = cacheDir
 
-        except Exception as e:
-            # No status response :(
-            self.log.exception("Unable to get status for client %s: %s",
-                               self.host, e)
+        self.files = set()
+        self.basenames = {}
+        self.dbUpdate = None
 
-            # Try to reconnect
-            self.checkConnection()
+    def __contains__(self, uri):
+        return isRemote(uri) or uri in self.files
 
-        # TODO: Add other attributes, e.g. {'playlistlength': '55',
-        # 'playlist': '3868', 'repeat': '0', 'consume': '0',
-        # 'mixrampdb': '0.000000', 'random': '0', 'state': 'stop',
-        # 'volume': '-1', 'single': '0'}
+    @property
+    def cacheFile(self):
+        if self.cacheDir:
+            return os.path.join(self.cacheDir, 'mpdsync-%s-%s.json'
+                                % (self.client.host, self.client.port))
 
-    def testPing(self):
-        '''Pings the daemon 5 times and sets the initial maxDifference.'''
+    def refresh(self, force=False):
+        '''Rebuilds the index if the slave's database has been updated since
+        it was last built.  The on-disk cache is used when it matches
+        the slave's database.'''
 
-        for i in range(5):
-            self.ping()
-            time.sleep(0.1)
+        # "db_update" is the time of the last database update, so
+        # it's a cheap way to tell if the index is stale
+        dbUpdate = self.client.stats().get('db_update')
 
-        self.maxDifference = self.pings.average * 5
+        if not force:
+            if self.files and dbUpdate == self.dbUpdate:
+                return
 
-        self.log.debug('Average ping for %s: %s seconds; '
-                       'setting maxDifference: %s',
-                       self.host, self.pings.average, self.maxDifference)
+            if self._load(dbUpdate):
+                return
 
+        self._build()
+        self.dbUpdate = dbUpdate
+        self._save()
 
-class Master(Client):
-    def __init__(self, *args, **kwargs):
+    def filter(self, uris):
+        '''Returns a list of the URIs that can be added to the slave,
+        substituting files found elsewhere in the slave's database by
+        the same name, and skipping the rest, and a list of the position
+        in it of each of URIS (None for the skipped ones).'''
 
-        # Don't pass adjustLatency to Client
-        # FIXME: Is there a nicer way to do this?
-        attr = 'adjustLatency'
-        if attr in kwargs:
-            self.adjustLatency = kwargs[attr]
-            del kwargs[attr]
-        else:
-            self.adjustLatency = None
+        self.refresh()
 
-        super(Master, self).__init__(*args, **kwargs)
+        result = []
+        positions = []
+        for uri in uris:
+            uri = self.substitute(uri)
+            if uri is None:
+                positions.append(None)
+            else:
+                positions.append(len(result))
+                result.append(uri)
 
-        self.slaves = []
-        self.slaveDifferences = AveragedList(name='slaveDifferences', length=10)
-        self.elapsedLoopRunning = False
+        return result, positions
 
-        self.seeker = None
+    def substitute(self, uri):
+        '''Returns URI, or a file with the same name in the slave's database
+        if URI is missing from it, or None if there is no such file.'''
 
-    def _average_difference(self, slave):
-        """Return absolute value of average difference between slave and
-        master, recording data in attributes as side-effect."""
+        if uri in self:
+            return uri
 
-        # TODO: Some songs MPD seems unable to sync properly.  If the
-        # seek value is higher than a certain position, it will always
-        # seek to around the same value, meaning it basically can't
-        # seek past a certain point in the song.  This leads to
-        # endless syncs, and it means the slave seeks to the same
-        # place over and over again until the master moves on to the
-        # next song.  This causes the slave to sound like a broken
-        # record.  Perhaps charming in a nostalgic kind of way, but
-        # not exactly desirable...  So I guess I need to try to detect
-        # this somehow.  Sigh.
+        # Only use the name if it's unique; otherwise we might play
+        # the wrong song
+        substitute = self.basenames.get(uri.split('/')[-1])
+        if substitute:
+            self.log.warning('File missing on slave %s: "%s"; using "%s" instead',
+                             self.client.host, uri, substitute)
+        else:
+            # NOTE: This means the slave's playlist will be shorter
+            # than the master's, but that's better than having no
+            # playlist at all (see Master.slaveSong)
+            self.log.warning('File missing on slave %s: "%s"; skipping',
+                             self.client.host, uri)
 
-        # Check pings
-        self.ping()
-        slave.ping()
-        masterPing = self.pings[0]
-        slavePing = slave.pings[0]
-        ping = abs(masterPing - slavePing)
+        return substitute
 
-        self.log.debug("Last ping time for slave %s: %s", slave.host, ping)
+    def _build(self):
+        '''Builds the index from the slave's database.'''
 
-        # Get master status and time how long it takes
-        masterStatusLatency = MyFloat(timeFunction(self.status))
+        self.log.debug("Building database index for %s", self.client.host)
 
-        self.log.debug("masterStatusLatency:%s", masterStatusLatency)
+        # List each top-level directory separately, because listing
+        # a large database at once can exceed MPD's output buffer
+        files = []
+        for entry in self.client.lsinfo():
+            if 'directory' in entry:
+                files.extend(e['file'] for e in self.client.listall(entry['directory'])
+                             if 'file' in e)
+            elif 'file' in entry:
+                files.append(entry['file'])
 
-        # Get slave status and time how long it takes
-        slaveStatusLatency = MyFloat(timeFunction(slave.status))
+        self._setFiles(files)
 
-        self.log.debug("slaveStatusLatency:%s", slaveStatusLatency)
+        self.log.debug("Indexed %s files on %s", len(self.files), self.client.host)
 
-        # If song changed, reset differences
-        if slave.lastSong != slave.song:
-            self.log.debug("Song changed (%s -> %s); "
-                           "resetting %s.currentSongDifferences",
-                           slave.lastSong, slave.song, slave.host)
+    def _setFiles(self, files):
+        self.files = set(files)
 
-            # TODO: Put this in a function?
-            slave.currentSongShouldSeek = True
-            slave.currentSongAdjustments = AveragedList(name='%s.currentSongAdjustments' % slave.host,
-                                                        length=10, printDebug=True)
-            slave.currentSongDifferences = AveragedList(name='%s.currentSongDifferences' % slave.host)
-            slave.lastSong = slave.song
+        # Map names to files, or to None when a name is not unique
+        self.basenames = {}
+        for f in self.files:
+            name = f.split('/')[-1]
+            self.basenames[name] = None if name in self.basenames else f
 
-            # Record song differences and adjustments for later debugging
-            slave.song_adjustments.append({'file': slave.playlist[int(slave.song)],
-                                           'adjustments': slave.currentSongAdjustments})
-            slave.song_differences.append({'file': slave.playlist[int(slave.song)],
-                                           'differences': slave.currentSongDifferences})
+    def _load(self, dbUpdate):
+        '''Loads the index from the cache file, returning True if it matches
+        DBUPDATE.'''
 
-        if slave.elapsed:
+        if not self.cacheFile or not os.path.exists(self.cacheFile):
+            return False
 
-            # Seems like it would make sense to add the
-            # masterStatusLatency, but I seem to be observing that the
-            # opposite is the case...
-            difference = self.elapsed - (slave.elapsed + slaveStatusLatency)
+        try:
+            with open(self.cacheFile) as f:
+                cache = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warning("Unable to read database cache %s: %s", self.cacheFile, e)
 
-            # Record the difference
-            slave.currentSongDifferences.insert(0, difference)
+            return False
 
-            # "Difference" is approximately aligned with the average
-            # below in the debug output
-            self.log.debug('Master/%s elapsed:%s/%s  Difference:%s',
-                           slave.host, self.elapsed, slave.elapsed, difference)
-            self.log.debug(slave.currentSongDifferences)
-            self.log.debug(slave.currentSongAdjustments)
+        if cache.get('db_update') != dbUpdate:
+            self.log.debug("Database cache for %s is stale", self.client.host)
 
-            return abs(slave.currentSongDifferences.average)
+            return False
 
-    def status(self):
-        '''Gets the master's status and updates its playlistVersion
-        attribute.'''
+        self._setFiles(cache['files'])
+        self.dbUpdate = dbUpdate
 
-        super(Master, self).status()
+        self.log.debug("Loaded %s files from database cache for %s",
+                       len(self.files), self.client.host)
 
-        # Use the master's reported playlist version (for the slaves
-        # we update it manually to match the master)
-        self.playlistVersion = self.currentStatus['playlist']
+        return True
 
-    def addSlave(self, host, password=None):
-        '''Connects to a slave, gets its status, and adds it to the list of
-        slaves.'''
+    def _save(self):
+        '''Writes the index to the cache file.'''
 
-        slave = Client(host, password=password, logger=self.log)
+        if not self.cacheFile:
+            return
 
-        # Connect to slave
+        # Write to a temp file first so a crash can't leave a
+        # truncated cache behind
+        tempFile = self.cacheFile + '.tmp'
         try:
-            slave.connect()
-        except Exception as e:
-            self.log.exception('Unable to connect to slave: %s:%s: %s',
-                               slave.host, slave.port, e)
-        else:
-            self.log.debug('Connected to slave: %s' % slave.host)
+            with open(tempFile, 'w') as f:
+                json.dump({'db_update': self.dbUpdate,
+                           'files': sorted(self.files)}, f)
+            os.rename(tempFile, self.cacheFile)
+        except (IOError, OSError) as e:
+            self.log.warning("Unable to write database cache %s: %s", self.cacheFile, e)
 
-            self.slaves.append(slave)
 
-            # Get initial status (this is not automatic upon connection)
-            slave.status()
+class TransitionPredictor(object):
+    '''Predicts when a daemon will change to the next track on its own,
+    so a natural track change can be told apart from one made by a
+    user (which the slaves can't have followed by themselves).'''
 
-    def syncAll(self):
-        '''Syncs all slaves completely.'''
+    def __init__(self, tolerance=TRANSITION_TOLERANCE):
+        self.tolerance = tolerance
 
-        self.syncPlaylists()
-        self.syncOptions()
-        self.syncPlayers()
+        self.song = None
+        self.endsAt = None
 
-    def syncPlaylists(self):
-        '''Syncs all slaves' playlists.'''
+        # Counters
+        self.predicted = 0
+        self.unpredicted = 0
 
-        # Get master info
-        self.status()
-        self.getPlaylist()
+    def __str__(self):
+        return 'predicted:%s unpredicted:%s' % (self.predicted, self.unpredicted)
 
-        # Sync slaves
-        for slave in self.slaves:
+    def update(self, client):
+        '''Records CLIENT's current song and when it should end, according
+        to its last status.'''
 
-            # Reconnect if necessary (slave connections tend to drop for
-            # some reason)
-            if not slave.checkConnection():
-                # If it can't reconnect...we can't sync the playlists,
-                # or it will raise an exception
-                raise Exception("Unable to reconnect to slave: %s", slave.host)
+        if client.playing and client.duration and client.elapsed is not None:
+            self.song = client.song
+            self.endsAt = time.time() + (client.duration - client.elapsed)
+        else:
+            self.song = None
+            self.endsAt = None
 
-            if not slave.hasBeenSynced:
-                # Do a full sync the first time
+    def isNatural(self, client):
+        '''Returns True if CLIENT, whose status must be current, has changed
+        to the next song when the previous one was predicted to end.'''
 
-                # Compare playlists; don't clear if they're the same
-                slave.getPlaylist()
-                if slave.playlist != self.playlist:
-                    # Playlists differ
-                    self.log.debug("Playlist differs on slave %s; syncing...",
-                                   slave.host)
+        if self.song is None or not client.playing or client.song is None:
+            return False
 
-                    #Start command list
-                    slave.command_list_ok_begin()
+        if client.song == self.song:
+            # Same song (e.g. seeked)
+            return False
 
-                    # Clear playlist
-                    slave.clear()
+        # The next song can't be predicted in random mode, and in
+        # consume mode the playlist changes too
+        if client.random or client.consume:
+            self.unpredicted += 1
 
-                    # Add tracks
-                    for song in self.playlist:
-                        # Remove "file: " from song filename
-                        slave.add(FILE_PREFIX_RE.sub('', song))
+            return False
 
-                    # Execute command list
-                    result = slave.command_list_end()
+        nextSong = int(self.song) + 1
+        if client.repeat and nextSong >= client.playlistLength:
+            nextSong = 0
 
-                    if not result:
-                        self.log.critical("Couldn't add tracks to playlist on slave: %s",
-                                          slave.host)
-                        continue
-                    else:
-                        self.log.debug("Added to playlist on slave %s, result: %s",
-                                       slave.host, result)
+        # When the new song started, according to its elapsed time
+        startedAt = time.time() - (client.elapsed or 0)
 
-                        slave.hasBeenSynced = True
+        if (int(client.song) == nextSong
+            and abs(startedAt - self.endsAt) <= self.tolerance):
+            self.predicted += 1
 
-                else:
-                    # Playlists are the same
-                    self.log.debug("Playlist is the same on slave %s", slave.host)
+            return True
+        else:
+            self.unpredicted += 1
 
-                    slave.hasBeenSynced = True
+            return False
 
-            else:
-                # Slave has been synced before; sync playlist changes
 
-                # TODO: if slave.playlistVersion is None, handle it
+class SeekerParams(object):
+    '''The constants the Seeker uses to decide when and how far to correct
+    a slave.  The defaults are the module constants, which are guesses;
+    "mpdtools.py autotune" finds better ones for each slave and writes
+    them to a profile (see SeekerProfile).'''
 
-                # Get list of changes
-                changes = self.plchanges(slave.playlistVersion)
+    defaults = {'maxAdjustments': MAX_ADJUSTMENTS,
+                'maxAdjustment': MAX_ADJUSTMENT,
+                'minDifference': MIN_DIFFERENCE,
+                'pingMultiplier': PING_MULTIPLIER,
+                'maxPingDifference': MAX_PING_DIFFERENCE,
+                'wideningAfter': WIDENING_AFTER,
+                'widening': WIDENING}
 
-                # Start command list
-                slave.command_list_ok_begin()
+    def __init__(self, **params):
+        for param, default in self.defaults.items():
+            # Keep counts as ints
+            setattr(self, param, type(default)(params.pop(param, default)))
 
-                # Make changes
-                for change in changes:
-                    self.log.debug('Adding to slave:"%s" file:"%s" at pos:%s',
-                                   slave.host, change['file'], change['pos'])
+        if params:
+            raise ValueError('Unknown Seeker parameters: %s' % ', '.join(sorted(params)))
 
-                    slave.addid(change['file'], change['pos'])
+    def __repr__(self):
+        return 'SeekerParams(%s)' % ', '.join('%s=%s' % (param, value)
+                                              for param, value in sorted(self.toDict().items()))
 
-                # Execute command list
-                try:
-                    results = slave.command_list_end()
-                except mpd.ProtocolError as e:
-                    if e.message == "Got unexpected 'OK'":
-                        self.log.exception("mpd.ProtocolError: Got unexpected 'OK'")
+    def toDict(self):
+        return dict((param, getattr(self, param)) for param in self.defaults)
 
-                        continue  # Maybe it will work next time around...
 
-                # Check results
-                if not results:
-                    # This should not happen.  SIGH.
-                    self.log.error("SIGH.")
+class SeekerProfile(object):
+    '''SeekerParams for each slave, by HOST:PORT address, and for slaves
+    that aren't listed.  Saved as JSON like:
 
-                    continue
+    {"default": {"maxAdjustment": 0.3, ...},
+     "slaves": {"kitchen:6600": {"maxAdjustment": 0.15, ...}}}
 
-                # Add tags for remote tracks (e.g. files streaming
-                # over HTTP) that have tags in playlist
-                slave.command_list_ok_begin()
-                for num, change in enumerate(changes):
-                    if 'http' in change['file']:
-                        for tag in ['artist', 'album', 'title', 'genre']:
-                            if tag in change:
-
-                                # results is a list of song IDs that
-                                # were added; it corresponds to
-                                # changes
-                                slave.addtagid(int(results[num]), tag, change[tag])
-                try:
-                    slave.command_list_end()
-                except mpd.ProtocolError as e:
-                    if e.message == "Got unexpected 'OK'":
-                        self.log.exception("mpd.ProtocolError: Got unexpected 'OK'")
+    Parameters that aren't given keep their defaults.'''
 
-                # Update slave status
-                slave.status()
+    def __init__(self, default=None, slaves=None):
+        self.default = default or SeekerParams()
+        self.slaves = slaves or {}
 
-                # Truncate the slave playlist to the same length as the master
-                if self.playlistLength == 0:
-                    slave.clear()
-                elif self.playlistLength < slave.playlistLength:
-                    self.log.debug("Deleting from %s to %s",
-                                   self.playlistLength - 1, slave.playlistLength - 1)
+    def paramsFor(self, address):
+        return self.slaves.get(address, self.default)
 
-                    slave.delete((self.playlistLength - 1, slave.playlistLength - 1))
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
 
-                # Check result
-                slave.status()
-                if slave.playlistLength != self.playlistLength:
-                    self.log.error("Playlist lengths don't match for slave %s: %s / %s",
-                                   slave.host, slave.playlistLength, self.playlistLength)
+        return cls(default=SeekerParams(**data.get('default', {})),
+                   slaves=dict((address, SeekerParams(**params))
+                               for address, params in data.get('slaves', {}).items()))
 
-                # Make sure the slave's playing status still matches the
-                # master (for some reason, deleting a track lower-numbered
-                # than the currently playing track makes the slaves stop
-                # playing)
-                if slave.state != self.state:
-                    # Resync the slave
-                    self.syncPlayer(slave)
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2, sort_keys=True)
 
-            # Update slave playlist version number to match the master's
-            slave.playlistVersion = self.playlistVersion
+    def toDict(self):
+        return {'default': self.default.toDict(),
+                'slaves': dict((address, params.toDict())
+                               for address, params in self.slaves.items())}
 
-            # Not sure if this is still necessary
-            self.playedSinceLastPlaylistUpdate = False
 
-    def syncOptions(self):
-        '''TBI: Sync player options (e.g. random).'''
-        pass
+class SeekActuator(object):
+    '''Corrects a slave's playing position by seeking it to the master's
+    position, adjusted for latency.'''
 
-    def syncPlayers(self):
-        '''Syncs all slaves' player status.'''
+    name = 'seek'
 
-        # SOMEDAY: do this in parallel?
-        for slave in self.slaves:
-            if not self.syncPlayer(slave):
-                self.log.debug("Unable to sync slave: %s.  Trying to resync all...", slave.host)
+    def usable(self, seeker, slave):
+        return True
+
+    def correct(self, seeker, slave):
+        '''Returns the adjustment made, or None if none was made.  Raises an
+        exception if the slave couldn't be seeked.'''
 
-                self.syncAll()
+        # TODO: Idea: Maybe part of the problem is that MPD can't seek
+        # songs precisely, but only to certain places, like between
+        # frames, or something like that.  So maybe if the master and
+        # slaves were both seeked to the same value initially, it
+        # would cause them to both seek to about the same place, once
+        # or twice, instead of the slaves trying repeatedly to get a
+        # good sync.
 
-                return None  # What should we return here?
+        adjustBy = seeker._calc_adjustment(slave)
 
-        # Restart sync thread if necessary
-        if self.adjustLatency:
-            if self.playing:
-                self.checkSeeker()
-            else:
-                if not self.paused:
-                    # Stopped
-                    self.stopSeeker()
+        # Calculate position
+        position = seeker.elapsed - adjustBy
+        if position < 0:
+            seeker.log.debug("Position for %s was < 0 (%s); skipping adjustment",
+                             slave.host, position)
 
-    def syncPlayer(self, slave):
-        '''Sync's a slave's player status.'''
+            return None
 
-        # Try 5 times
-        tries = 0
-        while tries < 5:
+        seeker.log.debug('Master elapsed:%s  Adjusting %s to:%s (song: %s)',
+                         seeker.elapsed, slave.host, position, seeker.song)
 
-            try:
-                # Update master info
-                self.status()
+        # Try to seek to current playing position, adjusted for
+        # latency
+        slave.seek(seeker.slaveSong(slave), position)
 
-                # Reconnect if connection dropped
-                slave.checkConnection()
+        slave.adjustments.insert(0, adjustBy)
+        slave.fileTypeAdjustments[slave.currentSongFiletype].append(adjustBy)
 
-                # Update slave status
-                slave.status()
+        return adjustBy
 
-                # Sync player status
-                if self.playing:
 
-                    # Verify playlist is set.  Sometimes this can get emptied somehow, when connections drop...
-                    if not slave.playlist:
-                        self.syncPlaylists()
+class PauseActuator(object):
+    '''Corrects a slave that is slightly ahead of the master by pausing it
+    for as long as it is ahead.  Unlike seeking, this doesn't depend on
+    where MPD is able to seek to in the song.'''
 
-                    # Don't re-sync if the slave is already playing
-                    # the same song at the right place
-                    if (slave.playing
-                        and slave.song == self.song
-                        and self._average_difference(slave) < 1):
+    name = 'pause'
 
-                        self.log.debug('Slave %s and master already playing same song, less than 1 second apart',
-                                       slave.host)
+    def usable(self, seeker, slave):
+        "Return True if slave is ahead by a small enough amount to pause it."
 
-                    else:
-                        # Slave not playing, or playing a different song
-                        self.log.debug('Playing slave %s, initial=True' % slave.host)
+        difference = seeker._aligned(slave, slave.currentSongDifferences.average)
 
-                        # Seek to current master position before playing
-                        try:
-                            slave.seek(self.song, self.elapsed)
-                        except Exception as e:
-                            self.log.exception("Couldn't seek slave %s: %s", slave.host, e)
+        return -MAX_PAUSE_CORRECTION <= difference < 0
 
-                            return False
+    def correct(self, seeker, slave):
+        '''Returns the time the slave will be paused for.  Raises an
+        exception if the slave couldn't be paused.  It's resumed by a
+        PauseResumer, so the tick isn't held up meanwhile.'''
 
-                        # Play it
-                        if not slave.play(initial=True):
-                            self.log.critical("Couldn't play slave: %s", slave.host)
+        # The slave stays paused until the resume plus the time it
+        # takes the resume command to reach it after the pause command
+        # returns, which is about one ping
+        duration = MyFloat(-seeker._aligned(slave, slave.currentSongDifferences.average))
+        pauseTime = max(0, duration - slave.pings.average)
 
-                            return False
+        seeker.log.debug("Pausing %s for %s (resuming in %s)", slave.host, duration, pauseTime)
 
-                        # Wait a moment and then check the difference
-                        time.sleep(0.2)
-                        playLatency = self._average_difference(slave)
+        # Not pause() with no argument, which toggles
+        slave.pause(1)
+        PauseResumer(seeker, slave, time.time() + pauseTime).start()
 
-                        if not playLatency:
-                            # This probably means the slave isn't playing at all for some reason
-                            self.log.error('No playLatency for slave "%s"', slave.host)
+        return duration
 
-                            slave.stop()  # Maybe...?
 
-                            return False
+class PauseResumer(object):
+    '''Resumes SLAVE, which PauseActuator paused, at RESUMEAT (a
+    time.time()).  Runs in the SEEKER's master's SeekerScheduler, or in
+    its own thread without one.  The Seeker leaves the slave alone
+    until then (see Client.resumePending).'''
 
-                        self.log.debug('Client %s took %s seconds to start playing',
-                                       slave.host, playLatency)
+    def __init__(self, seeker, slave, resumeAt):
+        self.log = seeker.log.getChild(self.__class__.__name__)
 
-                        # Update initial play times
-                        slave.initialPlayTimes.insert(0, playLatency)
+        self.master = seeker.master
+        self.zone = seeker.zone
+        self.slave = slave
+        self.resumeAt = resumeAt
+        self.thread = None
 
-                elif self.paused:
-                    slave.pause()
-                else:
-                    slave.stop()
+    def start(self):
+        self.slave.resumePending = True
 
-            except Exception as e:
-                self.log.exception("Unable to syncPlayer for slave %s.  Tries:%s  Error:%s",
-                                   slave.host, tries, e)
-                tries += 1
+        if self.master.scheduler:
+            self.master.scheduler.add(self)
 
-                return False
-            else:
-                # Sync succeeded
-                return True
+            return
 
-    def startSeeker(self):
-        '''Runs a loop trying to keep the slaves in sync with the master.'''
+        self.thread = Thread(target=self._loop, name='PauseResumer')
+        self.thread.daemon = True
+        self.thread.start()
 
-        # Make new connection to master server that won't idle()
-        self.seeker = Seeker(self)
-        self.seeker.connect()
-        self.seeker.start_loop()
+    def _loop(self):
+        while self.slave.resumePending:
+            time.sleep(self.tick())
 
-    def checkSeeker(self):
-        "Restart seeker thread if necessary."
+    def tick(self):
+        "Resume the slave if it's time.  Return seconds to sleep until then."
 
-        if self.seeker:
-            self.seeker.check_loop()
-        else:
-            self.startSeeker()
+        remaining = self.resumeAt - time.time()
+        if remaining > 0:
+            return remaining
 
-    def stopSeeker(self):
-        "Stop sync loop thread, disconnect seeker connection, and cleanup Seeker instance."
+        try:
+            with self.slave.connectionLock:
+                self.slave.pause(0)
+        except Exception as e:
+            # Its next sync finds it paused and repairs it
+            self.log.error("Unable to resume slave %s: %s", self.slave.host, e)
 
-        if self.seeker:
-            # Stop thread
-            self.seeker.sync = False
-            while self.seeker.thread.is_alive():
-                self.log.debug("Waiting for seeker thread to stop...")
-                time.sleep(0.1)
+        self.slave.resumePending = False
 
-            self.log.debug("Seeker thread stopped.")
+        if self.thread is None:
+            # Done; the scheduler won't tick it again
+            self.master.scheduler.remove(self)
 
-            # Disconnect and cleanup object
-            self.seeker.disconnect()
-            self.seeker = None
+        return 0
 
 
-class Seeker(Master):
-    '''Used to make a second connection to the master server that doesn't
-    idle, which can be used to re-seek slaves' playing positions.'''
+class TimedMPDClient(mpd.MPDClient):
+    '''Records how long each command takes (see CommandLatencies), and
+    when the daemon was last changed by one.  Subclasses must have an
+    address attribute.'''
 
-    # TODO: It would seem like a good idea to avoid doing some things
-    # in this instance, like syncing the playlist, since that's not
-    # relevant to the seeker and takes some time.
+    # Commands that change the queue or the player
+    changeCommands = frozenset(['add', 'addid', 'addtagid', 'clear', 'delete', 'deleteid',
+                                'move', 'moveid', 'next', 'pause', 'play', 'playid',
+                                'previous', 'seek', 'seekcur', 'seekid', 'stop'])
 
-    def __init__(self, master):
-        super(Seeker, self).__init__(master.host, logger=master.log)
+    # Time of the last change
+    lastChange = 0
 
-        # By doing this, we don't have to run status() in the loop,
-        # because it can get the master's playing status from the
-        # other instance
-        self.master = master
-        self.slaves = master.slaves
-        self.sync = False
+    def _execute(self, command, args, retval):
+        # Commands in a command list are timed together by
+        # command_list_end()
+        if self._command_list is not None:
+            return super(TimedMPDClient, self)._execute(command, args, retval)
 
-    def start_loop(self):
-        "Start sync thread (_syncLoop)."
+        start = time.time()
+        try:
+            return super(TimedMPDClient, self)._execute(command, args, retval)
+        finally:
+            end = time.time()
+            if command in self.changeCommands:
+                self.lastChange = end
 
-        self.sync = True
+            commandLatencies.record(self.address, command, end - start)
 
-        # Remove any stale locks
-        for slave in self.slaves:
-            slave.syncLoopLocked = False
+            if tracer.enabled:
+                tracer.complete('mpd.' + command, start, end, {'host': self.address})
 
-        self.thread = Thread(target=self._syncLoop)
-        self.thread.daemon = True
-        self.thread.start()
+    def command_list_end(self):
+        start = time.time()
+        try:
+            return super(TimedMPDClient, self).command_list_end()
+        finally:
+            end = time.time()
+            self.lastChange = end
 
-    def check_loop(self):
-        "Restart _syncLoop if necessary."
+            commandLatencies.record(self.address, 'command_list_end', end - start)
+
+            if tracer.enabled:
+                tracer.complete('mpd.command_list_end', start, end, {'host': self.address})
+
+if mpd_command_provider:
+    # python-mpd2 binds each command method to the _execute() of the
+    # class it was added to, so add them again to use the one above
+    TimedMPDClient = mpd_command_provider(TimedMPDClient)
+
+
+class Client(TimedMPDClient):
+    '''Subclasses mpd.MPDClient (through TimedMPDClient), keeping state data, reconnecting as
+    needed, etc.'''
+
+    initAttrs = {None: ['currentStatus', 'lastSong',
+                        'currentSongFiletype', 'playlist',
+                        'playlistVersion', 'playlistLength',
+                        'song', 'duration', 'elapsed', 'state',
+                        'hasBeenSynced', 'playing', 'paused'],
+                 False: ['consume', 'random', 'repeat',
+                         'single']}
+
+    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
+                 memoryBudget=False, logger=None):
+
+        super(Client, self).__init__()
+
+        # Command timeout
+        self.timeout = 10
+
+        # Split host/latency
+        if '/' in host:
+            host, latency = host.split('/')
+
+        if latency is not None:
+            self.latency = float(latency)
+        else:
+            self.latency = None
+
+        # Split host/port
+        if ':' in host:
+            host, port = host.split(':')
+
+        self.host = host
+        self.port = port
+        self.password = password
+
+        self.log = logger.getChild('%s(%s)' %
+                                   (self.__class__.__name__, self.host))
+
+        # Until connect() resets them, so properties like currentFile
+        # work before the first status()
+        self._initAttrs()
+
+        self.syncLoopLocked = False
+        self.playedSinceLastPlaylistUpdate = False
+
+        # Paused by the Seeker until a PauseResumer resumes it
+        self.resumePending = False
+
+        # Held while anything uses this slave's connection, since the
+        # event loop, Seeker ticks and StreamProbes use it from
+        # different threads
+        self.connectionLock = RLock()
+
+        # Position in this slave's queue of each song in the master's,
+        # or None if it's missing here, when files it doesn't have are
+        # left out (see Master.slaveSong)
+        self.positions = None
+
+        # Limits on history, so memory use doesn't grow over long
+        # sessions (None means unlimited)
+        if memoryBudget:
+            self.maxSongs = BUDGET_SONGS
+            self.maxAdjustments = BUDGET_ADJUSTMENTS
+            self.maxDifferences = BUDGET_DIFFERENCES
+        else:
+            self.maxSongs = self.maxAdjustments = self.maxDifferences = None
+
+        self.currentSongShouldSeek = True
+        self.currentSongAdjustments = None
+        self.currentSongDifferences = AveragedList(
+            name='currentSongDifferences', length=self.maxDifferences)
+
+        self.pings = AveragedList(name='%s.pings' % self.host, length=10)
+        self.adjustments = AveragedList(name='%sadjustments' % self.host,
+                                        length=20)
+        self.initialPlayTimes = AveragedList(name='%s.initialPlayTimes'
+                                             % self.host, length=20,
+                                             printDebug=True)
+
+        # Start latencies by file type, and the offset the last
+        # play(initial=True) compensated by
+        self.startLatencies = StartLatencies()
+        self.lastPlayOffset = 0
+
+        # Difference recorded by the last measurement, or None if it
+        # wasn't recorded (see Master._add_sample)
+        self.lastDifference = None
+
+        # MAYBE: Should I reset this in _initAttrs() ?
+        self.reSeekedTimes = 0
+
+        # Record adjustments by file type to see if there's a pattern
+        self.fileTypeAdjustments = defaultdict(lambda: AveragedList(length=self.maxAdjustments))
+
+        # Percentiles of differences from the master, overall and by
+        # file type
+        self.skew = SkewSketch()
+        self.fileTypeSkew = defaultdict(SkewSketch)
+
+        # TODO: Record each song's number of adjustments in a list (by
+        # filename), and print on exit.  This way I can play a short
+        # playlist in a loop and see if there is a pattern with
+        # certain songs being consistently bad at syncing and seeking.
+        self.song_adjustments = []
+
+        self.song_differences = []
+
+        # Index of files in the daemon's database (see SlaveDatabase)
+        self.database = None
+
+        # Number of times each recovery path has been taken for this
+        # daemon (see Master.repairSlave)
+        self.recoveries = defaultdict(int)
+
+        # Number of corrections made by each actuator, and the average
+        # differences remaining after them (see Seeker._reseek_slave)
+        self.corrections = defaultdict(int)
+        self.correctionResiduals = defaultdict(lambda: AveragedList(length=10))
+        self.pendingCorrection = None
+
+        # Constants the Seeker uses for this daemon
+        self.params = SeekerParams()
+
+        # Playlist version last found to match the master's (see
+        # Master.checkSlave)
+        self.checkedPlaylistVersion = None
+
+        # Filters out measurements made while the link was slow
+        self.rttFilter = RttFilter()
+
+        # Whether the Seeker should take a burst of measurements (see
+        # Master._burst)
+        self.burstPending = False
+
+    @property
+    def address(self):
+        return '%s:%s' % (self.host, self.port)
+
+    @property
+    def currentFile(self):
+        '''The current song's entry in the playlist, or None.'''
+
+        try:
+            return self.playlist[int(self.song)]
+        except (IndexError, KeyError, TypeError):
+            return None
+
+    def ping(self):
+        '''Pings the daemon and records how long it took.'''
+
+        self.pings.insert(0, timeFunction(super(Client, self).ping))
+
+    def checkConnection(self):
+        '''Pings the daemon and tries to reconnect if necessary.'''
+
+        # I don't know why this is necessary, but for some reason the
+        # slave connections tend to get dropped.
+        try:
+            self.ping()
+
+        except Exception as e:
+            self.log.debug('Connection to "%s" seems to be down.  '
+                           'Trying to reconnect...', self.host)
+
+            # Try to disconnect first
+            try:
+                self.disconnect()  # Maybe this will help it reconnect
+            except Exception as e:
+                self.log.exception("Couldn't DISconnect from client %s: %s",
+                                   self.host, e)
+
+            # Try to reconnect
+            try:
+                self.connect()
+            except Exception as e:
+                self.log.critical('Unable to reconnect to "%s"', self.host)
+
+                return False
+            else:
+                self.log.debug('Reconnected to "%s"', self.host)
+
+                metrics.inc('mpdsync_reconnects_total', host=self.address)
+
+                return True
+
+        else:
+            self.log.debug("Connection still up to %s", self.host)
+
+            return True
+
+    def connect(self):
+        '''Connects to the daemon, sets the password if necessary, and tests
+        the ping time.'''
+
+        # Reset initial values
+        self._initAttrs()
+
+        super(Client, self).connect(self.host, self.port)
+
+        if self.password:
+            super(Client, self).password(self.password)
+
+        self.testPing()
+
+        self.log.debug("Connected.")
+
+    def _initAttrs(self):
+        "Set the attributes in initAttrs to their initial values."
+
+        for val, attrs in self.initAttrs.items():
+            for attr in attrs:
+                setattr(self, attr, val)
+
+    def disconnect(self):
+        "Disconnect from MPD."
+
+        super(Client, self).disconnect()
+
+        self.log.debug("Disconnected.")
+
+    def getPlaylist(self):
+        '''Gets the playlist from the daemon.'''
+
+        self.playlist = super(Client, self).playlist()
+
+        self.log.debug("Got playlist")
+
+    def pause(self, state=None):
+        '''Pauses the daemon and tracks the playing state.  With STATE 0,
+        resumes it instead; without STATE, MPD toggles it, so the
+        daemon is expected to be playing.'''
+
+        if state is None:
+            super(Client, self).pause()
+        else:
+            super(Client, self).pause(state)
+
+        self.playing = state == 0
+        self.paused = not self.playing
+
+    def play(self, initial=False, song=None):
+        '''Plays the daemon, adjusting starting position as necessary.  SONG
+        is the position of the song to play when not INITIAL.'''
+
+        # FIXME: I was checking if (self.playedSinceLastPlaylistUpdate
+        # == False), but I removed that code.  I'm not sure if it's
+        # still necessary.
+
+        if initial:
+            # Slave is not already playing, or is playing a different song
+            self.log.debug("%s.play(initial=True)", self.host)
+
+            startLatency = self.startLatencies.estimate(self.currentFile) if self.currentFile else None
+
+            # Calculate adjustment
+            if self.latency is not None:
+                # Use user-set adjustment
+                offset = self.latency
+            elif startLatency is not None:
+                self.log.debug("Adjusting by start latency for %s files",
+                               self.startLatencies.key(self.currentFile))
+
+                offset = startLatency
+            elif self.initialPlayTimes.average:
+                self.log.debug("Adjusting by average initial play time")
+
+                offset = self.initialPlayTimes.average
+            else:
+                self.log.debug("Adjusting by average ping")
+
+                offset = self.pings.average
+
+            self.log.debug('Adjusting initial play by %s seconds', offset)
+
+            self.lastPlayOffset = offset if offset > 0 else 0
+
+            # Update status (not sure if this is still necessary, but
+            # it might help avoid race conditions or something)
+            self.status()
+
+            # Execute in command list
+            # TODO: Is a command list necessary or helpful here?
+            try:
+                self.command_list_ok_begin()
+            except mpd.CommandListError as e:
+                # Server was already in a command list; probably a
+                # lost client connection, so try again
+                self.log.exception("mpd.CommandListError: %s", e)
+
+                self.command_list_end()
+                self.command_list_ok_begin()
+
+            # Adjust starting position if necessary
+            # TODO: Is it necessary or good to make sure it's a
+            # positive adjustment?  There seem to be some tracks that
+            # require negative adjustments, but I don't know if that
+            # would be the case when playing from a stop
+            if offset > 0:
+                tries = 0
+
+                # Wait for the server to...catch up?  I don't remember
+                # exactly why this code is here, because it seems like
+                # the master shouldn't be behind the slaves, but I
+                # suppose it could happen on song changes
+                while self.elapsed is None and tries < 10:
+                    time.sleep(0.2)
+                    self.status()
+                    self.log.debug(self.song)
+                    tries += 1
+
+                # Seek to the adjusted playing position
+                self.seek(self.song, self.elapsed + offset)
+
+            # Issue the play command
+            super(Client, self).play()
+
+            # Execute command list
+            try:
+                result = self.command_list_end()
+            except mpd.ProtocolError:
+                self.log.exception("Unable to play client: %s.  Trying to resync...", self.host)
+
+                return False
+
+        else:
+            # Slave is already playing current song
+            self.log.debug("%s.play(initial=False)", self.host)
+
+            # Issue the play command
+            if song is not None:
+                result = super(Client, self).play(song)
+            else:
+                result = super(Client, self).play()
+
+        # TODO: Not sure if this is still necessary to track...
+        self.playedSinceLastPlaylistUpdate = True
+
+        return result
+
+    def seek(self, song, elapsed):
+        '''Seeks daemon to a position and updates local attributes for current
+        song and elapsed time.'''
+
+        self.song = song
+        self.elapsed = elapsed
+        super(Client, self).seek(self.song, self.elapsed)
+
+    def status(self):
+        '''Gets daemon's status and updates local attributes.'''
+
+        self.currentStatus = super(Client, self).status()
+
+        # Wrap whole thing in try/except because of MPD protocol
+        # errors.  But I may have fixed this by "locking" each client
+        # in the loop, so this may not be necessary anymore.
+        try:
+
+            # Not sure why, but sometimes this ends up as None when
+            # the track or playlist is changed...?
+            if self.currentStatus:
+                # Status response received
+
+                # Set playlist attrs
+                self.playlistLength = int(self.currentStatus['playlistlength'])
+                if self.playlist:
+                    if self.song:
+                        if int(self.song) >= len(self.playlist):
+                            self.log.exception(
+                                'Current song number > (playlist length - 1)'
+                                ' (%s>%s).  What is causing this pesky bug?',
+                                int(self.song), len(self.playlist))
+                        else:
+                            self.currentSongFiletype = (
+                                self.playlist[int(self.song)].split('.')[-1])
+                    else:
+                        self.currentSongFiletype = None
+
+                    self.log.debug('Current filetype: %s',
+                                   self.currentSongFiletype)
+
+                # Set True/False attrs
+                for attr in self.initAttrs[False]:
+                    val = (True
+                           if self.currentStatus[attr] == '1'
+                           else False)
+                    setattr(self, attr, val)
+
+                # Set playing state attrs
+                self.state = self.currentStatus['state']
+                self.playing = (True
+                                if self.state == 'play'
+                                else False)
+                self.paused = (True
+                               if self.state == 'pause'
+                               else False)
+
+                # Set song attrs
+                self.song = (self.currentStatus['song']
+                             if 'song' in self.currentStatus
+                             else None)
+                for attr in ['duration', 'elapsed']:
+                    val = (MyFloat(self.currentStatus[attr])
+                           if attr in self.currentStatus
+                           else None)
+                    setattr(self, attr, val)
+
+            else:
+                # None?  Sigh...  This shouldn't happen...if it does
+                # I'll need to reconnect, I think...
+                self.log.error("No status received for client %s", self.host)
+
+        except Exception as e:
+            # No status response :(
+            self.log.exception("Unable to get status for client %s: %s",
+                               self.host, e)
+
+            # Try to reconnect
+            self.checkConnection()
+
+        # TODO: Add other attributes, e.g. {'playlistlength': '55',
+        # 'playlist': '3868', 'repeat': '0', 'consume': '0',
+        # 'mixrampdb': '0.000000', 'random': '0', 'state': 'stop',
+        # 'volume': '-1', 'single': '0'}
+
+    def testPing(self):
+        '''Pings the daemon 5 times and sets the initial maxDifference.'''
+
+        for i in range(5):
+            self.ping()
+            time.sleep(0.1)
+
+        self.maxDifference = self.pings.average * 5
+
+        self.log.debug('Average ping for %s: %s seconds; '
+                       'setting maxDifference: %s',
+                       self.host, self.pings.average, self.maxDifference)
+
+
+class Master(Client):
+
+    # Where samples come from, in traces
+    traceSource = 'master'
+
+    # Options that are only for the master, with their defaults
+    masterOptions = {'adjustLatency': None,
+                     'pauseCorrection': False,
+                     'burst': False,
+                     'align': 'master',
+                     'recorder': None,
+                     'databaseIndex': False,
+                     'databaseCache': None,
+                     'profile': None,
+                     'memoryBudget': False,
+                     'historyLog': None,
+                     'upstream': None,
+                     'zone': None,
+                     'scheduler': None}
+
+    def __init__(self, *args, **kwargs):
+
+        # Don't pass master options to Client
+        for attr, default in self.masterOptions.items():
+            setattr(self, attr, kwargs.pop(attr, default))
+
+        super(Master, self).__init__(*args, **kwargs)
+
+        if self.profile is None:
+            self.profile = SeekerProfile()
+
+        self.slaves = []
+
+        # How far apart the slaves are
+        self.groupSkew = GroupSkew()
+
+        # Offset from the master that differences are aligned to for
+        # the current decision (see _updateAlignment)
+        self.alignment = 0
+
+        # Number of times each recovery path has been taken for all
+        # slaves
+        self.recoveries = defaultdict(int)
+
+        self.predictor = TransitionPredictor()
+        self.elapsedLoopRunning = False
+
+        self.seeker = None
+
+    @traced
+    def _average_difference(self, slave):
+        """Return absolute value of average difference between slave and
+        master, recording data in attributes as side-effect."""
+
+        # TODO: Some songs MPD seems unable to sync properly.  If the
+        # seek value is higher than a certain position, it will always
+        # seek to around the same value, meaning it basically can't
+        # seek past a certain point in the song.  This leads to
+        # endless syncs, and it means the slave seeks to the same
+        # place over and over again until the master moves on to the
+        # next song.  This causes the slave to sound like a broken
+        # record.  Perhaps charming in a nostalgic kind of way, but
+        # not exactly desirable...  So I guess I need to try to detect
+        # this somehow.  Sigh.
+
+        return self._record_sample(slave, self._measure(slave))
+
+    @traced
+    def _burst(self, slave, samples=BURST_SAMPLES, keep=BURST_KEEP):
+        '''Measure slave SAMPLES times back to back, and record the KEEP
+        measurements with the shortest round-trip times, so a decision
+        can be made right away instead of after several ticks.'''
+
+        slave.burstPending = False
+
+        measured = []
+        for num in range(samples):
+            sample = self._measure(slave)
+            rtt = sample['masterStatusLatency'] + sample['slaveStatusLatency']
+
+            measured.append((rtt, num, sample, self.song, self.elapsed,
+                             slave.song, slave.elapsed))
+
+        # Record the best ones in the order they were taken, with the
+        # statuses they were taken with.  The others' round-trip
+        # times still go into the RTT filter's window, or it would
+        # only see the fastest ones and reject ordinary measurements
+        # afterward
+        best = set(m[1] for m in sorted(measured, key=lambda m: m[0])[:keep])
+        for rtt, num, sample, masterSong, masterElapsed, song, elapsed in measured:
+            if num not in best:
+                slave.rttFilter.add(rtt)
+
+                continue
+
+            self.song, self.elapsed = masterSong, masterElapsed
+            slave.song, slave.elapsed = song, elapsed
+
+            self._record_sample(slave, sample, source='burst')
+
+        # Leave the latest statuses in place for whatever runs next
+        rtt, num, sample, self.song, self.elapsed, slave.song, slave.elapsed = measured[-1]
+
+    def _record_sample(self, slave, sample, source=None):
+        "Record SAMPLE of slave from SOURCE (default: traceSource), and return _add_sample()."
+
+        if self.upstream:
+            # How far behind the root master our master is, when this
+            # is a downstream relay (see RelayClient)
+            sample['upstreamOffset'] = self.upstream.offset
+
+        if self.recorder:
+            self.recorder.record('sample', source=source or self.traceSource, slave=slave.address,
+                                 masterSong=self.song, masterElapsed=self.elapsed,
+                                 masterPlaying=self.playing,
+                                 song=slave.song, file=slave.currentFile,
+                                 elapsed=slave.elapsed, **sample)
+
+        return self._add_sample(slave, sample)
+
+    def _measure(self, slave):
+        """Ping and get the status of master and slave, returning ping times
+        and status latencies in a dict."""
+
+        # Check pings
+        self.ping()
+        slave.ping()
+        masterPing = self.pings[0]
+        slavePing = slave.pings[0]
+        ping = abs(masterPing - slavePing)
+
+        self.log.debug("Last ping time for slave %s: %s", slave.host, ping)
+
+        # Get master status and time how long it takes
+        masterStatusLatency = MyFloat(timeFunction(self.status))
+
+        self.log.debug("masterStatusLatency:%s", masterStatusLatency)
+
+        # Get slave status and time how long it takes
+        slaveStatusLatency = MyFloat(timeFunction(slave.status))
+
+        self.log.debug("slaveStatusLatency:%s", slaveStatusLatency)
+
+        return {'masterPing': masterPing, 'slavePing': slavePing,
+                'masterStatusLatency': masterStatusLatency,
+                'slaveStatusLatency': slaveStatusLatency}
+
+    def _add_sample(self, slave, sample):
+        """Record the difference between slave and master according to their
+        statuses and SAMPLE, returning the absolute value of the average
+        difference."""
+
+        slaveStatusLatency = sample['slaveStatusLatency']
+        slave.lastDifference = None
+
+        # If song changed, reset differences
+        if slave.lastSong != slave.song:
+            self.log.debug("Song changed (%s -> %s); "
+                           "resetting %s.currentSongDifferences",
+                           slave.lastSong, slave.song, slave.host)
+
+            if slave.currentSongAdjustments is not None:
+                metrics.observe('mpdsync_song_reseeks', len(slave.currentSongAdjustments),
+                                slave=slave.address)
+
+            # TODO: Put this in a function?
+            slave.currentSongShouldSeek = True
+            # Its length counts the song's adjustments (see
+            # _calc_adjustment and _max_difference), so it's only
+            # capped by the memory budget, which is well above any
+            # maxAdjustments
+            slave.currentSongAdjustments = AveragedList(name='%s.currentSongAdjustments' % slave.host,
+                                                        length=slave.maxAdjustments, printDebug=True)
+            slave.currentSongDifferences = AveragedList(name='%s.currentSongDifferences' % slave.host,
+                                                        length=slave.maxDifferences)
+            slave.lastSong = slave.song
+            slave.burstPending = True
+
+            # Until it has measurements for this song
+            self.groupSkew.remove(slave.address)
+
+            # Record song differences and adjustments for later debugging
+            slave.song_adjustments.append({'file': slave.currentFile,
+                                           'adjustments': slave.currentSongAdjustments})
+            slave.song_differences.append({'file': slave.currentFile,
+                                           'differences': slave.currentSongDifferences})
+            self._forgetSongs(slave)
+
+        # Leave out measurements made while the link was slow, but
+        # keep the first one of each song, which starting to play it
+        # needs
+        rtt = sample['masterStatusLatency'] + slaveStatusLatency
+        if (slave.elapsed and len(slave.currentSongDifferences)
+            and not slave.rttFilter.accept(rtt)):
+            self.log.debug("Rejected measurement of %s with round-trip time %s (%s)",
+                           slave.host, rtt, slave.rttFilter)
+
+            metrics.inc('mpdsync_rejected_samples_total', slave=slave.address)
+
+            return abs(slave.currentSongDifferences.average)
+
+        if slave.elapsed:
+
+            # Seems like it would make sense to add the
+            # masterStatusLatency, but I seem to be observing that the
+            # opposite is the case...
+            difference = self.elapsed - (slave.elapsed + slaveStatusLatency)
+
+            # Make it relative to the root master, if any, so skew
+            # doesn't add up at each hop
+            difference += sample.get('upstreamOffset', 0)
+
+            self.groupSkew.update(slave.address, difference)
+
+            # Record the difference (always from the master; the
+            # Seeker aligns it, see _aligned())
+            slave.currentSongDifferences.insert(0, difference)
+            slave.lastDifference = difference
+            slave.skew.add(difference)
+            slave.fileTypeSkew[slave.currentSongFiletype].add(difference)
+
+            metrics.set('mpdsync_difference_seconds', difference, slave=slave.address)
+            metrics.set('mpdsync_average_difference_seconds',
+                        slave.currentSongDifferences.average, slave=slave.address)
+            metrics.set('mpdsync_rtt_seconds', slave.pings.average, host=slave.address)
+            metrics.set('mpdsync_rtt_seconds', self.pings.average, host=self.address)
+            metrics.observe('mpdsync_status_latency_seconds', slaveStatusLatency,
+                            host=slave.address)
+
+            # "Difference" is approximately aligned with the average
+            # below in the debug output
+            self.log.debug('Master/%s elapsed:%s/%s  Difference:%s',
+                           slave.host, self.elapsed, slave.elapsed, difference)
+            self.log.debug(slave.currentSongDifferences)
+            self.log.debug(slave.currentSongAdjustments)
+
+            return abs(slave.currentSongDifferences.average)
+
+    def _updateAlignment(self):
+        '''Fix what differences are aligned to (see _aligned()) for the
+        next decision: the master, or with --align median, the median of
+        the group's offsets (see GroupSkew), once there are two.  It's
+        only found once per decision, so all of a slave's differences
+        are shifted by the same amount while deciding.'''
+
+        self.alignment = 0
+
+        if self.align == 'median' and len(self.groupSkew.offsets) > 1:
+            # Keep the slaves together instead of with the master,
+            # e.g. when the master can't be heard
+            self.alignment = self.groupSkew.median() or 0
+
+    def _aligned(self, slave, difference):
+        '''Return DIFFERENCE of slave from the master relative to what it's
+        corrected towards (see _updateAlignment()).'''
+
+        return difference - self.alignment
+
+    def _forgetSongs(self, slave):
+        '''Remove the oldest songs' adjustments and differences from slave
+        beyond its maxSongs, writing them to the history log if there is
+        one.'''
+
+        if slave.maxSongs is None:
+            return
+
+        while len(slave.song_adjustments) > slave.maxSongs:
+            adjustments = slave.song_adjustments.pop(0)
+            differences = slave.song_differences.pop(0)
+
+            if self.historyLog:
+                self.historyLog.record('song', slave=slave.address, file=adjustments['file'],
+                                       adjustments=[round(a, 6) for a in adjustments['adjustments']],
+                                       differences=len(differences['differences']),
+                                       averageDifference=differences['differences'].overall_average,
+                                       minDifference=differences['differences'].min,
+                                       maxDifference=differences['differences'].max)
+
+    def status(self):
+        '''Gets the master's status and updates its playlistVersion
+        attribute.'''
+
+        super(Master, self).status()
+
+        # Use the master's reported playlist version (for the slaves
+        # we update it manually to match the master)
+        self.playlistVersion = self.currentStatus['playlist']
+
+    def addSlave(self, host, password=None):
+        '''Connects to a slave, gets its status, and adds it to the list of
+        slaves.  Returns the slave, or None if it couldn't be connected
+        to.'''
+
+        slave = Client(host, password=password, memoryBudget=self.memoryBudget,
+                       logger=self.log)
+
+        # Connect to slave
+        try:
+            slave.connect()
+        except Exception as e:
+            self.log.exception('Unable to connect to slave: %s:%s: %s',
+                               slave.host, slave.port, e)
+        else:
+            self.log.debug('Connected to slave: %s' % slave.host)
+
+            if self.databaseIndex or self.databaseCache:
+                slave.database = SlaveDatabase(slave, cacheDir=self.databaseCache)
+
+            slave.params = self.profile.paramsFor(slave.address)
+            self.log.debug('Seeker parameters for %s: %s', slave.address, slave.params)
+
+            self.slaves.append(slave)
+
+            # Get initial status (this is not automatic upon connection)
+            slave.status()
+
+            return slave
+
+    def removeSlave(self, slave):
+        "Stops syncing slave and disconnects from it."
+
+        self.slaves.remove(slave)
+        self.groupSkew.remove(slave.address)
+
+        try:
+            # Not in the middle of a Seeker tick
+            with slave.connectionLock:
+                slave.disconnect()
+        except Exception as e:
+            self.log.debug("Couldn't disconnect from slave %s: %s", slave.host, e)
+
+    @traced
+    def handleEvents(self, subsystems):
+        '''Syncs slaves according to the changed SUBSYSTEMS.'''
+
+        # The idle events come from another connection, so this one
+        # may have timed out while waiting
+        self.checkConnection()
+
+        # Sync the playlist before the players, since playing depends
+        # on it
+        for subsystem in ['database', 'playlist', 'options', 'player']:
+            if subsystem not in subsystems:
+                continue
+
+            self.log.debug("Subsystem update: %s", subsystem)
+
+            metrics.inc('mpdsync_idle_events_total', subsystem=subsystem)
+
+            if subsystem == 'database':
+                self.refreshDatabases()
+            elif subsystem == 'playlist':
+                self.syncPlaylists()
+            elif subsystem == 'options':
+                self.syncOptions()
+            elif subsystem == 'player':
+                self.syncPlayers()
+
+    @traced
+    def refreshDatabases(self):
+        '''Refreshes slaves' database indexes, e.g. after a database update.'''
+
+        for slave in self.slaves:
+            if slave.database:
+                try:
+                    with slave.connectionLock:
+                        slave.database.refresh()
+                except Exception as e:
+                    self.log.exception("Unable to refresh database index for slave %s: %s",
+                                       slave.host, e)
+
+    @traced
+    def syncAll(self):
+        '''Syncs all slaves completely.'''
+
+        self.syncPlaylists()
+        self.syncOptions()
+        self.syncPlayers()
+
+    @traced
+    def repairSlave(self, slave, reason):
+        '''Resyncs one slave's playlist and player status, without touching
+        the other slaves.  REASON is the recovery path that called it,
+        which is recorded in the recoveries counters.  Returns False if
+        it failed.'''
+
+        # Not in the middle of a Seeker tick
+        with slave.connectionLock:
+            return self._repairSlave(slave, reason)
+
+    def _repairSlave(self, slave, reason):
+
+        self.recoveries[reason] += 1
+        slave.recoveries[reason] += 1
+        metrics.inc('mpdsync_recoveries_total', slave=slave.address, reason=reason)
+
+        self.log.debug("Repairing slave %s (%s); recoveries: %s",
+                       slave.host, reason, dict(slave.recoveries))
+
+        # Get master info
+        self.status()
+        self.getPlaylist()
+
+        # Compare the whole playlist, which only clears it if it
+        # differs
+        slave.hasBeenSynced = False
+
+        if not self.syncPlaylist(slave):
+            self.log.error("Unable to repair playlist for slave %s", slave.host)
+
+            return False
+
+        # Don't call repairSlave() again if this fails
+        if not self.syncPlayer(slave):
+            self.log.error("Unable to repair player for slave %s", slave.host)
+
+            return False
+
+        return True
+
+    @traced
+    def checkSlave(self, slave, subsystems):
+        '''Checks slave after its own idle events in SUBSYSTEMS (see
+        Zones), and repairs it if its queue or player have diverged from
+        the master's, e.g. because someone changed it directly.  Events
+        caused by mpdsync's own commands are ignored.  Returns False if
+        the repair failed.'''
+
+        if slave.syncLoopLocked or time.time() - slave.lastChange < SLAVE_EVENT_GRACE:
+            self.log.debug("Ignoring events from slave %s after changing it: %s",
+                           slave.host, sorted(subsystems))
+
+            return True
+
+        for subsystem in subsystems:
+            metrics.inc('mpdsync_slave_events_total', slave=slave.address, subsystem=subsystem)
+
+        self.status()
+        slave.status()
+        if not slave.currentStatus:
+            return self.repairSlave(slave, 'slaveLost')
+
+        if 'playlist' in subsystems and slave.currentStatus['playlist'] != slave.checkedPlaylistVersion:
+            self.getPlaylist()
+            slave.getPlaylist()
+
+            if slave.playlist != self._slavePlaylist(slave):
+                self.log.info("Playlist on slave %s was changed; repairing it", slave.host)
+
+                return self.repairSlave(slave, 'slavePlaylist')
+
+            # Changed the same way as the master's (e.g. in consume
+            # mode), so don't compare it again until it changes
+            slave.checkedPlaylistVersion = slave.currentStatus['playlist']
+
+        # Its queue may leave out files the master has, and it's
+        # stopped when it doesn't have the master's song (see
+        # syncPlayer)
+        song = self.slaveSong(slave)
+        state = 'stop' if self.playing and song is None else self.state
+
+        if 'player' in subsystems and (slave.state != state
+                                       or (slave.playing and slave.song != song)):
+            self.log.info("Player on slave %s was changed (%s song %s, expected %s song %s); repairing it",
+                          slave.host, slave.state, slave.song, state, song)
+
+            return self.repairSlave(slave, 'slavePlayer')
+
+        return True
+
+    def _slavePlaylist(self, slave):
+        "Return the playlist that slave should have, in the format of getPlaylist()."
+
+        if not slave.database:
+            return self.playlist
+
+        return ['file: %s' % uri for uri in self._slaveUris(slave)]
+
+    def _slaveUris(self, slave):
+        '''Return the URIs of the master's playlist that slave should have,
+        leaving out files it doesn't have, and update slave.positions to
+        match.'''
+
+        # Remove "file: " from song filenames
+        uris = [FILE_PREFIX_RE.sub('', song) for song in self.playlist]
+
+        if not slave.database:
+            slave.positions = None
+
+            return uris
+
+        uris, slave.positions = slave.database.filter(uris)
+
+        return uris
+
+    def slaveSong(self, slave, song=None):
+        '''Return the position in slave's queue of the song at position
+        SONG (default: the current song) in the master's, in the format
+        of Client.song, or None if the slave doesn't have it.  They only
+        differ when files missing on the slave are left out.'''
+
+        if song is None:
+            song = self.song
+
+        if song is None or slave.positions is None:
+            return song
+
+        song = int(song)
+        if song >= len(slave.positions) or slave.positions[song] is None:
+            return None
+
+        return str(slave.positions[song])
+
+    @traced
+    def syncPlaylists(self):
+        '''Syncs all slaves' playlists.'''
+
+        # Get master info
+        self.status()
+        self.getPlaylist()
+
+        # Sync slaves
+        for slave in self.slaves:
+            self.syncPlaylist(slave)
+
+    @traced
+    def syncPlaylist(self, slave):
+        '''Syncs a slave's playlist.  The master's status and playlist must
+        be current.  Returns False if it failed.'''
+
+        start = time.time()
+        # Not in the middle of a Seeker tick
+        with slave.connectionLock:
+            result = self._syncPlaylist(slave)
+        metrics.observe('mpdsync_playlist_sync_seconds', time.time() - start,
+                        slave=slave.address)
+
+        return result
+
+    def _syncPlaylist(self, slave):
+
+        # Reconnect if necessary (slave connections tend to drop for
+        # some reason)
+        if not slave.checkConnection():
+            # If it can't reconnect...we can't sync the playlist,
+            # so do a full sync next time
+            self.log.error("Unable to reconnect to slave: %s", slave.host)
+
+            slave.hasBeenSynced = False
+
+            return False
+
+        if not slave.hasBeenSynced:
+            # Do a full sync the first time
+
+            # Leave out files the slave doesn't have, so they can't
+            # make the whole command list fail
+            uris = self._slaveUris(slave)
+
+            # Compare playlists; don't clear if they're the same
+            slave.getPlaylist()
+            if slave.playlist != ['file: %s' % uri for uri in uris]:
+                # Playlists differ
+                self.log.debug("Playlist differs on slave %s; syncing...",
+                               slave.host)
+
+                #Start command list
+                slave.command_list_ok_begin()
+
+                # Clear playlist
+                slave.clear()
+
+                # Add tracks
+                for uri in uris:
+                    slave.add(uri)
+
+                # Execute command list
+                result = slave.command_list_end()
+
+                if not result:
+                    self.log.critical("Couldn't add tracks to playlist on slave: %s",
+                                      slave.host)
+                    return False
+                else:
+                    self.log.debug("Added to playlist on slave %s, result: %s",
+                                   slave.host, result)
+
+                    # It's what the slave has now; otherwise
+                    # syncPlayer would take the still-empty playlist
+                    # fetched above for a lost one
+                    slave.playlist = ['file: %s' % uri for uri in uris]
+
+                    slave.hasBeenSynced = True
+
+            else:
+                # Playlists are the same
+                self.log.debug("Playlist is the same on slave %s", slave.host)
+
+                slave.hasBeenSynced = True
+
+        else:
+            # Slave has been synced before; sync playlist changes
+
+            # TODO: if slave.playlistVersion is None, handle it
+
+            # Get list of changes
+            changes = self.plchanges(slave.playlistVersion)
+
+            # The length the slave's playlist should have
+            uris = self._slaveUris(slave)
+            playlistLength = len(uris)
+
+            # Leave out files the slave doesn't have, and move the
+            # rest to their positions in its playlist
+            if slave.positions is not None:
+                for change in changes:
+                    pos = self.slaveSong(slave, change['pos'])
+                    change['file'] = None if pos is None else uris[int(pos)]
+                    change['pos'] = pos
+                changes = [change for change in changes
+                           if change['file'] is not None]
+
+            # Start command list
+            slave.command_list_ok_begin()
+
+            # Make changes
+            for change in changes:
+                self.log.debug('Adding to slave:"%s" file:"%s" at pos:%s',
+                               slave.host, change['file'], change['pos'])
+
+                slave.addid(change['file'], change['pos'])
+
+            # Execute command list
+            try:
+                results = slave.command_list_end()
+            except mpd.ProtocolError as e:
+                if e.message == "Got unexpected 'OK'":
+                    self.log.exception("mpd.ProtocolError: Got unexpected 'OK'")
+
+                    return False  # Maybe it will work next time around...
+
+            # Check results
+            if not results:
+                # This should not happen.  SIGH.
+                self.log.error("SIGH.")
+
+                return False
+
+            # Add tags for remote tracks (e.g. files streaming
+            # over HTTP) that have tags in playlist
+            slave.command_list_ok_begin()
+            for num, change in enumerate(changes):
+                if 'http' in change['file']:
+                    for tag in ['artist', 'album', 'title', 'genre']:
+                        if tag in change:
+
+                            # results is a list of song IDs that
+                            # were added; it corresponds to
+                            # changes
+                            slave.addtagid(int(results[num]), tag, change[tag])
+            try:
+                slave.command_list_end()
+            except mpd.ProtocolError as e:
+                if e.message == "Got unexpected 'OK'":
+                    self.log.exception("mpd.ProtocolError: Got unexpected 'OK'")
+
+            # Update slave status
+            slave.status()
+
+            # Truncate the slave playlist to the same length as the master
+            if playlistLength == 0:
+                slave.clear()
+            elif playlistLength < slave.playlistLength:
+                self.log.debug("Deleting from %s to %s",
+                               playlistLength - 1, slave.playlistLength - 1)
+
+                slave.delete((playlistLength - 1, slave.playlistLength - 1))
+
+            # Check result
+            slave.status()
+            if slave.playlistLength != playlistLength:
+                self.log.error("Playlist lengths don't match for slave %s: %s / %s",
+                               slave.host, slave.playlistLength, playlistLength)
+            else:
+                # It's what the slave should have now, and its current
+                # filetype depends on it
+                slave.playlist = ['file: %s' % uri for uri in uris]
+
+            # Make sure the slave's playing status still matches the
+            # master (for some reason, deleting a track lower-numbered
+            # than the currently playing track makes the slaves stop
+            # playing)
+            if slave.state != self.state:
+                # Resync the slave
+                self.syncPlayer(slave)
+
+        # Update slave playlist version number to match the master's
+        slave.playlistVersion = self.playlistVersion
+
+        # Not sure if this is still necessary
+        self.playedSinceLastPlaylistUpdate = False
+
+        return True
+
+
+    @traced
+    def syncOptions(self):
+        '''TBI: Sync player options (e.g. random).'''
+        pass
+
+    @traced
+    def syncPlayers(self):
+        '''Syncs all slaves' player status.'''
+
+        # Update master info
+        self.status()
+
+        # If the master just went on to the next song by itself, the
+        # slaves that were playing along with it should have too, so
+        # don't send them any commands.  If one didn't, the Seeker
+        # will notice.
+        if self.predictor.isNatural(self):
+            self.log.debug("Natural track change to song %s", self.song)
+
+            previousSong = self.predictor.song
+        else:
+            previousSong = None
+
+        self.predictor.update(self)
+
+        # Slaves started or found unreachable below, which syncPlayer()
+        # shouldn't try again
+        starting = []
+        failed = []
+
+        if self.playing and self.currentFile and isRemote(self.currentFile):
+            # Start the slaves that aren't playing the stream yet
+            # together, before syncPlayer() would start them one by one
+            for slave in self.slaves:
+                try:
+                    with slave.connectionLock:
+                        slave.status()
+                except Exception as e:
+                    self.log.error("Unable to get status of slave %s: %s", slave.host, e)
+
+                    failed.append(slave)
+                    continue
+
+                if not (slave.playing and slave.song == self.slaveSong(slave)):
+                    starting.append(slave)
+
+            if starting:
+                failed.extend(self._startStreams(starting))
+
+        # SOMEDAY: do this in parallel?
+        for slave in self.slaves:
+            if slave in failed:
+                self.log.debug("Unable to start stream on slave: %s.  Trying to repair it...", slave.host)
+
+                self.repairSlave(slave, 'player')
+
+                continue
+
+            if slave in starting:
+                continue
+
+            if previousSong is not None and self._followedTransition(slave, previousSong):
+                self.log.debug("Slave %s should have followed track change; not syncing it",
+                               slave.host)
+
+                continue
+
+            if not self.syncPlayer(slave):
+                self.log.debug("Unable to sync slave: %s.  Trying to repair it...", slave.host)
+
+                self.repairSlave(slave, 'player')
+
+        # Restart sync thread if necessary
+        if self.adjustLatency:
+            if self.playing:
+                self.checkSeeker()
+            else:
+                if not self.paused:
+                    # Stopped
+                    self.stopSeeker()
+
+    def _followedTransition(self, slave, previousSong):
+        '''Return True if SLAVE was playing PREVIOUSSONG in sync with the
+        master, according to what we already know about it.'''
+
+        if not (slave.playing and slave.song == self.slaveSong(slave, previousSong)):
+            return False
+
+        self._updateAlignment()
+
+        # Without measurements (i.e. no Seeker), trust the slave
+        if (len(slave.currentSongDifferences)
+            and abs(self._aligned(slave, slave.currentSongDifferences.average)) > self.predictor.tolerance):
+            return False
+
+        return True
+
+    @traced
+    def _startStreams(self, slaves):
+        '''Starts SLAVES playing the master's current song, a remote stream,
+        so that they start making sound at the same time: since streams
+        can't be seeked, each slave is started earlier by how long it
+        takes to buffer (see StartLatencies), slowest first.  How long
+        each one actually took is measured afterward by a StreamProbe,
+        outside the event loop.  Returns the slaves that couldn't be
+        told to play; slaves that are just slow to start are left
+        playing.'''
+
+        uri = self.currentFile
+        delays = dict((slave, slave.startLatencies.estimate(uri) or STREAM_BUFFERING)
+                      for slave in slaves)
+        latest = max(delays.values())
+
+        self.log.debug("Starting stream %s on slaves: %s", uri,
+                       ', '.join('%s (%s)' % (slave.host, delay) for slave, delay in delays.items()))
+
+        # Slave: time it was told to play
+        played = {}
+        failed = []
+
+        start = time.time()
+        for slave in sorted(slaves, key=lambda slave: delays[slave], reverse=True):
+            wait = start + latest - delays[slave] - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                # Not in the middle of a Seeker tick
+                with slave.connectionLock:
+                    slave.play(song=self.slaveSong(slave))
+            except Exception as e:
+                self.log.error("Unable to play stream on slave %s: %s", slave.host, e)
+
+                failed.append(slave)
+            else:
+                played[slave] = time.time()
+
+        if played:
+            StreamProbe(self, uri, played, delays).start()
+
+        return failed
+
+    @traced
+    def syncPlayer(self, slave):
+        '''Sync's a slave's player status.'''
+
+        # Not in the middle of a Seeker tick
+        with slave.connectionLock:
+            return self._syncPlayer(slave)
+
+    def _syncPlayer(self, slave):
+
+        # Try 5 times
+        tries = 0
+        while tries < 5:
+
+            try:
+                # Update master info
+                self.status()
+
+                # Reconnect if connection dropped
+                slave.checkConnection()
+
+                # Update slave status
+                slave.status()
+
+                # Sync player status
+                if self.playing:
+
+                    # Verify playlist is set.  Sometimes this can get emptied somehow, when connections drop...
+                    if not slave.playlist:
+                        self.recoveries['emptyPlaylist'] += 1
+                        slave.recoveries['emptyPlaylist'] += 1
+
+                        self.getPlaylist()
+                        slave.hasBeenSynced = False
+                        self.syncPlaylist(slave)
+
+                    if self.slaveSong(slave) is None:
+                        # It can't play what the master is playing
+                        self.log.warning("Slave %s doesn't have song %s (%s); stopping it",
+                                         slave.host, self.song, self.currentFile)
+
+                        slave.stop()
+
+                    elif self.currentFile and isRemote(self.currentFile):
+                        # Streams can't be seeked, and their positions
+                        # can't be compared
+                        if (not (slave.playing and slave.song == self.slaveSong(slave))
+                            and self._startStreams([slave])):
+                            return False
+
+                    # Don't re-sync if the slave is already playing
+                    # the same song at the right place
+                    elif (slave.playing
+                          and slave.song == self.slaveSong(slave)
+                          and self._average_difference(slave) < 1):
+
+                        self.log.debug('Slave %s and master already playing same song, less than 1 second apart',
+                                       slave.host)
+
+                    else:
+                        # Slave not playing, or playing a different song
+                        self.log.debug('Playing slave %s, initial=True' % slave.host)
+
+                        # Seek to current master position before playing
+                        try:
+                            slave.seek(self.slaveSong(slave), self.elapsed)
+                        except Exception as e:
+                            self.log.exception("Couldn't seek slave %s: %s", slave.host, e)
+
+                            return False
+
+                        # Play it
+                        if not slave.play(initial=True):
+                            self.log.critical("Couldn't play slave: %s", slave.host)
+
+                            return False
+
+                        # Wait a moment and then check the difference
+                        time.sleep(0.2)
+                        playLatency = self._average_difference(slave)
+
+                        if not playLatency:
+                            # This probably means the slave isn't playing at all for some reason
+                            self.log.error('No playLatency for slave "%s"', slave.host)
+
+                            slave.stop()  # Maybe...?
+
+                            return False
+
+                        self.log.debug('Client %s took %s seconds to start playing',
+                                       slave.host, playLatency)
+
+                        # Update initial play times
+                        slave.initialPlayTimes.insert(0, playLatency)
+
+                        # The slave took as long to start as it was
+                        # seeked ahead for, plus however far behind it
+                        # still is, if this measurement was recorded
+                        # (otherwise the last one is from before it
+                        # played)
+                        if slave.lastDifference is None:
+                            startLatency = None
+
+                            self.log.debug("No measurement of %s after playing; not updating its start latency",
+                                           slave.host)
+                        else:
+                            startLatency = slave.lastPlayOffset + slave.lastDifference
+
+                        if startLatency is not None and slave.currentFile:
+                            slave.startLatencies.update(slave.currentFile, startLatency)
+
+                            fileType, remote = slave.startLatencies.key(slave.currentFile)
+                            metrics.observe('mpdsync_start_latency_seconds', startLatency,
+                                            slave=slave.address, filetype=fileType,
+                                            remote=str(remote).lower())
+
+                        if self.recorder:
+                            self.recorder.record('initialPlay', slave=slave.address,
+                                                 file=slave.currentFile, latency=playLatency,
+                                                 offset=slave.lastPlayOffset,
+                                                 startLatency=startLatency)
+
+                elif self.paused:
+                    slave.pause()
+                else:
+                    slave.stop()
+
+            except Exception as e:
+                self.log.exception("Unable to syncPlayer for slave %s.  Tries:%s  Error:%s",
+                                   slave.host, tries, e)
+                tries += 1
+
+                return False
+            else:
+                # Sync succeeded
+                return True
+
+    def logSkew(self, level=logging.INFO):
+        "Log skew percentiles of each slave, overall and by file type, and of the group."
+
+        if len(self.slaves) > 1:
+            self.log.log(level, "Group skew: %s", self.groupSkew)
+
+        for slave in self.slaves:
+            self.log.log(level, "Skew for %s: %s", slave.address, slave.skew)
+            self.log.log(level, "Measurements of %s: %s", slave.address, slave.rttFilter)
+
+            for fileType, sketch in sorted(slave.fileTypeSkew.items(), key=lambda i: str(i[0])):
+                self.log.log(level, "Skew for %s %s files: %s", slave.address, fileType, sketch)
+
+    # Name, type and help of the metrics from skewMetrics()
+    skewMetricFamilies = [
+        ('mpdsync_skew_seconds', 'summary', 'Absolute difference from the master'),
+        ('mpdsync_filetype_skew_seconds', 'summary', 'Absolute difference from the master, by file type'),
+        ('mpdsync_group_offset_seconds', 'gauge', "Smallest and largest of the slaves' differences "
+                                                  "from the master"),
+        ('mpdsync_group_spread_seconds', 'summary', "Difference between the slaves furthest apart")]
+
+    def skewMetrics(self):
+        '''Return dict of lines of skew percentiles for the metrics, by
+        family name (see skewMetricFamilies and Zones.skewMetrics).'''
+
+        zone = (('zone', self.zone),) if self.zone else ()
+
+        families = defaultdict(list)
+        for slave in self.slaves:
+            families['mpdsync_skew_seconds'].append(((('slave', slave.address),), slave.skew))
+            families['mpdsync_filetype_skew_seconds'].extend(
+                ((('slave', slave.address), ('filetype', fileType)), sketch)
+                for fileType, sketch in slave.fileTypeSkew.items())
+        if len(self.slaves) > 1:
+            families['mpdsync_group_spread_seconds'].append((zone, self.groupSkew.spread))
+
+        lines = defaultdict(list)
+        for name, sketches in families.items():
+            for labels, sketch in sketches:
+                summary = sketch.summary()
+                for percentile in SKEW_PERCENTILES:
+                    if summary['p%s' % percentile] is not None:
+                        lines[name].append('%s%s %s' % (name, formatLabels(labels + (('quantile', percentile / 100.0),)),
+                                                        summary['p%s' % percentile]))
+                lines[name].append('%s_count%s %s' % (name, formatLabels(labels), summary['count']))
+
+        groupSkew = self.groupSkew
+        if groupSkew.offsets:
+            for bound, (offset, address) in [('min', groupSkew.min), ('max', groupSkew.max)]:
+                lines['mpdsync_group_offset_seconds'].append('mpdsync_group_offset_seconds%s %s' % (
+                    formatLabels(zone + (('bound', bound), ('slave', address))), round(offset, 6)))
+
+        return lines
+
+    def startSeeker(self):
+        '''Runs a loop trying to keep the slaves in sync with the master.'''
+
+        # Make new connection to master server that won't idle()
+        self.seeker = Seeker(self)
+        self.seeker.connect()
+        self.seeker.start_loop()
+
+    def checkSeeker(self):
+        "Restart seeker thread if necessary."
+
+        if self.seeker:
+            self.seeker.check_loop()
+        else:
+            self.startSeeker()
+
+    def stopSeeker(self):
+        "Stop sync loop thread, disconnect seeker connection, and cleanup Seeker instance."
+
+        if self.seeker:
+            # Stop thread
+            self.seeker.sync = False
+            if self.seeker.thread is None:
+                self.scheduler.remove(self.seeker)
+            while self.seeker.thread and self.seeker.thread.is_alive():
+                self.log.debug("Waiting for seeker thread to stop...")
+                time.sleep(0.1)
+
+            self.log.debug("Seeker thread stopped.")
+
+            # Disconnect and cleanup object
+            self.seeker.disconnect()
+            self.seeker = None
+
+
+class Seeker(Master):
+    '''Used to make a second connection to the master server that doesn't
+    idle, which can be used to re-seek slaves' playing positions.'''
+
+    # TODO: It would seem like a good idea to avoid doing some things
+    # in this instance, like syncing the playlist, since that's not
+    # relevant to the seeker and takes some time.
+
+    traceSource = 'seeker'
+
+    def __init__(self, master):
+        super(Seeker, self).__init__(master.host, port=master.port,
+                                     password=master.password, logger=master.log)
+
+        # By doing this, we don't have to run status() in the loop,
+        # because it can get the master's playing status from the
+        # other instance
+        self.master = master
+        self.slaves = master.slaves
+        self.recoveries = master.recoveries
+        self.recorder = master.recorder
+        self.historyLog = master.historyLog
+        self.upstream = master.upstream
+        self.zone = master.zone
+
+        # Ways to correct slaves' positions, in order of preference
+        # (see _choose_actuator)
+        self.actuators = [SeekActuator()]
+        if master.pauseCorrection:
+            self.actuators.insert(0, PauseActuator())
+        self.burst = master.burst
+        self.align = master.align
+        self.groupSkew = master.groupSkew
+        self.sync = False
+
+    def status(self):
+        '''Gets the master's status, and its playlist when that changed, so
+        decisions use this connection's own view of the current song
+        instead of the main thread's.'''
+
+        version = self.playlistVersion
+
+        super(Seeker, self).status()
+
+        if self.playlist is None or self.playlistVersion != version:
+            self.getPlaylist()
+
+    def start_loop(self):
+        "Start sync thread (_syncLoop)."
+
+        self.sync = True
+
+        # Remove any stale locks
+        for slave in self.slaves:
+            slave.syncLoopLocked = False
+
+        if self.master.scheduler:
+            # Tick in the scheduler's thread instead of our own
+            self.thread = None
+            self.master.scheduler.add(self)
+
+            return
+
+        self.thread = Thread(target=self._syncLoop, name='Seeker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_loop(self):
+        "Restart _syncLoop if necessary."
+
+        if self.thread is None:
+            self.master.scheduler.check()
+
+        elif self.sync and not self.thread.is_alive():
+            self.log.warning("Sync thread died; restarting...")
+
+            self.checkConnection()
+            self.start_loop()
+
+    def _syncLoop(self):
+        "Run loop keeping slaves' position in sync."
+
+        # Run the loop
+        while self.sync:
+
+            # NOTE: This works, but the thread won't stop while it's
+            # sleeping, so it can take several seconds in the worst
+            # case for the thread to notice that it should stop.  This
+            # doesn't seem like a problem most of the time, unless the
+            # user stops MPD and then starts it playing again before
+            # this thread has terminated, in which case the slaves
+            # won't start playing again until the thread terminates
+            # and the script catches up with the subsystem updates.
+            # I'm not sure how to fix this short of switching to a
+            # subprocess, because killing threads is not supported,
+            # and any workarounds are necessarily ugly hacks which
+            # might have bad side effects.
+
+            start = time.time()
+            sleepTime = self.tick()
+            metrics.observe('mpdsync_seeker_tick_seconds', time.time() - start)
+
+            self.log.debug('Sleeping for %s seconds', sleepTime)
+
+            time.sleep(sleepTime)
+
+    @traced
+    def tick(self):
+        "Check and correct each slave once.  Return seconds to sleep until the next tick."
+
+        sleepTime = None
+
+        if self.master.playing:
+
+            # Check each slave's average difference (slaves may be
+            # moved or removed meanwhile; see Zones)
+            for slave in list(self.slaves):
+
+                # Don't run the loop if an earlier one is already
+                # waiting for a result (this might be helping to
+                # cause the MPD protocol errors)
+                if slave.syncLoopLocked:
+                    self.log.debug("syncLoopLocked for slave %s", slave.host)
+
+                    continue
+                elif slave.resumePending:
+                    # Still paused for a correction (see PauseActuator)
+                    self.log.debug("Waiting for slave %s to be resumed", slave.host)
+
+                    continue
+                else:
+                    # Lock the slave
+                    slave.syncLoopLocked = True
+
+                # TODO: If finished seeking, stop the loop until
+                # the next track (and restart it on track change)
+
+                with slave.connectionLock:
+                    if self.burst and slave.burstPending:
+                        self._burst(slave)
+
+                    necessary = self._reseek_necessary(slave)
+
+                    if self.recorder:
+                        self.recorder.record('decision', slave=slave.address, reseek=necessary,
+                                             measurements=len(slave.currentSongDifferences),
+                                             average=slave.currentSongDifferences.average)
+
+                    if necessary:
+                        self._reseek_slave(slave)
+                        sleepTime = 2  # Sleep 2 seconds after reseeking
+
+                # Unlock the slave
+                slave.syncLoopLocked = False
+
+            # Sleep for 400ms for each measurement, but at least 2 s
+
+            # BUG: If there are multiple slaves, this sleeps for
+            # whatever sleepTime was set to for the last slave.  Not a
+            # big deal, but might need fixing.
+            if not sleepTime and self.slaves:
+                sleepTime = max(2, 0.4 * len(slave.currentSongDifferences))
+            elif not sleepTime:
+                # No slaves (e.g. all moved to another zone)
+                sleepTime = 2
+
+            # Come back for a burst as soon as a new song or a
+            # correction has settled
+            if self.burst and any(slave.burstPending for slave in self.slaves):
+                sleepTime = min(sleepTime, BURST_SETTLE)
+
+            # Print how far apart the slaves are
+            if len(self.slaves) > 1:
+                self.log.debug("Group skew: %s", self.groupSkew)
+
+        else:
+            # Not playing; sleep 2 seconds
+            sleepTime = 2
+
+            # TODO: Instead, stop this thread, and restart it when playing resumes
+
+        return sleepTime
+
+    @traced
+    def _reseek_slave(self, slave):
+        "Correct slave position to match master's."
+
+        actuator = self._choose_actuator(slave)
+
+        # For some reason this is getting weird errors like
+        # "mpd.ProtocolError: Got unexpected return value: 'volume:
+        # 0'", and I don't want the script to quit, so wrapping it in
+        # a try/except should help it try again
+        try:
+            adjustBy = actuator.correct(self, slave)
+
+        except Exception as e:
+            # Correction failed
+            self.log.exception("Unable to %s slave %s: %s", actuator.name, slave.host, e)
+
+            if self.recorder:
+                self.recorder.record('correction', slave=slave.address, actuator=actuator.name,
+                                     ok=False)
+
+            # Try to completely resync the slave
+            self.repairSlave(slave, actuator.name)
+
+            # Clear song adjustments to prevent wild jittering after
+            # seek timeouts
+            slave.currentSongAdjustments.clear()
+            slave.checkConnection()
+
+            return False
+
+        else:
+            if adjustBy is None:
+                return False
+
+            if self.recorder:
+                self.recorder.record('correction', slave=slave.address, actuator=actuator.name,
+                                     ok=True, adjustBy=adjustBy)
+
+            self._corrected(slave, actuator, adjustBy)
+
+            return True
+
+    def _corrected(self, slave, actuator, adjustBy):
+        "Update slave's stats after a successful correction."
+
+        slave.currentSongAdjustments.append(adjustBy)
+        slave.corrections[actuator.name] += 1
+        metrics.inc('mpdsync_reseeks_total', slave=slave.address, actuator=actuator.name)
+
+        # Measure how well it worked once there are enough new
+        # measurements (see _reseek_necessary)
+        slave.pendingCorrection = actuator.name
+        slave.burstPending = True
+
+        # Reset song differences
+        slave.currentSongDifferences.clear()
+        self.groupSkew.remove(slave.address)
+
+    def _choose_actuator(self, slave):
+        '''Return the actuator to correct slave with.  When more than one
+        can be used, the one that has left the smallest differences on
+        this slave is chosen, after trying each a few times.'''
+
+        usable = [actuator for actuator in self.actuators
+                  if actuator.usable(self, slave)]
+
+        if len(usable) == 1:
+            return usable[0]
+
+        residuals = slave.correctionResiduals
+
+        # Try each one at least 3 times first
+        untried = [actuator for actuator in usable
+                   if len(residuals[actuator.name]) < 3]
+        if untried:
+            return min(untried, key=lambda a: len(residuals[a.name]))
+
+        actuator = min(usable, key=lambda a: residuals[a.name].average)
+
+        self.log.debug("Chose %s for %s; residuals: %s", actuator.name, slave.host,
+                       dict((a.name, residuals[a.name].average) for a in usable))
+
+        return actuator
+
+    def _calc_adjustment(self, slave):
+        "Return adjustment to make to sync slave with master."
+
+        # Choose adjustment
+        if slave.latency is not None:
+            # Use the user-set adjustment
+            self.log.debug("Adjusting %s by slave.latency: %s", slave.host, slave.latency)
+
+            adjustBy = MyFloat(slave.latency)
+
+        else:
+            # Calculate adjustment automatically
+
+            if len(slave.currentSongAdjustments) < 1:
+                # First adjustment for song
+                self.log.debug("First adjustment for song...")
+
+                if len(slave.adjustments) > 5:
+                    # More than 5 total adjustments made to this
+                    # slave.  Adjust by average adjustment, slightly
+                    # reduced to avoid swinging back and forth (like
+                    # a difference, since it's inverted below)
+                    adjustBy = self._aligned(slave, slave.adjustments.average * 0.75)
+
+                    self.log.debug("Adjusting %s by average slave adjustment: %s", slave.host, adjustBy)
+                else:
+                    # 5 or fewer total adjustments made to this slave.
+                    # Adjust by average ping
+                    adjustBy = self._pingAdjustment(slave)
+
+                    self.log.debug("Adjusting %s by average ping: %s", slave.host, adjustBy)
+            else:
+                # Not the first adjustment for song
+
+                if len(slave.currentSongAdjustments) > slave.params.maxAdjustments:
+                    # Too many adjustments; alternate between ping and average difference
+                    self.log.debug("Too many adjustments (%s > %s)", len(slave.currentSongAdjustments),
+                                   slave.params.maxAdjustments)
+
+                    if not even(len(slave.currentSongAdjustments)):
+                        # Adjust by ping
+                        self.log.debug("Adjusting by ping...")
+
+                        adjustBy = self._pingAdjustment(slave)
+                    else:
+                        # Try adjusting by difference again
+                        self.log.debug("Trying to adjust by difference...")
+
+                        adjustBy = self._aligned(slave, slave.currentSongDifferences.average)
+
+                else:
+                    # Adjust by average difference
+                    adjustBy = self._aligned(slave, slave.currentSongDifferences.average)
+
+                    self.log.debug("Adjusting %s by average difference: %s",
+                                   slave.host, adjustBy)
+
+            # TODO: If the difference is too great, it seems that the
+            # slave MPD has hit a bug where it thinks that song
+            # duration is shorter than it is and won't seek past that
+            # point.  Stopping the slave playback and re-playing the
+            # track seems to fix it.
+
+            absAdjustBy = abs(adjustBy)
+            if absAdjustBy > slave.params.maxAdjustment:
+                # Adjustment too large; use ping
+                self.log.debug("Adjustment too large (%s > %s); adjusting by ping", absAdjustBy,
+                               slave.params.maxAdjustment)
+
+                adjustBy = self._pingAdjustment(slave)
+
+            if adjustBy == self._pingAdjustment(slave):
+                # Adjusting by ping, clear differences
+                self.log.debug("Clearing differences")
+
+                slave.currentSongDifferences.clear()
+            else:
+                # Invert final difference-based adjustment
+                adjustBy = adjustBy * -1
+
+        return adjustBy
+
+    def _pingAdjustment(self, slave):
+        '''Return an adjustment of slave by its average ping, towards what
+        it's aligned with (unlike differences, adjustments aren't
+        inverted, so the alignment is added).'''
+
+        return slave.pings.average + self.alignment
+
+    def _reseek_necessary(self, slave):
+        "Return True if reseek is necessary."
+
+        # Update master info
+        self.status()
+
+        # Reconnect if connection dropped
+        slave.checkConnection()
+
+        if not slave.currentSongShouldSeek:
+            self.log.debug('Not seeking this song anymore')
+
+            return False
+
+        if self.currentFile and isRemote(self.currentFile):
+            # Streams are started together instead (see
+            # Master._startStreams)
+            self.log.debug('Playing a remote stream; not measuring or seeking')
+
+            return False
+
+        if self.playing and self.slaveSong(slave) is None:
+            # Master.syncPlayer() stopped it, since it doesn't have the
+            # current song
+            self.log.debug("Slave %s doesn't have song %s; not measuring or seeking",
+                           slave.host, self.song)
+
+            return False
+
+        # Measure, and get the absolute value of the average
+        # difference from what it's aligned with
+        self._average_difference(slave)
+        self._updateAlignment()
+        average_difference = abs(self._aligned(slave, slave.currentSongDifferences.average))
+
+        if (self.playing and slave.song != self.slaveSong(slave)
+            and not self._changingTracks(slave)):
+            # Slave didn't follow a track change (see
+            # Master.syncPlayers); seeking within the song won't help
+            self.log.debug("Slave %s is playing song %s instead of %s; resyncing it",
+                           slave.host, slave.song, self.slaveSong(slave))
+
+            self.recoveries['missedTransition'] += 1
+            slave.recoveries['missedTransition'] += 1
+
+            self.syncPlayer(slave)
+
+            return False
+
+        max_difference = self._max_difference(slave)
+
+        if len(slave.currentSongDifferences) < 3:
+            self.log.debug("Less than 3 measurements; not seeking")
+
+            return False
+
+        if slave.pendingCorrection:
+            # Record how far off the last correction left the slave
+            slave.correctionResiduals[slave.pendingCorrection].insert(0, average_difference)
+            slave.pendingCorrection = None
+
+        # Commenting out for now.  Not sure if it's really necessary now that we have backing-off.
+        # if (len(slave.currentSongDifferences) >= 5 and average_difference < MIN_DIFFERENCE):
+        #     self.log.debug("Average difference %s < %s; not seeking this song anymore", average_difference, MIN_DIFFERENCE)
+
+        #     slave.currentSongShouldSeek = False
+
+        #     return False
+
+        if (average_difference > max_difference
+            and abs(self._aligned(slave, slave.currentSongDifferences[0])) > max_difference):
+            # Average and current difference too large; reseek
+            self.log.debug("Average difference (%s) > max difference (%s); reseeking..." % (average_difference, max_difference))
+
+            return True
+        else:
+            self.log.debug("Average difference within acceptable range; not reseeking")
+
+            return False
+
+    def _changingTracks(self, slave):
+        "Return True if master or slave is about to change or just changed tracks."
+
+        if self.elapsed is not None and self.elapsed < TRANSITION_TOLERANCE:
+            return True
+
+        if (slave.duration and slave.elapsed is not None
+            and slave.duration - slave.elapsed < TRANSITION_TOLERANCE):
+            return True
+
+        return False
+
+    def _max_difference(self, slave):
+        "Return max difference between slave and master."
+
+        params = slave.params
+
+        if len(slave.currentSongDifferences) >= 5:
+            # At least 5 measurements for current song
+
+            if len(slave.currentSongDifferences) >= 10:
+                # 10 or more measurements; use 1/4 of the range
+                maxDifference = slave.currentSongDifferences.range / 4
+
+                # Add half the average to prevent it from being too
+                # small and causing excessive reseeks.  For some songs
+                # the range can be very small, like 38ms, but for
+                # others it can be consistently 100-200 ms.
+                maxDifference += (abs(self._aligned(slave, slave.currentSongDifferences.average)) / 2)
+            else:
+                # 5-9 measurements; use 1/2 of the range
+                maxDifference = slave.currentSongDifferences.range / 2
+
+            # Use at least half of the biggest difference to prevent
+            # the occasional small range from causing unnecessary
+            # syncs.  This may not be necessary with adding half the
+            # average a few lines up, but it may be a good extra
+            # precaution.
+
+            # Use the max and min of the last 10 measurements, but
+            # not less than the minimum difference (30ms by default)
+            recent = [self._aligned(slave, difference) for difference in slave.currentSongDifferences[:10]]
+            minimumMaxDifference = max(params.minDifference, (0.5 * max(abs(max(recent)),
+                                                         abs(min(recent)))))
+
+            if maxDifference < minimumMaxDifference:
+                self.log.debug('maxDifference too small (%s); setting maxDifference to half of the biggest difference', maxDifference)
+
+                maxDifference = minimumMaxDifference
+
+        elif slave.pings.average:
+            # Use average ping
+
+            # Use the larger of master or slave ping so the script can
+            # run on either one, multiplied by 30 by default (e.g. a 2
+            # ms LAN ping becomes 60 ms max difference), but not less
+            # than the minimum difference
+            maxDifference = max(params.minDifference,
+                                (params.pingMultiplier * max([slave.pings.average, self.pings.average])))
+
+            # But don't go over 200 ms by default; if it's that high, better to
+            # just resync again.  But this does not work well for
+            # remote files.  The difference sometimes never gets lower
+            # than the maxDifference, so it resyncs forever, and
+            # always by the average ping or average slave adjustment,
+            # which basically loops doing the same syncs forever.
+            # Sigh.
+            maxDifference = min(params.maxPingDifference, maxDifference)
+
+        else:
+            # This shouldn't happen, but if it does, use 200ms until we
+            # have something better.  200ms seems like a lot, and for
+            # local files it is, but remote files don't seek as
+            # quickly or consistently, so 100ms can cause excessive
+            # reseeking in a short period of time
+            maxDifference = params.maxPingDifference
+
+        if len(slave.currentSongAdjustments) > params.wideningAfter:
+            # Many adjustments means trouble seeking this song.  Begin
+            # increasing the acceptable range by 25ms (by default) per
+            # adjustment over 3.
+            increase_by = params.widening * (len(slave.currentSongAdjustments) - params.wideningAfter)
+
+            maxDifference += increase_by
+
+            self.log.debug("More than %s adjustments; increasing max difference by %s",
+                           params.wideningAfter, increase_by)
+
+        maxDifference = round(maxDifference, 3)
+
+        self.log.debug("maxDifference for slave %s: %s", slave.host, maxDifference)
+
+        return maxDifference
+
+class TraceRecorder(object):
+    '''Appends timestamped measurements and decisions to a trace file,
+    one compact JSON object per line, for replaying later (see
+    mpdtools.py).  Safe to use from several threads.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.lock = Lock()
+
+    def record(self, kind, **fields):
+        fields['t'] = round(time.time(), 4)
+        fields['k'] = kind
+
+        for key, value in fields.items():
+            if isinstance(value, float):
+                fields[key] = round(value, 6)
+
+        line = json.dumps(fields, separators=(',', ':'))
+
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Metrics(object):
+    '''Registry of counters, gauges and histograms, exported in the
+    Prometheus text format by MetricsServer and MetricsTextfile.
+    Updating a metric only changes a dict under a lock, so it's cheap
+    enough for the sync loops.  Metrics must be declared with
+    describe() before use.'''
+
+    def __init__(self):
+        self.lock = Lock()
+
+        # name: (kind, help, buckets)
+        self.descriptions = {}
+
+        # name: {labels: value}.  Histogram values are [bucket
+        # counts..., sum, count].
+        self.values = defaultdict(dict)
+
+        # Functions returning more lines to render, for metrics kept
+        # elsewhere
+        self.collectors = []
+
+    def describe(self, name, kind, help, buckets=None):
+        self.descriptions[name] = (kind, help, buckets)
+
+    def inc(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + value
+
+    def set(self, name, value, **labels):
+        if value is None:
+            return
+
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.descriptions[name][2]
+        labels = tuple(sorted(labels.items()))
+
+        with self.lock:
+            values = self.values[name]
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(buckets) + 2)
+
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        "Return all metrics in the Prometheus text format."
+
+        with self.lock:
+            values = dict((name, dict((labels, list(value) if isinstance(value, list) else value)
+                                      for labels, value in v.items()))
+                          for name, v in self.values.items())
+
+        lines = []
+        for name in sorted(self.descriptions):
+            kind, help, buckets = self.descriptions[name]
+
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for labels, value in sorted(values.get(name, {}).items()):
+                if kind == 'histogram':
+                    # Bucket counts are cumulative
+                    for bound, count in zip(buckets, value):
+                        lines.append('%s_bucket%s %s' % (name, formatLabels(labels + (('le', bound),)), count))
+                    lines.append('%s_bucket%s %s' % (name, formatLabels(labels + (('le', '+Inf'),)), value[-1]))
+                    lines.append('%s_sum%s %s' % (name, formatLabels(labels), value[-2]))
+                    lines.append('%s_count%s %s' % (name, formatLabels(labels), value[-1]))
+                else:
+                    lines.append('%s%s %s' % (name, formatLabels(labels), value))
+
+        for collector in self.collectors:
+            lines.extend(collector())
+
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of this process, updated by the sync code
+metrics = Metrics()
+metrics.describe('mpdsync_difference_seconds', 'gauge',
+                 "Last measured difference between the master's and slave's positions")
+metrics.describe('mpdsync_average_difference_seconds', 'gauge',
+                 "Average difference between the master's and slave's positions for the current song")
+metrics.describe('mpdsync_rtt_seconds', 'gauge', 'Average ping time')
+metrics.describe('mpdsync_status_latency_seconds', 'histogram',
+                 'Time taken by status commands while measuring', SECONDS_BUCKETS)
+metrics.describe('mpdsync_song_reseeks', 'histogram', 'Corrections made to each song',
+                 (0, 1, 2, 3, 5, 8, 13))
+metrics.describe('mpdsync_reseeks_total', 'counter', 'Corrections made')
+metrics.describe('mpdsync_start_latency_seconds', 'histogram',
+                 'Time taken by slaves to start playing, by file type', SECONDS_BUCKETS)
+metrics.describe('mpdsync_rejected_samples_total', 'counter',
+                 'Measurements left out because they were made while the link was slow')
+metrics.describe('mpdsync_reconnects_total', 'counter', 'Reconnections to daemons')
+metrics.describe('mpdsync_recoveries_total', 'counter', 'Slave repairs, by recovery path')
+metrics.describe('mpdsync_playlist_sync_seconds', 'histogram', 'Time taken to sync a playlist',
+                 SECONDS_BUCKETS)
+metrics.describe('mpdsync_idle_events_total', 'counter', 'Idle events handled, by subsystem')
+metrics.describe('mpdsync_slave_events_total', 'counter',
+                 "Idle events from slaves that weren't caused by mpdsync, by subsystem")
+metrics.describe('mpdsync_failovers_total', 'counter', 'Lost masters replaced by a slave, by zone')
+metrics.describe('mpdsync_failbacks_total', 'counter', 'Masters that took over again after failing over')
+metrics.describe('mpdsync_seeker_tick_seconds', 'histogram',
+                 'Time taken by each Seeker tick', SECONDS_BUCKETS)
+metrics.describe('mpdsync_zone_tick_seconds', 'histogram',
+                 'Time taken by each Seeker tick, by zone', SECONDS_BUCKETS)
+
+
+class LatencyHistogram(object):
+    '''Histogram of latencies with logarithmic buckets, like an HDR
+    histogram: each power of 2 of microseconds is split into
+    LATENCY_SUB_BUCKETS buckets, so every value is recorded with about
+    the same relative precision in a few dozen counters.'''
+
+    def __init__(self):
+        # Bucket index: count
+        self.counts = defaultdict(int)
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __str__(self):
+        return ' '.join('%s:%s' % (key, value) for key, value in sorted(self.summary().items()))
+
+    def record(self, seconds):
+        self.counts[self._bucket(seconds)] += 1
+
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        '''Return the latency that PERCENT percent of the recorded ones
+        were at or below, rounded up to the end of its bucket.'''
+
+        if not self.count:
+            return None
+
+        target = math.ceil(self.count * percent / 100.0)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.max, self._upperBound(bucket))
+
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 6),
+                'min': round(self.min, 6),
+                'p50': round(self.percentile(50), 6),
+                'p90': round(self.percentile(90), 6),
+                'p99': round(self.percentile(99), 6),
+                'max': round(self.max, 6)}
+
+    def _bucket(self, seconds):
+        microseconds = seconds * 1000000
+        if microseconds < 1:
+            return 0
+
+        # microseconds = mantissa * 2 ** exponent, with mantissa in
+        # [0.5, 1)
+        mantissa, exponent = math.frexp(microseconds)
+
+        return exponent * LATENCY_SUB_BUCKETS + int((mantissa * 2 - 1) * LATENCY_SUB_BUCKETS)
+
+    def _upperBound(self, bucket):
+        "Return the largest latency in seconds that goes in BUCKET."
+
+        if bucket == 0:
+            return 0.000001
+
+        exponent, sub = divmod(bucket, LATENCY_SUB_BUCKETS)
+
+        return 2 ** (exponent - 1) * (1 + (sub + 1) / float(LATENCY_SUB_BUCKETS)) / 1000000
+
+
+class CommandLatencies(object):
+    '''LatencyHistograms of how long each MPD command takes, by daemon
+    address (including the other connections to the same daemon, like
+    IdleWatchers' and the Seeker's).  Idle commands take as long as the
+    daemon was idle, of course.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = defaultdict(lambda: defaultdict(LatencyHistogram))
+
+    def record(self, address, command, seconds):
+        with self.lock:
+            self.histograms[address][command].record(seconds)
+
+    def summary(self):
+        "Return dict of latency summaries by address and command."
+
+        with self.lock:
+            return dict((address, dict((command, histogram.summary())
+                                       for command, histogram in commands.items()))
+                        for address, commands in self.histograms.items())
+
+    def log(self, log, level=logging.INFO):
+        "Log a line for each address and command, slowest first."
+
+        summary = self.summary()
+        for address, commands in sorted(summary.items()):
+            for command, stats in sorted(commands.items(), key=lambda i: -i[1]['p99']):
+                log.log(level, "Command latency for %s %s: %s", address, command,
+                        ' '.join('%s:%s' % (key, stats[key])
+                                 for key in ['count', 'mean', 'p50', 'p90', 'p99', 'max']))
+
+    def collect(self):
+        "Return lines for the metrics (see Metrics.collectors)."
+
+        name = 'mpdsync_command_latency_seconds'
+        lines = ['# HELP %s Time taken by each MPD command' % name,
+                 '# TYPE %s summary' % name]
+
+        for address, commands in sorted(self.summary().items()):
+            for command, stats in sorted(commands.items()):
+                labels = (('host', address), ('command', command))
+                for quantile in ['p50', 'p90', 'p99']:
+                    lines.append('%s%s %s' % (name, formatLabels(labels + (('quantile', '0.%s' % quantile[1:]),)),
+                                              stats[quantile]))
+                lines.append('%s_sum%s %s' % (name, formatLabels(labels), stats['mean'] * stats['count']))
+                lines.append('%s_count%s %s' % (name, formatLabels(labels), stats['count']))
+
+        return lines
+
+
+class Span(object):
+    "Context manager that records a span in a Tracer."
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, time.time(), self.args)
+
+
+class NoSpan(object):
+    "Context manager that does nothing, for when tracing is disabled."
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Tracer(object):
+    '''Writes spans to a file in the Chrome trace event format, for
+    viewing in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+    Each span has the thread it ran in, so the main loop's and the
+    Seeker's work can be seen side by side.  Until start() is called,
+    span() returns a context manager that does nothing.'''
+
+    noSpan = NoSpan()
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        self.file = None
+        self.pid = os.getpid()
+
+        # Threads that have been named in the file
+        self.threads = set()
+        self.events = 0
+
+    def start(self, path):
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+        with self.lock:
+            if self.file:
+                self.file.write('\n]\n')
+                self.file.close()
+                self.file = None
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return self.noSpan
+
+        return Span(self, name, args)
+
+    def complete(self, name, start, end, args=None):
+        "Record span NAME from START to END, in seconds since the epoch."
+
+        thread = current_thread()
+        event = {'name': name, 'cat': 'mpdsync', 'ph': 'X',
+                 'ts': int(start * 1000000), 'dur': int((end - start) * 1000000),
+                 'pid': self.pid, 'tid': thread.ident}
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            if not self.file:
+                return
+
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self._write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                             'tid': thread.ident, 'args': {'name': thread.name}})
+
+            self._write(event)
+
+    def _write(self, event):
+        # The file is written as it goes, so a separator goes before
+        # every event but the first
+        if self.events:
+            self.file.write(',\n')
+        self.file.write(json.dumps(event, separators=(',', ':')))
+        self.events += 1
+
+
+# The tracer of this process, enabled by --trace
+tracer = Tracer()
+
+
+# The command latencies of this process, recorded by Client
+commandLatencies = CommandLatencies()
+metrics.collectors.append(commandLatencies.collect)
+
+
+class MetricsServer(object):
+    '''Serves metrics over HTTP on PORT, from a daemon thread.'''
+
+    def __init__(self, port, registry=None):
+        registry = registry or metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Don't log every scrape to stderr
+                pass
+
+        self.server = HTTPServer(('', port), Handler)
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsTextfile(object):
+    '''Writes metrics to PATH every INTERVAL seconds, for a textfile
+    collector like node_exporter's, from a daemon thread.'''
+
+    def __init__(self, path, interval=METRICS_TEXTFILE_INTERVAL, registry=None):
+        self.path = path
+        self.interval = interval
+        self.registry = registry or metrics
+
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+        self.thread = Thread(target=self._writeLoop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.write()
+
+    def write(self):
+        # Write to a temp file and rename it, so the collector never
+        # reads a partial file
+        tempPath = self.path + '.tmp'
+        with open(tempPath, 'w') as f:
+            f.write(self.registry.render())
+        os.rename(tempPath, self.path)
+
+    def _writeLoop(self):
+        while self.running:
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                logging.getLogger('mpdsync').getChild(self.__class__.__name__).error(
+                    "Unable to write metrics to %s: %s", self.path, e)
+
+            time.sleep(self.interval)
+
+
+class RelayServer(object):
+    '''Serves the timing reference of zone NAME of ZONES on PORT, so that another
+    mpdsync can use one of this group's slaves as its master and sync
+    its own slaves to the same root master (see RelayClient).  Several
+    levels make a tree that scales to many more slaves than one
+    mpdsync can poll.
+
+    Every RELAY_INTERVAL seconds, each connection gets a JSON line with
+    the offset of the master and each slave from the root master, in
+    seconds behind it (null when a slave has no measurements for the
+    current song, i.e. it was just corrected or started the song, and
+    the offset it had no longer holds).'''
+
+    def __init__(self, zones, name, port, interval=RELAY_INTERVAL):
+        self.log = zones.log.getChild(self.__class__.__name__)
+
+        self.zones = zones
+        self.name = name
+        self.interval = interval
+        self.running = False
+
+        relay = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                relay.log.debug("Downstream connected: %s", self.client_address)
+
+                try:
+                    while relay.running:
+                        self.wfile.write((json.dumps(relay.offsets()) + '\n').encode('utf-8'))
+                        self.wfile.flush()
+                        time.sleep(relay.interval)
+                except (IOError, OSError, socket.error) as e:
+                    relay.log.debug("Downstream disconnected: %s: %s", self.client_address, e)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('', port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def master(self):
+        # It may change on failover
+        return self.zones.masters[self.name]
+
+    def offsets(self):
+        master = self.master
+
+        # Our master is as far behind the root as our upstream says;
+        # our slaves' differences already include that
+        offsets = {master.address: master.upstream.offset if master.upstream else 0}
+
+        for slave in list(master.slaves):
+            differences = slave.currentSongDifferences
+            offsets[slave.address] = round(differences.average, 6) if len(differences) else None
+
+        return {'t': round(time.time(), 3), 'song': master.song, 'offsets': offsets}
+
+    def start(self):
+        self.running = True
+
+        self.thread = Thread(target=self.server.serve_forever, name='RelayServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RelayClient(object):
+    '''Follows an upstream mpdsync's RelayServer at UPSTREAM, in
+    HOST:PORT/NAME format, for the offset of daemon NAME (our master, as
+    the upstream knows it) from the root master.  NAME defaults to
+    DEFAULTNAME.'''
+
+    def __init__(self, upstream, defaultName, logger):
+        self.log = logger.getChild(self.__class__.__name__)
+
+        if '/' in upstream:
+            upstream, self.name = upstream.split('/', 1)
+        else:
+            self.name = defaultName
+
+        self.host, self.port = upstream.rsplit(':', 1)
+        self.port = int(self.port)
+
+        self.lastOffset = 0.0
+        self.updated = None
+        self.running = False
+
+    @property
+    def offset(self):
+        '''Seconds our master is behind the root master, or 0 if the
+        upstream hasn't said recently.'''
+
+        if self.updated is None or time.time() - self.updated > RELAY_STALE:
+            return 0.0
+
+        return self.lastOffset
+
+    def start(self):
+        self.running = True
+
+        self.thread = Thread(target=self._readLoop, name='RelayClient')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _readLoop(self):
+        while self.running:
+            try:
+                connection = socket.create_connection((self.host, self.port),
+                                                      timeout=RELAY_STALE)
+                self.log.debug("Connected to upstream %s:%s", self.host, self.port)
+
+                for line in connection.makefile('rb'):
+                    if not self.running:
+                        break
+
+                    offsets = json.loads(line.decode('utf-8'))['offsets']
+                    if self.name not in offsets:
+                        continue
+
+                    # Null means the upstream just corrected our master
+                    # or it started a song, which both aim to put it in
+                    # sync, so the last offset is out of date
+                    offset = offsets[self.name]
+                    self.lastOffset = 0.0 if offset is None else offset
+                    self.updated = time.time()
+
+                connection.close()
+
+            except (IOError, OSError, socket.error, ValueError, KeyError) as e:
+                self.log.warning("Lost upstream %s:%s: %s", self.host, self.port, e)
+
+            if self.running:
+                time.sleep(RELAY_RETRY)
+
+
+class StreamProbe(object):
+    '''Measures how long each slave in PLAYED (slave: time it was told to
+    play) took to start playing the stream URI, which MASTER started
+    it on expecting it to take DELAYS (slave: seconds; see
+    Master._startStreams).  A stream's elapsed time starts when it
+    starts playing, so slaves' statuses are polled every STREAM_POLL
+    seconds, for up to STREAM_TIMEOUT seconds.  Runs in MASTER's
+    SeekerScheduler, or in its own thread without one, so the event
+    loop isn't held up.'''
+
+    def __init__(self, master, uri, played, delays):
+        self.log = master.log.getChild(self.__class__.__name__)
+
+        self.master = master
+        self.zone = master.zone
+        self.uri = uri
+        self.played = dict(played)
+        self.delays = delays
+        self.deadline = time.time() + STREAM_TIMEOUT
+        self.thread = None
+
+    def start(self):
+        if self.master.scheduler:
+            self.master.scheduler.add(self)
+
+            return
+
+        self.thread = Thread(target=self._loop, name='StreamProbe')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while self.played:
+            time.sleep(self.tick())
+
+    def tick(self):
+        "Check each slave once.  Return seconds to sleep until the next check."
+
+        for slave, playedAt in list(self.played.items()):
+            try:
+                with slave.connectionLock:
+                    slave.status()
+            except Exception as e:
+                # Its connection is checked again on its next sync
+                self.log.error("Unable to get status of slave %s: %s", slave.host, e)
+
+                del self.played[slave]
+                continue
+
+            if not (slave.playing and slave.elapsed):
+                continue
+
+            delay = time.time() - playedAt - slave.elapsed
+            del self.played[slave]
+
+            self.log.debug("Slave %s took %s seconds to buffer %s", slave.host, delay, self.uri)
+
+            slave.startLatencies.update(self.uri, delay)
+
+            fileType, remote = slave.startLatencies.key(self.uri)
+            metrics.observe('mpdsync_start_latency_seconds', delay,
+                            slave=slave.address, filetype=fileType, remote=str(remote).lower())
+
+            if self.master.recorder:
+                self.master.recorder.record('streamStart', slave=slave.address, file=self.uri,
+                                            expected=self.delays[slave], startLatency=delay)
+
+        if self.played and time.time() >= self.deadline:
+            for slave in self.played:
+                self.log.warning("Slave %s didn't start playing %s within %s seconds",
+                                 slave.host, self.uri, STREAM_TIMEOUT)
+
+            self.played.clear()
+
+        if not self.played and self.thread is None:
+            # Done; the scheduler won't tick it again
+            self.master.scheduler.remove(self)
+
+        return STREAM_POLL
+
+
+class SeekerScheduler(object):
+    '''Runs the Seekers of several masters (see Zones), and their
+    StreamProbes and PauseResumers, in one thread, ticking each one
+    when its last tick said to.  Hold lock to change a master's slaves or the Seekers;
+    it's not held during ticks, which hold each slave's
+    connectionLock while they use it.'''
+
+    def __init__(self, logger):
+        self.log = logger.getChild(self.__class__.__name__)
+
+        # Seeker: time of its next tick
+        self.seekers = {}
+        self.lock = Lock()
+        self.thread = None
+
+        # Seeker whose tick is running
+        self.ticking = None
+
+    def add(self, seeker):
+        with self.lock:
+            self.seekers[seeker] = time.time()
+
+        self.check()
+
+    def remove(self, seeker):
+        "Remove SEEKER, waiting for its tick to finish if it's running."
+
+        with self.lock:
+            self.seekers.pop(seeker, None)
+
+        while self.ticking is seeker and current_thread() is not self.thread:
+            time.sleep(0.05)
+
+    def check(self):
+        "Start the thread, or restart it if it died."
+
+        if self.thread and self.thread.is_alive():
+            return
+
+        if self.thread:
+            self.log.warning("Scheduler thread died; restarting...")
+
+        self.thread = Thread(target=self._loop, name='SeekerScheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                due = [seeker for seeker, tickAt in self.seekers.items()
+                       if tickAt <= time.time()]
+
+            for seeker in due:
+                with self.lock:
+                    if seeker not in self.seekers:
+                        # Removed meanwhile
+                        continue
+
+                    self.ticking = seeker
+
+                start = time.time()
+                try:
+                    sleepTime = seeker.tick()
+                except Exception as e:
+                    # Don't let one zone stop the others
+                    self.log.exception("Seeker for zone %s failed: %s", seeker.zone, e)
+                    sleepTime = 2
+                finally:
+                    self.ticking = None
+
+                with self.lock:
+                    # Unless it was removed meanwhile
+                    if seeker in self.seekers:
+                        self.seekers[seeker] = time.time() + sleepTime
+
+                metrics.observe('mpdsync_seeker_tick_seconds', time.time() - start)
+                metrics.observe('mpdsync_zone_tick_seconds', time.time() - start,
+                                zone=seeker.zone)
+
+            with self.lock:
+                nextTick = min(self.seekers.values()) if self.seekers else time.time() + 1
+
+            # Wake up at least once a second for new seekers
+            time.sleep(min(1, max(0.01, nextTick - time.time())))
+
+
+class Zones(object):
+    '''Independent groups of a master and its slaves (zones), served by
+    one event loop: their IdleWatchers put events in EVENTS, and their
+    Seekers share one SeekerScheduler thread.  OPTIONS are Master options
+    for every zone.  Slaves can be moved between zones without
+    resyncing the others (see configure()).
+
+    With WATCHSLAVES, each slave is watched too, so a slave whose queue
+    or player is changed behind mpdsync's back is repaired right away
+    (see Master.checkSlave).
+
+    A zone whose master is lost stops syncing, without affecting the
+    other zones, until the master comes back.  With FAILOVER, it
+    carries on with one of its slaves as the master instead (see
+    masterLost()).'''
+
+    def __init__(self, events, options=None, password=None, watchSlaves=False, failover=False,
+                 logger=None):
+        self.logger = logger
+        self.log = logger.getChild(self.__class__.__name__)
+
+        self.events = events
+        self.options = options or {}
+        self.password = password
+        self.watchSlaves = watchSlaves
+        self.failover = failover
+        self.scheduler = SeekerScheduler(logger)
+
+        # Name: Master
+        self.masters = {}
+        self.watchers = {}
+        self.heartbeats = {}
+
+        # Name: (master spec, password, Master options) it was added with
+        self.settings = {}
+
+        # Name: Heartbeat waiting for the zone's lost master to come back
+        self.lostMasters = {}
+
+        # Slave address: IdleWatcher
+        self.slaveWatchers = {}
+
+    def __iter__(self):
+        return iter([self.masters[name] for name in sorted(self.masters)])
+
+    def addZone(self, name, master, slaves, password=None, **options):
+        '''Connects to MASTER and SLAVES (in HOST:PORT/LATENCY format), syncs
+        them, and starts watching the master.  OPTIONS override the Master
+        options for this zone.  Returns False if the master couldn't be
+        connected to or watched.'''
+
+        password = password or self.password
+        masterOptions = dict(self.options, **options)
+        self.settings[name] = (master, password, masterOptions)
+
+        master = Master(host=master, password=password, zone=name,
+                        scheduler=self.scheduler, logger=self.logger, **masterOptions)
+
+        try:
+            master.connect()
+        except Exception as e:
+            self.log.exception('Unable to connect to master server for zone %s: %s', name, e)
+            return False
+
+        self.log.debug('Connected to master server for zone %s.', name)
+
+        for slave in slaves:
+            master.addSlave(slave, password=password)
+
+        master.syncAll()
+
+        if not self._watchMaster(name, master):
+            return False
+
+        self.masters[name] = master
+
+        for slave in master.slaves:
+            self._watchSlave(slave)
+
+        return True
+
+    def _watchMaster(self, name, master):
+        "Start watching MASTER of zone NAME.  Returns False if it failed."
+
+        # A lost connection is an event like any other, so it only
+        # affects this zone
+        watcher = IdleWatcher(master, self.events,
+                              subsystems=['database', 'playlist', 'player', 'options'],
+                              lost='lost')
+        try:
+            watcher.start()
+        except Exception as e:
+            self.log.exception('Unable to watch master server for zone %s: %s', name, e)
+            return False
+
+        self.watchers[name] = watcher
+
+        if self.failover:
+            # A master that disappears without closing the connection
+            # would keep the idle connection waiting
+            self.heartbeats[name] = Heartbeat(master, self.events)
+            self.heartbeats[name].start()
+
+        return True
+
+    def _unwatchMaster(self, name):
+        watcher = self.watchers.pop(name, None)
+        if watcher:
+            watcher.stop()
+
+        heartbeat = self.heartbeats.pop(name, None)
+        if heartbeat:
+            heartbeat.stop()
+
+    def removeZone(self, name):
+        "Stops syncing zone NAME and disconnects from its daemons."
+
+        master = self.masters.pop(name)
+        self._unwatchMaster(name)
+
+        lost = self.lostMasters.pop(name, None)
+        if lost:
+            lost.stop()
+
+        master.stopSeeker()
+        for slave in list(master.slaves):
+            self._unwatchSlave(slave)
+            master.removeSlave(slave)
+
+        try:
+            master.disconnect()
+        except Exception as e:
+            self.log.debug("Couldn't disconnect from master %s: %s", master.host, e)
+
+    def addSlave(self, spec, name, password=None):
+        '''Connects to slave SPEC, in HOST:PORT/LATENCY format, and syncs it
+        to zone NAME's master, without resyncing the zone's other slaves.
+        Returns the slave, or None if it failed.'''
+
+        master = self.masters[name]
+
+        slave = master.addSlave(spec, password=password or self.password)
+        if slave:
+            master.repairSlave(slave, 'added')
+            self._watchSlave(slave)
+
+        return slave
+
+    def removeSlave(self, address):
+        "Stops syncing slave at ADDRESS and disconnects from it."
+
+        master, slave = self.findSlave(address)
+
+        self.log.info("Removing slave %s from zone %s", address, master.zone)
+
+        self._unwatchSlave(slave)
+        with self.scheduler.lock:
+            master.removeSlave(slave)
+
+    def _watchSlave(self, slave):
+        if not self.watchSlaves:
+            return
+
+        watcher = IdleWatcher(slave, self.events, subsystems=['playlist', 'player'],
+                              retry=SLAVE_WATCH_RETRY)
+        try:
+            watcher.start()
+        except Exception as e:
+            # The slave can still be synced without it
+            self.log.error('Unable to watch slave %s: %s', slave.address, e)
+            return
+
+        self.slaveWatchers[slave.address] = watcher
+
+    def _unwatchSlave(self, slave):
+        watcher = self.slaveWatchers.pop(slave.address, None)
+        if watcher:
+            watcher.stop()
+
+    def findSlave(self, address):
+        "Return (master, slave) for slave at ADDRESS, or (None, None)."
+
+        for master in self:
+            for slave in master.slaves:
+                if slave.address == address:
+                    return master, slave
+
+        return None, None
+
+    def moveSlave(self, address, name):
+        '''Moves slave at ADDRESS to zone NAME and syncs it to its new
+        master.  Returns False if it failed.'''
+
+        source, slave = self.findSlave(address)
+        target = self.masters[name]
+
+        if source is target:
+            return True
+
+        with self.scheduler.lock:
+            source.slaves.remove(slave)
+            target.slaves.append(slave)
+
+        self.log.info("Moved slave %s from zone %s to %s", address, source.zone, name)
+
+        return target.repairSlave(slave, 'moved')
+
+    def configure(self, config):
+        '''Makes the zones match CONFIG, a dict like:
+
+        {"zones": {"downstairs": {"master": "HOST:PORT",
+                                  "slaves": ["HOST:PORT/LATENCY", ...],
+                                  "password": "optional"},
+                   ...}}
+
+        Zones whose master changed are restarted, slaves that changed
+        zones are moved, and other slaves are left alone.  Returns False
+        if any zone couldn't be started.'''
+
+        zones = config['zones']
+        ok = True
+
+        # Stop zones that are gone or have a new master (the one they
+        # were added with, which may have failed over to a slave)
+        for name, master in list(self.masters.items()):
+            if (name not in zones
+                or splitSpec(zones[name]['master'])[0] != splitSpec(self.settings[name][0])[0]):
+                self.log.info("Removing zone %s", name)
+                self.removeZone(name)
+
+        # Zone and spec of each slave
+        wanted = {}
+        for name, zone in zones.items():
+            for spec in zone.get('slaves', []):
+                wanted[splitSpec(spec)[0]] = (name, spec)
+
+        # Start new zones with their slaves that aren't in another zone
+        for name, zone in sorted(zones.items()):
+            if name not in self.masters:
+                self.log.info("Adding zone %s", name)
+
+                slaves = [spec for spec in zone.get('slaves', [])
+                          if self.findSlave(splitSpec(spec)[0])[1] is None]
+                if not self.addZone(name, zone['master'], slaves, password=zone.get('password')):
+                    ok = False
+
+        # Move or remove the other slaves
+        for master in list(self):
+            for slave in list(master.slaves):
+                if slave.address not in wanted:
+                    self.removeSlave(slave.address)
+                    continue
+
+                name, spec = wanted[slave.address]
+                slave.latency = splitSpec(spec)[1]
+
+                if name in self.masters and name != master.zone:
+                    self.moveSlave(slave.address, name)
+
+        # Add new slaves
+        for address, (name, spec) in sorted(wanted.items()):
+            if name in self.masters and self.findSlave(address)[1] is None:
+                self.addSlave(spec, name, password=zones[name].get('password'))
+
+        return ok
+
+    def handleEvents(self, changes):
+        "Syncs each zone according to CHANGES, as returned by EventCoalescer.get()."
+
+        # Masters coming back after failing over
+        for name, heartbeat in list(self.lostMasters.items()):
+            if 'back' in changes.pop(heartbeat.client, ()):
+                self.failBack(name)
+
+        masters = list(self)
+        for master, subsystems in changes.items():
+            # Events may still come from zones that were just removed
+            if master not in masters:
+                continue
+
+            if 'lost' in subsystems:
+                self.masterLost(master.zone)
+            else:
+                master.handleEvents(subsystems)
+
+        # Check slaves after their masters have synced them
+        masters = list(self)
+        for client, subsystems in changes.items():
+            if client not in masters:
+                master, slave = self.findSlave(client.address)
+
+                # Or slaves that were just removed
+                if slave is client:
+                    # Not while a Seeker tick uses the same connection
+                    with slave.connectionLock:
+                        master.checkSlave(slave, subsystems)
+
+    def skewMetrics(self):
+        "Return lines of every zone's skew metrics (see Master.skewMetrics)."
+
+        zones = [master.skewMetrics() for master in self]
+
+        lines = []
+        for name, kind, help in Master.skewMetricFamilies:
+            lines.extend(['# HELP %s %s' % (name, help),
+                          '# TYPE %s %s' % (name, kind)])
+            for zone in zones:
+                lines.extend(zone.get(name, []))
+
+        return lines
+
+    def masterLost(self, name):
+        '''Handles the loss of zone NAME's master: with failover, see
+        failOver(); otherwise, or if no slave could take over, stops
+        syncing the zone.  Then waits for the master to come back (see
+        failBack()).'''
+
+        if name in self.lostMasters:
+            # Both the idle connection and the heartbeat noticed
+            return
+
+        master = self.masters[name]
+
+        self.log.warning("Lost master %s of zone %s", master.address, name)
+
+        if not (self.failover and self.failOver(name)):
+            self.log.error("Not syncing zone %s until master %s is back", name, master.address)
+
+            self._unwatchMaster(name)
+            try:
+                master.stopSeeker()
+            except Exception as e:
+                self.log.debug("Couldn't stop Seeker for master %s: %s", master.address, e)
+
+        self._waitForMaster(name, master)
+
+    def _waitForMaster(self, name, master):
+        heartbeat = Heartbeat(master, self.events, up=False)
+        heartbeat.start()
+        self.lostMasters[name] = heartbeat
+
+    def failOver(self, name):
+        '''Replaces the lost master of zone NAME with the slave that is
+        closest to it, which already has the same queue, and keeps
+        syncing the other slaves to it without resyncing them (unless
+        their queues leave out missing files; see _promote()).  Returns
+        False if no slave could take over.'''
+
+        master = self.masters[name]
+
+        # The best-synced slave that can still be reached
+        candidates = [slave for slave in master.slaves if slave.checkConnection()]
+        candidates.sort(key=lambda slave: (abs(slave.currentSongDifferences.average)
+                                           if len(slave.currentSongDifferences) else float('inf')))
+
+        for slave in candidates:
+            if self._promote(name, slave):
+                self.log.warning("Promoted slave %s to master of zone %s", slave.address, name)
+
+                metrics.inc('mpdsync_failovers_total', zone=name)
+
+                return True
+
+        self.log.error("No slave to promote in zone %s", name)
+
+        return False
+
+    def failBack(self, name):
+        '''Makes the original master of zone NAME the master again, after
+        syncing it to the slave that replaced it (see failOver()), which
+        becomes a slave again, or resyncs the zone to it if nothing
+        replaced it.'''
+
+        original = self.lostMasters.pop(name).client
+        current = self.masters[name]
+        spec, password, options = self.settings[name]
+
+        self.log.warning("Master %s of zone %s is back", original.address, name)
+
+        if current is original:
+            # Nothing took over, so sync the slaves to it again
+            try:
+                original.disconnect()
+            except Exception as e:
+                # Its connection was already dropped
+                self.log.debug("Couldn't disconnect from master %s: %s", original.address, e)
+
+            try:
+                original.connect()
+            except Exception as e:
+                self.log.error("Unable to reconnect to master %s of zone %s: %s; trying again later",
+                               original.address, name, e)
+
+                self._waitForMaster(name, original)
+
+                return
+
+            # It may have been restarted, so compare the whole
+            # playlists, which only clears them if they differ
+            for slave in original.slaves:
+                slave.hasBeenSynced = False
+
+            try:
+                original.syncAll()
+            except Exception as e:
+                self.log.error("Unable to resync zone %s: %s; trying again later", name, e)
+
+                self._waitForMaster(name, original)
+
+                return
+
+            self._watchMaster(name, original)
+
+            return
+
+        # Bring its queue and position up to date like a slave's.
+        # But when slaves' queues leave out files they don't have,
+        # the stand-in's queue may be a subset of the original's, so
+        # only its position is brought up to date then.
+        slave = current.addSlave(original.address, password=password)
+        if slave and slave.database:
+            synced = self._resume(current, slave)
+        else:
+            synced = slave and current.repairSlave(slave, 'failback')
+
+        if not synced:
+            self.log.error("Unable to sync master %s of zone %s; trying again later",
+                           original.address, name)
+
+            if slave:
+                with self.scheduler.lock:
+                    current.removeSlave(slave)
+
+            self._waitForMaster(name, original)
+
+            return
+
+        if self._promote(name, slave, demote=True):
+            self.log.warning("Master %s of zone %s took over again from %s",
+                             original.address, name, current.address)
+
+            metrics.inc('mpdsync_failbacks_total', zone=name)
+
+    def _resume(self, master, client):
+        '''Starts CLIENT (a slave of MASTER) playing MASTER's current song
+        at its position, if CLIENT's queue has it, without changing the
+        queue.  If CLIENT's queue is empty, it's repaired like any
+        slave's instead.  Returns False if it failed.'''
+
+        try:
+            master.status()
+            client.getPlaylist()
+
+            if not client.playlist:
+                # It lost its queue (e.g. it was restarted without a
+                # state file), so there's nothing to keep
+                return master.repairSlave(client, 'failback')
+
+            if master.playing and master.currentFile in client.playlist:
+                song = client.playlist.index(master.currentFile)
+                client.play(song=song)
+                client.seek(song, master.elapsed)
+        except Exception as e:
+            self.log.error("Unable to resume %s from %s: %s", client.address, master.address, e)
+
+            return False
+
+        return True
+
+    def _promote(self, name, slave, demote=False):
+        '''Makes SLAVE the master of zone NAME.  The other slaves are kept
+        as they are, since they already mirror its queue, unless their
+        queues leave out files they don't have, in which case the zone
+        is resynced to it.  With DEMOTE, the old master becomes a slave;
+        otherwise it's dropped.  Returns False if SLAVE couldn't be
+        connected to.'''
+
+        old = self.masters[name]
+        spec, password, options = self.settings[name]
+
+        new = Master(host=slave.address, password=password, zone=name,
+                     scheduler=self.scheduler, logger=self.logger, **options)
+        try:
+            new.connect()
+            new.status()
+            new.getPlaylist()
+        except Exception as e:
+            self.log.error("Unable to connect to new master %s of zone %s: %s",
+                           slave.address, name, e)
+            return False
+
+        # Remember its latency for when it's a slave again
+        new.latency = slave.latency
+
+        self._unwatchMaster(name)
+        try:
+            old.stopSeeker()
+        except Exception as e:
+            self.log.debug("Couldn't stop Seeker for old master %s: %s", old.address, e)
+
+        # Move the other slaves to the new master
+        with self.scheduler.lock:
+            old.slaves.remove(slave)
+            new.slaves.extend(old.slaves)
+            del old.slaves[:]
+
+        self._unwatchSlave(slave)
+        for client in [slave, old]:
+            try:
+                client.disconnect()
+            except Exception as e:
+                self.log.debug("Couldn't disconnect from %s: %s", client.address, e)
+
+        # Slaves' queues are their own subsets of the old master's
+        # when they leave out files they don't have, and their
+        # positions map the old master's queue
+        filtered = bool(new.databaseIndex or new.databaseCache)
+
+        for other in new.slaves:
+            # Their differences from the old master no longer count
+            other.currentSongDifferences.clear()
+
+            if filtered:
+                # Compare whole playlists in the resync below
+                other.positions = None
+                other.hasBeenSynced = False
+            else:
+                # Their queues already match the new master's, so
+                # only changes from now on need to be synced
+                other.playlistVersion = new.playlistVersion
+
+        if demote:
+            demoted = new.addSlave(old.address if old.latency is None
+                                   else '%s/%s' % (old.address, old.latency), password=password)
+            if demoted:
+                demoted.hasBeenSynced = not filtered
+                demoted.playlistVersion = new.playlistVersion
+                self._watchSlave(demoted)
+
+        if filtered:
+            try:
+                new.syncAll()
+            except Exception as e:
+                # The next event will try again
+                self.log.error("Unable to resync zone %s to new master %s: %s",
+                               name, new.address, e)
+
+        self.masters[name] = new
+        self._watchMaster(name, new)
+
+        # The resync may have started its Seeker already
+        if new.adjustLatency and new.playing:
+            new.checkSeeker()
+
+        return True
+
+    def zoneMetrics(self):
+        "Return lines of zone membership for the metrics (see Metrics.collectors)."
+
+        lines = ['# HELP mpdsync_zone_slaves Slaves in each zone',
+                 '# TYPE mpdsync_zone_slaves gauge']
+        lines.extend('mpdsync_zone_slaves%s %s' % (formatLabels((('zone', master.zone),)), len(master.slaves))
+                     for master in self)
+
+        lines.extend(['# HELP mpdsync_zone_slave_info Zone of each slave',
+                      '# TYPE mpdsync_zone_slave_info gauge'])
+        lines.extend('mpdsync_zone_slave_info%s 1' % formatLabels((('zone', master.zone), ('slave', slave.address)))
+                     for master in self for slave in master.slaves)
+
+        return lines
+
+
+class ControlServer(object):
+    '''Serves a line protocol on a Unix socket at PATH for changing ZONES
+    while running.  Each command's output lines are followed by "OK", or
+    by "ACK MESSAGE" if it failed, like MPD.  Commands:
+
+      add SLAVE [ZONE]             Sync SLAVE (HOST:PORT/LATENCY) in ZONE
+      remove SLAVE                 Stop syncing SLAVE
+      move SLAVE ZONE              Move SLAVE to ZONE
+      latency SLAVE SECONDS|auto   Set SLAVE's latency, or go back to measuring it
+      set SLAVE PARAM VALUE        Set one of SLAVE's Seeker parameters (see SeekerParams)
+      stats                        Print zones, slaves and their settings as JSON
+
+    ZONE may be left out when there is only one.  Commands are put in
+    EVENTS and run by the event loop between syncs (see run()), so a
+    change takes effect on the Seeker's next tick, and no other slaves
+    are resynced.  A command the event loop hasn't started within
+    CONTROL_TIMEOUT seconds is answered with an ACK and dropped.  A
+    config reload (SIGHUP) undoes slaves added, removed or moved here
+    that aren't in the config.'''
+
+    def __init__(self, zones, path, events):
+        self.log = zones.log.getChild(self.__class__.__name__)
+
+        self.zones = zones
+        self.path = path
+        self.events = events
+
+        control = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    words = line.decode('utf-8').split()
+                    if not words:
+                        continue
+
+                    # Wait for the event loop to run it
+                    command = ControlCommand(words)
+                    control.events.put((control, [command]))
+                    try:
+                        reply = command.reply.get(timeout=CONTROL_TIMEOUT)
+                    except queue.Empty:
+                        if command.claim('cancelled'):
+                            # The event loop is stuck (e.g. in a long
+                            # sync); don't leave the client hanging
+                            reply = 'ACK timed out waiting for the event loop\n'
+                        else:
+                            # It started just now, so it will reply
+                            reply = command.reply.get()
+
+                    self.wfile.write(reply.encode('utf-8'))
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        # Remove the socket left by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.server = Server(path, Handler)
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, name='ControlServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def run(self, command):
+        "Run COMMAND (a ControlCommand) and send its reply.  Call from the event loop."
+
+        name, args = command.words[0], command.words[1:]
+
+        if not command.claim('running'):
+            # Its client has already been told it failed
+            self.log.warning("Not running timed-out control command: %s", ' '.join(command.words))
+
+            return
+
+        self.log.info("Control command: %s", ' '.join(command.words))
+
+        try:
+            handler = getattr(self, 'cmd_%s' % name, None)
+            if handler is None:
+                raise ValueError('unknown command "%s"' % name)
+
+            # Check before running it, so a TypeError from inside
+            # isn't mistaken for this after a partial change
+            if not acceptsArgs(handler, len(args)):
+                raise ValueError('wrong number of arguments for "%s"' % name)
+
+            lines = handler(*args) or []
+        except (ValueError, KeyError) as e:
+            command.reply.put('ACK %s\n' % (e.args[0] if e.args else e))
+        except Exception as e:
+            self.log.exception("Control command failed: %s", e)
+            command.reply.put('ACK %s\n' % e)
+        else:
+            command.reply.put(''.join(line + '\n' for line in lines) + 'OK\n')
 
-        if self.sync and not self.thread.is_alive():
-            self.log.warning("Sync thread died; restarting...")
+    def _slave(self, address):
+        "Return (master, slave) for slave at ADDRESS, or raise KeyError."
 
-            self.checkConnection()
-            self.start_loop()
+        master, slave = self.zones.findSlave(splitSpec(address)[0])
+        if slave is None:
+            raise KeyError('no slave %s' % address)
 
-    def _syncLoop(self):
-        "Run loop keeping slaves' position in sync."
+        return master, slave
 
-        # Run the loop
-        while self.sync:
-            sleepTime = None
+    def _zone(self, name=None):
+        "Return zone NAME, which defaults to the only zone."
 
-            # NOTE: This works, but the thread won't stop while it's
-            # sleeping, so it can take several seconds in the worst
-            # case for the thread to notice that it should stop.  This
-            # doesn't seem like a problem most of the time, unless the
-            # user stops MPD and then starts it playing again before
-            # this thread has terminated, in which case the slaves
-            # won't start playing again until the thread terminates
-            # and the script catches up with the subsystem updates.
-            # I'm not sure how to fix this short of switching to a
-            # subprocess, because killing threads is not supported,
-            # and any workarounds are necessarily ugly hacks which
-            # might have bad side effects.
+        if name is None:
+            if len(self.zones.masters) != 1:
+                raise ValueError('which zone?')
 
-            if self.master.playing:
+            name = list(self.zones.masters)[0]
 
-                # Check each slave's average difference
-                for slave in self.slaves:
+        if name not in self.zones.masters:
+            raise KeyError('no zone %s' % name)
 
-                    # Don't run the loop if an earlier one is already
-                    # waiting for a result (this might be helping to
-                    # cause the MPD protocol errors)
-                    if slave.syncLoopLocked:
-                        self.log.debug("syncLoopLocked for slave %s", slave.host)
+        return name
 
-                        continue
-                    else:
-                        # Lock the slave
-                        slave.syncLoopLocked = True
+    def cmd_add(self, spec, name=None):
+        if self.zones.findSlave(splitSpec(spec)[0])[1]:
+            raise ValueError('%s is already synced' % spec)
 
-                    # TODO: If finished seeking, stop the loop until
-                    # the next track (and restart it on track change)
+        if not self.zones.addSlave(spec, self._zone(name)):
+            raise ValueError('unable to connect to %s' % spec)
 
-                    if self._reseek_necessary(slave):
-                        self._reseek_slave(slave)
-                        sleepTime = 2  # Sleep 2 seconds after reseeking
+    def cmd_remove(self, address):
+        self._slave(address)
+        self.zones.removeSlave(splitSpec(address)[0])
 
-                    # Unlock the slave
-                    slave.syncLoopLocked = False
+    def cmd_move(self, address, name):
+        master, slave = self._slave(address)
 
-                # Sleep for 400ms for each measurement, but at least 2 s
-                if not sleepTime:
-                    sleepTime = max(2, 0.4 * len(slave.currentSongDifferences))
+        if not self.zones.moveSlave(slave.address, self._zone(name)):
+            raise ValueError('unable to sync %s in zone %s' % (address, name))
 
-                # Print comparison between two slaves
-                if len(self.slaves) > 1:
-                    self.slaveDifferences.insert(0, abs(self.slaves[0].currentSongDifferences.average
-                                                        - self.slaves[1].currentSongDifferences.average))
-                    self.log.debug("Average difference between slaves 1 and 2: %s",
-                                   self.slaveDifferences.average)
+    def cmd_latency(self, address, latency):
+        master, slave = self._slave(address)
 
-            else:
-                # Not playing; sleep 2 seconds
-                sleepTime = 2
+        slave.latency = None if latency == 'auto' else float(latency)
 
-                # TODO: Instead, stop this thread, and restart it when playing resumes
+    def cmd_set(self, address, param, value):
+        master, slave = self._slave(address)
 
-            # BUG: If there are multiple slaves, this sleeps for
-            # whatever sleepTime was set to for the last slave.  Not a
-            # big deal, but might need fixing.
-            self.log.debug('Sleeping for %s seconds', sleepTime)
+        # The profile's params may be shared with other slaves
+        params = slave.params.toDict()
+        params[param] = value
+        slave.params = SeekerParams(**params)
 
-            time.sleep(sleepTime)
+        self.log.info("Seeker parameters for %s: %s", slave.address, slave.params)
 
-    def _reseek_slave(self, slave):
-        "Seek slave position to match master's."
+    def cmd_stats(self):
+        return [json.dumps(dict((master.zone, {
+            'master': master.address,
+            'slaves': dict((slave.address, {'latency': slave.latency,
+                                            'params': slave.params.toDict(),
+                                            'skew': slave.skew.summary(),
+                                            'rejected': slave.rttFilter.rejected})
+                           for slave in master.slaves)})
+                                for master in self.zones), sort_keys=True)]
 
-        # TODO: Idea: Maybe part of the problem is that MPD can't seek
-        # songs precisely, but only to certain places, like between
-        # frames, or something like that.  So maybe if the master and
-        # slaves were both seeked to the same value initially, it
-        # would cause them to both seek to about the same place, once
-        # or twice, instead of the slaves trying repeatedly to get a
-        # good sync.
 
-        adjustBy = self._calc_adjustment(slave)
+class ControlCommand(object):
+    '''A command from a ControlServer connection, as a list of WORDS,
+    with a queue for its reply.  Either the event loop claims it to run
+    it, or the connection claims it to cancel it after a timeout, but
+    not both (see claim()).'''
 
-        # Calculate position
-        position = self.elapsed - adjustBy
-        if position < 0:
-            self.log.debug("Position for %s was < 0 (%s); skipping adjustment",
-                           slave.host, position)
+    def __init__(self, words):
+        self.words = words
+        self.reply = queue.Queue()
 
-            return False
+        # None, 'running' or 'cancelled'
+        self.state = None
+        self.lock = Lock()
 
-        self.log.debug('Master elapsed:%s  Adjusting %s to:%s (song: %s)',
-                       self.elapsed, slave.host, position, self.song)
+    def claim(self, state):
+        "Set state to STATE and return True, unless it was already claimed."
 
-        # For some reason this is getting weird errors like
-        # "mpd.ProtocolError: Got unexpected return value: 'volume:
-        # 0'", and I don't want the script to quit, so wrapping it in
-        # a try/except should help it try again
-        try:
-            # Try to seek to current playing position, adjusted for
-            # latency
-            slave.seek(self.song, position)
+        with self.lock:
+            if self.state is not None:
+                return False
 
-        except Exception as e:
-            # Seek failed
-            self.log.exception("Unable to seek slave %s: %s", slave.host, e)
+            self.state = state
 
-            # Try to completely resync the slave
-            slave.playlistVersion = None
-            self.syncPlaylists()
+            return True
 
-            # Clear song adjustments to prevent wild jittering after
-            # seek timeouts
-            slave.currentSongAdjustments.clear()
-            slave.checkConnection()
 
-            return False
+class Heartbeat(object):
+    '''Pings a daemon on a separate connection every INTERVAL seconds in
+    a thread.  If UP, puts (client, ['lost']) in EVENTS when it misses
+    FAILOVER_MISSES pings in a row; otherwise, puts (client, ['back'])
+    when it can be connected to again.  Either way, it stops then.'''
 
-        else:
-            # Seek succeeded
+    def __init__(self, client, events, up=True, interval=FAILOVER_INTERVAL):
+        self.log = client.log.getChild(self.__class__.__name__)
 
-            slave.adjustments.insert(0, adjustBy)
-            slave.currentSongAdjustments.append(adjustBy)
-            slave.fileTypeAdjustments[slave.currentSongFiletype].append(adjustBy)
+        self.client = client
+        self.events = events
+        self.up = up
+        self.interval = interval
+        self.connection = Client(client.host, port=client.port,
+                                 password=client.password, logger=client.log)
+        self.connection.timeout = interval
+        self.running = False
 
-            # Reset song differences
-            slave.currentSongDifferences.clear()
+    def start(self):
+        self.running = True
 
-            return True
+        self.thread = Thread(target=self._loop, name='Heartbeat(%s)' % self.client.address)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def _calc_adjustment(self, slave):
-        "Return adjustment to make to sync slave with master."
+    def stop(self):
+        self.running = False
 
-        # Choose adjustment
-        if slave.latency is not None:
-            # Use the user-set adjustment
-            self.log.debug("Adjusting %s by slave.latency: %s", slave.host, slave.latency)
+    def _loop(self):
+        connected = False
+        misses = 0
 
-            adjustBy = MyFloat(slave.latency)
+        while self.running:
+            try:
+                if not connected:
+                    self.connection.connect()
+                    connected = True
 
-        else:
-            # Calculate adjustment automatically
+                self.connection.ping()
 
-            if len(slave.currentSongAdjustments) < 1:
-                # First adjustment for song
-                self.log.debug("First adjustment for song...")
+            except Exception as e:
+                self.log.debug("No answer from %s: %s", self.client.address, e)
 
-                if len(slave.adjustments) > 5:
-                    # More than 5 total adjustments made to this
-                    # slave.  Adjust by average adjustment, slightly
-                    # reduced to avoid swinging back and forth
-                    adjustBy = slave.adjustments.average * 0.75
+                if connected:
+                    try:
+                        self.connection.disconnect()
+                    except Exception:
+                        pass
+                    connected = False
 
-                    self.log.debug("Adjusting %s by average slave adjustment: %s", slave.host, adjustBy)
-                else:
-                    # 5 or fewer total adjustments made to this slave.
-                    # Adjust by average ping
-                    adjustBy = slave.pings.average
+                misses += 1
+                if self.up and misses >= FAILOVER_MISSES:
+                    break
 
-                    self.log.debug("Adjusting %s by average ping: %s", slave.host, adjustBy)
             else:
-                # Not the first adjustment for song
+                misses = 0
+                if not self.up:
+                    break
 
-                if len(slave.currentSongAdjustments) > MAX_ADJUSTMENTS:
-                    # Too many adjustments; alternate between ping and average difference
-                    self.log.debug("Too many adjustments (%s > %s)", len(slave.currentSongAdjustments), MAX_ADJUSTMENTS)
+            time.sleep(self.interval)
 
-                    if not even(len(slave.currentSongAdjustments)):
-                        # Adjust by ping
-                        self.log.debug("Adjusting by ping...")
+        else:
+            # Stopped
+            if connected:
+                try:
+                    self.connection.disconnect()
+                except Exception:
+                    pass
 
-                        adjustBy = slave.pings.average
-                    else:
-                        # Try adjusting by difference again
-                        self.log.debug("Trying to adjust by difference...")
+            return
 
-                        adjustBy = slave.currentSongDifferences.average
+        if connected:
+            self.connection.disconnect()
 
-                else:
-                    # Adjust by average difference
-                    adjustBy = slave.currentSongDifferences.average
+        self.running = False
+        self.events.put((self.client, ['lost' if self.up else 'back']))
 
-                    self.log.debug("Adjusting %s by average difference: %s",
-                                   slave.host, adjustBy)
 
-            # TODO: If the difference is too great, it seems that the
-            # slave MPD has hit a bug where it thinks that song
-            # duration is shorter than it is and won't seek past that
-            # point.  Stopping the slave playback and re-playing the
-            # track seems to fix it.
+class IdleWatcher(object):
+    '''Makes a separate connection to a daemon and runs idle() on it in a
+    thread, putting (client, subsystems) tuples in a queue.  If the
+    connection fails, the exception is put in the queue instead of the
+    subsystems, unless RETRY is given, in which case it reconnects
+    after RETRY seconds, or LOST is given, in which case it's put in
+    the queue as the only subsystem.'''
 
-            absAdjustBy = abs(adjustBy)
-            if absAdjustBy > MAX_ADJUSTMENT:
-                # Adjustment too large; use ping
-                self.log.debug("Adjustment too large (%s > %s); adjusting by ping", absAdjustBy, MAX_ADJUSTMENT)
+    def __init__(self, client, events, subsystems=None, retry=None, lost=None):
+        self.log = client.log.getChild(self.__class__.__name__)
 
-                adjustBy = slave.pings.average
+        self.client = client
+        self.events = events
+        self.subsystems = subsystems or []
+        self.retry = retry
+        self.lost = lost
+        self.connection = Client(client.host, port=client.port,
+                                 password=client.password, logger=client.log)
+        self.running = False
+        self.thread = None
 
-            if adjustBy == slave.pings.average:
-                # Adjusting by ping, clear differences
-                self.log.debug("Clearing differences")
+    def start(self):
+        "Connect and start idle thread (_idleLoop)."
 
-                slave.currentSongDifferences.clear()
-            else:
-                # Invert final difference-based adjustment
-                adjustBy = adjustBy * -1
+        self.connection.connect()
 
-        return adjustBy
+        self.running = True
+        self.thread = Thread(target=self._idleLoop, name='IdleWatcher(%s)' % self.client.address)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def _reseek_necessary(self, slave):
-        "Return True if reseek is necessary."
+    def _shutdownSocket(self):
+        '''Shut down the idle connection's socket.  python-mpd2 keeps it in
+        a private attribute, so fall back to its public fileno() if that
+        goes away.'''
 
-        # Update master info
-        self.status()
+        sock = getattr(self.connection, '_sock', None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+            return
 
-        # Reconnect if connection dropped
-        slave.checkConnection()
+        fd = self.connection.fileno()
+        try:
+            # Python 3 detects the family itself; detach so closing
+            # this wrapper leaves the client's descriptor alone
+            sock = socket.socket(fileno=fd)
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            finally:
+                sock.detach()
+        except TypeError:
+            # Python 2: fromfd() dups the descriptor, so it can be
+            # closed afterward
+            family = socket.AF_UNIX if self.client.host.startswith('/') else socket.AF_INET
+            sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            finally:
+                sock.close()
 
-        if not slave.currentSongShouldSeek:
-            self.log.debug('Not seeking this song anymore')
+    def stop(self):
+        "Stop idle thread by disconnecting it."
 
-            return False
+        self.running = False
 
-        average_difference = self._average_difference(slave)  # Absolute value
-        max_difference = self._max_difference(slave)
+        # Shut the socket down first, because the thread is blocked
+        # reading from it, which would block disconnect().  Use the
+        # client's own socket, which may be a TCP or a Unix socket.
+        try:
+            self._shutdownSocket()
+        except Exception as e:
+            self.log.debug("Error shutting down idle connection to %s: %s",
+                           self.client.host, e)
 
-        if len(slave.currentSongDifferences) < 3:
-            self.log.debug("Less than 3 measurements; not seeking")
+        # Don't let a stuck thread hang shutdown; it's a daemon thread,
+        # so it won't keep the process alive
+        if self.thread is not None:
+            self.thread.join(IDLE_STOP_TIMEOUT)
+        if self.thread is not None and self.thread.is_alive():
+            self.log.warning("Idle thread for %s didn't stop within %s seconds; leaving it",
+                             self.client.host, IDLE_STOP_TIMEOUT)
 
-            return False
+            return
 
-        # Commenting out for now.  Not sure if it's really necessary now that we have backing-off.
-        # if (len(slave.currentSongDifferences) >= 5 and average_difference < MIN_DIFFERENCE):
-        #     self.log.debug("Average difference %s < %s; not seeking this song anymore", average_difference, MIN_DIFFERENCE)
+        try:
+            self.connection.disconnect()
+        except Exception as e:
+            self.log.debug("Error disconnecting idle connection to %s: %s",
+                           self.client.host, e)
 
-        #     slave.currentSongShouldSeek = False
+    def _idleLoop(self):
+        "Put subsystem changes in the queue until stopped."
 
-        #     return False
+        while self.running:
+            try:
+                subsystems = self.connection.idle(*self.subsystems)
+            except Exception as e:
+                if self.running and self.retry:
+                    self.log.warning("Idle connection to %s failed: %s; reconnecting in %s seconds",
+                                     self.client.host, e, self.retry)
+
+                    time.sleep(self.retry)
+                    try:
+                        self.connection.disconnect()
+                    except Exception:
+                        pass
+                    try:
+                        if self.running:
+                            self.connection.connect()
+                    except Exception as e:
+                        self.log.debug("Unable to reconnect to %s: %s", self.client.host, e)
 
-        if (average_difference > max_difference
-            and abs(slave.currentSongDifferences[0]) > max_difference):
-            # Average and current difference too large; reseek
-            self.log.debug("Average difference (%s) > max difference (%s); reseeking..." % (average_difference, max_difference))
+                    continue
 
-            return True
-        else:
-            self.log.debug("Average difference within acceptable range; not reseeking")
+                if self.running:
+                    self.log.error("Idle connection to %s failed: %s", self.client.host, e)
 
-            return False
+                    self.running = False
+                    self.events.put((self.client, [self.lost] if self.lost else e))
 
-    def _max_difference(self, slave):
-        "Return max difference between slave and master."
+                return
 
-        if len(slave.currentSongDifferences) >= 5:
-            # At least 5 measurements for current song
+            self.events.put((self.client, subsystems))
 
-            if len(slave.currentSongDifferences) >= 10:
-                # 10 or more measurements; use 1/4 of the range
-                maxDifference = slave.currentSongDifferences.range / 4
 
-                # Add half the average to prevent it from being too
-                # small and causing excessive reseeks.  For some songs
-                # the range can be very small, like 38ms, but for
-                # others it can be consistently 100-200 ms.
-                maxDifference += (abs(slave.currentSongDifferences.average) / 2)
-            else:
-                # 5-9 measurements; use 1/2 of the range
-                maxDifference = slave.currentSongDifferences.range / 2
+class EventCoalescer(object):
+    '''Merges bursts of idle events into one sync pass.  After the first
+    event, waits until no more events have arrived for QUIETWINDOW
+    seconds, but not longer than MAXDELAY seconds in total.'''
 
-            # Use at least half of the biggest difference to prevent
-            # the occasional small range from causing unnecessary
-            # syncs.  This may not be necessary with adding half the
-            # average a few lines up, but it may be a good extra
-            # precaution.
+    def __init__(self, events, quietWindow=0.1, maxDelay=1.0):
+        self.log = logging.getLogger(self.__class__.__name__)
 
-            # Use the max and min of the last 10 measurements, but not less than 30ms
-            minimumMaxDifference = max(0.030, (0.5 * max(abs(max(slave.currentSongDifferences[:10])),
-                                                         abs(min(slave.currentSongDifferences[:10])))))
+        self.events = events
+        self.quietWindow = quietWindow
+        self.maxDelay = maxDelay
 
-            if maxDifference < minimumMaxDifference:
-                self.log.debug('maxDifference too small (%s); setting maxDifference to half of the biggest difference', maxDifference)
+        # Counters
+        self.received = 0  # Subsystem changes received
+        self.merged = 0    # Subsystem changes merged into another
+        self.batches = 0   # Batches returned
 
-                maxDifference = minimumMaxDifference
+    def __str__(self):
+        return 'received:%s merged:%s batches:%s' % (
+            self.received, self.merged, self.batches)
 
-        elif slave.pings.average:
-            # Use average ping
+    def get(self):
+        '''Blocks until events arrive, then returns a dict mapping each
+        client to the set of its changed subsystems.  Raises the
+        exception if an idle connection failed.'''
 
-            # Use the larger of master or slave ping so the script can
-            # run on either one, multiplied by 30 (e.g. a 2 ms LAN
-            # ping becomes 60 ms max difference), but not less than 30ms
-            maxDifference = max(0.030, (30 * max([slave.pings.average, self.pings.average])))
+        # Wait for the first event.  Use a timeout so Ctrl+C works on
+        # Python 2.
+        while True:
+            try:
+                event = self.events.get(True, 1)
+            except queue.Empty:
+                continue
+            else:
+                break
 
-            # But don't go over 200 ms; if it's that high, better to
-            # just resync again.  But this does not work well for
-            # remote files.  The difference sometimes never gets lower
-            # than the maxDifference, so it resyncs forever, and
-            # always by the average ping or average slave adjustment,
-            # which basically loops doing the same syncs forever.
-            # Sigh.
-            maxDifference = min(0.200, maxDifference)
+        changes = defaultdict(set)
+        deadline = time.time() + self.maxDelay
 
-        else:
-            # This shouldn't happen, but if it does, use 200ms until we
-            # have something better.  200ms seems like a lot, and for
-            # local files it is, but remote files don't seek as
-            # quickly or consistently, so 100ms can cause excessive
-            # reseeking in a short period of time
-            maxDifference = 0.200
+        while event:
+            client, subsystems = event
+            if isinstance(subsystems, Exception):
+                raise subsystems
 
-        if len(slave.currentSongAdjustments) > 3:
-            # Many adjustments means trouble seeking this song.  Begin
-            # increasing the acceptable range by 25ms per adjustment over 3.
-            increase_by = 0.025 * (len(slave.currentSongAdjustments) - 3)
+            for subsystem in subsystems:
+                self.received += 1
+                if subsystem in changes[client]:
+                    self.merged += 1
+                else:
+                    changes[client].add(subsystem)
 
-            maxDifference += increase_by
+            # Wait for more events
+            timeout = min(self.quietWindow, deadline - time.time())
+            if timeout <= 0:
+                break
 
-            self.log.debug("More than 3 adjustments; increasing max difference by %s", increase_by)
+            try:
+                event = self.events.get(True, timeout)
+            except queue.Empty:
+                event = None
 
-        maxDifference = round(maxDifference, 3)
+        self.batches += 1
 
-        self.log.debug("maxDifference for slave %s: %s", slave.host, maxDifference)
+        self.log.debug("Events: %s", self)
+
+        return changes
 
-        return maxDifference
 
 # ** Functions
 
 def even(num):
     return (num % 2) == 0
 
+def isRemote(uri):
+    return '://' in uri
+
+def loadConfig(path):
+    "Return zone config from JSON file at PATH (see Zones.configure)."
+
+    with open(path) as f:
+        config = json.load(f)
+
+    for name, zone in config['zones'].items():
+        if 'master' not in zone:
+            raise KeyError('No master for zone %s' % name)
+
+    return config
+
+def acceptsArgs(function, count):
+    "Return True if FUNCTION (a function or bound method) takes COUNT positional arguments."
+
+    try:
+        spec = inspect.getfullargspec(function)
+    except AttributeError:
+        # Python 2
+        spec = inspect.getargspec(function)
+
+    args = spec.args[1:] if inspect.ismethod(function) else spec.args
+    required = len(args) - len(spec.defaults or ())
+
+    return required <= count and (count <= len(args) or spec.varargs is not None)
+
+def splitSpec(spec):
+    '''Return (address, latency) of daemon SPEC in HOST:PORT/LATENCY format,
+    where address is HOST:PORT and latency is a float or None.'''
+
+    latency = None
+    if '/' in spec:
+        spec, latency = spec.split('/')
+        latency = float(latency)
+
+    if ':' not in spec:
+        spec = '%s:%s' % (spec, DEFAULT_PORT)
+
+    return spec, latency
+
+def formatLabels(labels):
+    "Return LABELS, a sequence of (name, value) pairs, in the Prometheus format."
+
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                             .replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels)
+
 def timeFunction(f):
     t1 = time.time()
     f()
@@ -1288,6 +4996,10 @@ def main():
     parser.add_argument('-s', '--slaves',
                         dest="slaves", nargs='*',
                         help='Name or address of slave servers, optionally with port in HOST:PORT/LATENCY format')
+    parser.add_argument('-c', '--config', default=None,
+                        dest='config', metavar='FILE',
+                        help='Sync several zones, each with its own master and slaves, from JSON FILE '
+                             'instead of -m and -s (send SIGHUP to reload it)')
     parser.add_argument('-p', '--password', default=None,
                         dest="password",
                         help='Password to connect to servers with')
@@ -1295,6 +5007,73 @@ def main():
                         dest="adjustLatency", action="store_true",
                         help="Monitor latency between master and slaves and try to keep slaves' "
                              "playing position in sync with the master's")
+    parser.add_argument('--pause-correct',
+                        dest="pauseCorrection", action="store_true",
+                        help="Also correct slaves that are slightly ahead by pausing them briefly, "
+                             "when that has proven more precise than seeking (use with -l)")
+    parser.add_argument('--burst',
+                        dest="burst", action="store_true",
+                        help="After a song starts or a slave is corrected, take a quick burst of "
+                             "measurements so the next correction can be decided within a second "
+                             "(use with -l)")
+    parser.add_argument('--align', default='master', choices=['master', 'median'],
+                        dest="align",
+                        help="Keep slaves in sync with the master, or with each other (their median), "
+                             "e.g. when the master can't be heard (default: master; use with -l)")
+    parser.add_argument('--profile', default=None,
+                        dest="profile", metavar="FILE",
+                        help="Load Seeker parameters for each slave from FILE (see mpdtools.py autotune)")
+    parser.add_argument('--trace', default=None,
+                        dest="trace", metavar="FILE",
+                        help="Write spans of what each thread is doing to FILE, in Chrome trace format")
+    parser.add_argument('--record', default=None,
+                        dest="record", metavar="FILE",
+                        help="Append every measurement and decision to trace FILE (see mpdtools.py replay)")
+    parser.add_argument('-d', '--database-index',
+                        dest="databaseIndex", action="store_true",
+                        help="Index the files in each slave's database and don't send it files it doesn't have")
+    parser.add_argument('--database-cache', default=None,
+                        dest="databaseCache", metavar="DIR",
+                        help="Cache database indexes in DIR (implies --database-index)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        dest="metricsPort", metavar="PORT",
+                        help="Serve Prometheus metrics over HTTP on PORT")
+    parser.add_argument('--metrics-textfile', default=None,
+                        dest="metricsTextfile", metavar="FILE",
+                        help="Write Prometheus metrics to FILE every %s seconds" % METRICS_TEXTFILE_INTERVAL)
+    parser.add_argument('--memory-budget',
+                        dest="memoryBudget", action="store_true",
+                        help="Keep only recent history (%s songs per slave), so memory use stays flat "
+                             "over long sessions" % BUDGET_SONGS)
+    parser.add_argument('--history-log', default=None,
+                        dest="historyLog", metavar="FILE",
+                        help="Append songs' adjustments and differences to FILE when they're "
+                             "forgotten (implies --memory-budget)")
+    parser.add_argument('--relay-port', type=int, default=None,
+                        dest="relayPort", metavar="PORT",
+                        help="Serve this group's timing reference on PORT, for downstream mpdsyncs "
+                             "whose masters are slaves here")
+    parser.add_argument('--upstream', default=None,
+                        dest="upstream", metavar="HOST:PORT[/NAME]",
+                        help="Sync slaves to the root master through the relay at HOST:PORT, which "
+                             "knows our master as NAME (default: as given with -m)")
+    parser.add_argument('--watch-slaves',
+                        dest="watchSlaves", action="store_true",
+                        help="Also watch slaves for changes made behind mpdsync's back, and repair "
+                             "them right away")
+    parser.add_argument('--failover',
+                        dest="failover", action="store_true",
+                        help="If a master is lost, make its best-synced slave the master until it comes back, "
+                             "instead of waiting for it")
+    parser.add_argument('--control', default=None,
+                        dest="control", metavar="PATH",
+                        help="Accept commands to add, remove and retune slaves on a Unix socket at PATH")
+    parser.add_argument('--quiet-window', type=float, default=0.1,
+                        dest="quietWindow", metavar="SECONDS",
+                        help="Wait until the master has been quiet this long before syncing (default: 0.1)")
+    parser.add_argument('--max-delay', type=float, default=1.0,
+                        dest="maxDelay", metavar="SECONDS",
+                        help="Never wait longer than this to sync after a change (default: 1.0)")
     parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose", help="Be verbose, up to -vvv")
     args = parser.parse_args()
 
@@ -1333,69 +5112,195 @@ def main():
     log.debug("Args: %s", args)
 
     # Check args
-    if not args.master:
-        log.error("Please provide a master server with -m.")
-        return False
+    if args.config:
+        if args.master or args.slaves:
+            log.error("Please give the servers either with --config or with -m and -s.")
+            return False
 
-    if not args.slaves:
-        log.error("Please provide at least one slave server with -c.")
-        return False
+        if args.upstream or args.relayPort:
+            log.error("--upstream and --relay-port can't be used with --config.")
+            return False
+
+        try:
+            config = loadConfig(args.config)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.error("Unable to load config %s: %s", args.config, e)
+            return False
+
+    else:
+        if not args.master:
+            log.error("Please provide a master server with -m.")
+            return False
 
-    # Connect to the master server
-    master = Master(host=args.master, password=args.password,
-                    adjustLatency=args.adjustLatency, logger=log)
+        if not args.slaves:
+            log.error("Please provide at least one slave server with -s.")
+            return False
+
+    recorder = TraceRecorder(args.record) if args.record else None
+    historyLog = TraceRecorder(args.historyLog) if args.historyLog else None
+
+    profile = None
+    if args.profile:
+        try:
+            profile = SeekerProfile.load(args.profile)
+        except (IOError, OSError, ValueError) as e:
+            log.error("Unable to load profile %s: %s", args.profile, e)
+            return False
 
+    # Export metrics
+    exporters = []
     try:
-        master.connect()
-    except Exception as e:
-        log.exception('Unable to connect to master server: %s', e)
+        if args.metricsPort:
+            exporters.append(MetricsServer(args.metricsPort))
+        if args.metricsTextfile:
+            exporters.append(MetricsTextfile(args.metricsTextfile))
+    except (IOError, OSError) as e:
+        log.error("Unable to export metrics: %s", e)
         return False
+
+    for exporter in exporters:
+        exporter.start()
+
+    if args.trace:
+        try:
+            tracer.start(args.trace)
+        except (IOError, OSError) as e:
+            log.error("Unable to trace to %s: %s", args.trace, e)
+            return False
+
+    # Zones share one event queue (and one Seeker thread)
+    events = queue.Queue()
+    zones = Zones(events, password=args.password, watchSlaves=args.watchSlaves,
+                  failover=args.failover, logger=log,
+                  options={'adjustLatency': args.adjustLatency,
+                           'recorder': recorder,
+                           'profile': profile,
+                           'memoryBudget': args.memoryBudget or bool(historyLog),
+                           'historyLog': historyLog,
+                           'pauseCorrection': args.pauseCorrection,
+                           'burst': args.burst,
+                           'align': args.align,
+                           'databaseIndex': args.databaseIndex,
+                           'databaseCache': args.databaseCache})
+
+    if args.config:
+        # Connect to and sync each zone's master and slaves
+        if not zones.configure(config):
+            return False
+
     else:
-        log.debug('Connected to master server.')
+        upstream = None
+        if args.upstream:
+            upstream = RelayClient(args.upstream, splitSpec(args.master)[0], logger=log)
+            upstream.start()
+
+        # Connect to and sync the master and slaves
+        if not zones.addZone('default', args.master, args.slaves, upstream=upstream):
+            return False
+
+        if args.relayPort:
+            try:
+                relay = RelayServer(zones, 'default', args.relayPort)
+            except (IOError, OSError, socket.error) as e:
+                log.error("Unable to serve relay on port %s: %s", args.relayPort, e)
+                return False
 
-    # Connect to slaves
-    for slave in args.slaves:
-        master.addSlave(slave, password=args.password)
+            relay.start()
 
     # Make sure there is at least one slave connected
-    if not master.slaves:
+    if not any(master.slaves for master in zones):
         log.error("Couldn't connect to any slaves.")
         return False
 
-    # Sync master and slaves
-    master.syncAll()
+    # Export and print skew and command latencies on demand
+    metrics.collectors.append(zones.skewMetrics)
+    metrics.collectors.append(zones.zoneMetrics)
+
+    def logStats(level):
+        for master in zones:
+            master.logSkew(level)
+        commandLatencies.log(log, level=level)
+
+    if hasattr(signal, 'SIGUSR1'):
+        # Log them in the event loop, not in the handler, which could
+        # interrupt the main thread while it holds a lock they need
+        signal.signal(signal.SIGUSR1, lambda signum, frame: events.put((zones, ['stats'])))
+
+    control = None
+    if args.control:
+        try:
+            control = ControlServer(zones, args.control, events)
+        except (IOError, OSError, socket.error) as e:
+            log.error("Unable to listen on %s: %s", args.control, e)
+            return False
+
+        control.start()
+
+    if args.config and hasattr(signal, 'SIGHUP'):
+        # Reload the config in the event loop, not in the handler
+        signal.signal(signal.SIGHUP, lambda signum, frame: events.put((zones, ['reload'])))
+
+    # Watch the masters for changes on separate connections, so
+    # bursts of events can be merged
+    coalescer = EventCoalescer(events, quietWindow=args.quietWindow,
+                               maxDelay=args.maxDelay)
 
     # try/except to catch Ctrl+C and print debug info
     try:
         # Enter idle loop
         while True:
             # Wait for something to happen
-            subsystems = master.idle()
+            changes = coalescer.get()
+
+            signals = changes.pop(zones, ())
+
+            if 'stats' in signals:
+                logStats(logging.WARNING)
+
+            if 'reload' in signals:
+                log.info("Reloading %s", args.config)
+
+                try:
+                    zones.configure(loadConfig(args.config))
+                except (IOError, OSError, ValueError, KeyError) as e:
+                    log.error("Unable to reload %s: %s", args.config, e)
+
+            # Run commands from the control socket
+            for command in changes.pop(control, ()):
+                control.run(command)
 
             # Sync stuff
-            for subsystem in subsystems:
-                if subsystem == 'playlist':
-                    log.debug("Subsystem update: playlist")
-                    master.syncPlaylists()
-                elif subsystem == 'player':
-                    log.debug("Subsystem update: player")
-                    master.syncPlayers()
-                elif subsystem == 'options':
-                    log.debug("Subsystem update: options")
-                    master.syncOptions()
+            zones.handleEvents(changes)
 
     except KeyboardInterrupt:
-        log.debug("Interrupted.  Filetype adjustments for slave 0: %s",
-                  [{a: master.slaves[0].fileTypeAdjustments[a]}
-                   for a in master.slaves[0].fileTypeAdjustments])
-        log.debug("Song adjustments for slave 0: %s",
-                  "\n" + "\n".join([str(a)
-                             for a in sorted(master.slaves[0].song_adjustments,
-                                             key=lambda i: len(i['adjustments']))]))
-        log.debug("Song differences for slave 0: %s",
-                  "\n" + "\n".join([str(a)
-                             for a in sorted(master.slaves[0].song_differences,
-                                             key=lambda i: i['differences'].overall_average)]))
+        for exporter in exporters:
+            exporter.stop()
+
+        if control:
+            control.stop()
+
+        tracer.stop()
+
+        logStats(logging.INFO)
+
+        log.debug("Interrupted.  Idle events: %s", coalescer)
+        for master in zones:
+            log.debug("Recoveries in zone %s: %s", master.zone, dict(master.recoveries))
+            log.debug("Track changes in zone %s: %s", master.zone, master.predictor)
+
+            for slave in master.slaves:
+                log.debug("Start latencies for slave %s: %s", slave.address, slave.startLatencies)
+                log.debug("Filetype adjustments for slave %s: %s", slave.address,
+                          [{a: slave.fileTypeAdjustments[a]}
+                           for a in slave.fileTypeAdjustments])
+                log.debug("Song adjustments for slave %s: %s", slave.address,
+                          "\n" + "\n".join([str(a)
+                                     for a in sorted(slave.song_adjustments,
+                                                     key=lambda i: len(i['adjustments']))]))
+                log.debug("Song differences for slave %s: %s", slave.address,
+                          "\n" + "\n".join([str(a)
+                                     for a in sorted(slave.song_differences,
+                                                     key=lambda i: i['differences'].overall_average)]))
 
 if __name__ == '__main__':
     sys.exit(main())
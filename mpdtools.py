@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+
+# * mpdtools.py
+# Offline tools for mpdsync that don't need any servers.
+#
+# replay: Feeds a trace recorded with "mpdsync.py --record" through the
+# Seeker's decision logic (or another Seeker subclass), to see what it
+# would have done with the same measurements.  Note that this is open
+# loop: corrections made during replay don't change the recorded
+# measurements that follow them.
+#
+# autotune: Searches for Seeker parameters (see mpdsync.SeekerParams)
+# that keep a simulated slave closest to the master with the fewest
+# reseeks.  The simulation's noise, latencies and drift are fitted to
+# each slave in a recorded trace, and the result is a profile for
+# "mpdsync.py --profile".
+
+# ** Imports
+import argparse
+from collections import defaultdict
+import importlib
+import json
+import logging
+import math
+import random
+import sys
+
+import mpdsync
+
+
+# ** Classes
+class ReplayMixin(object):
+    '''Makes a Seeker take its measurements from trace records instead of
+    from servers.  Set currentRecord before calling _reseek_necessary().'''
+
+    currentRecord = None
+
+    def status(self):
+        pass
+
+    def checkConnection(self):
+        return True
+
+    def syncPlayer(self, slave):
+        return True
+
+    def _measure(self, slave):
+        record = self.currentRecord
+
+        self.song = record['masterSong']
+        self.elapsed = mpdsync.MyFloat(record['masterElapsed'] or 0)
+        self.playing = record['masterPlaying']
+
+        slave.song = record['song']
+        slave.elapsed = mpdsync.MyFloat(record['elapsed']) if record['elapsed'] else None
+        if record['song'] is not None:
+            slave.playlist[int(record['song'])] = record['file']
+
+        self.pings.insert(0, record['masterPing'])
+        slave.pings.insert(0, record['slavePing'])
+
+        sample = dict((key, mpdsync.MyFloat(record[key]))
+                      for key in ['masterPing', 'slavePing',
+                                  'masterStatusLatency', 'slaveStatusLatency'])
+        sample['upstreamOffset'] = record.get('upstreamOffset', 0)
+
+        return sample
+
+
+class ReplayClient(mpdsync.Client):
+    '''Slave whose state comes from trace records, so it never talks to a
+    server.'''
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayClient, self).__init__(*args, **kwargs)
+
+        # Only songs seen in the trace are known
+        self.playlist = {}
+
+    def checkConnection(self):
+        return True
+
+    def status(self):
+        pass
+
+
+class Replay(object):
+    '''Replays a trace through SEEKERCLASS (a Seeker subclass).'''
+
+    def __init__(self, seekerClass=mpdsync.Seeker, pauseCorrection=False):
+        self.log = logging.getLogger('mpdtools').getChild(self.__class__.__name__)
+
+        self.master = mpdsync.Master(host='replay', pauseCorrection=pauseCorrection,
+                                     logger=self.log)
+        cls = type('Replay' + seekerClass.__name__, (ReplayMixin, seekerClass), {})
+        self.seeker = cls(self.master)
+
+        self.slaves = {}
+
+        # Counters for each slave
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.adjustments = defaultdict(list)
+
+    def slave(self, address):
+        "Return replay slave for ADDRESS (in HOST:PORT format), making it if necessary."
+
+        if address not in self.slaves:
+            slave = ReplayClient(address, logger=self.log)
+            slave.params = self.master.profile.paramsFor(address)
+
+            self.slaves[address] = slave
+            self.master.slaves.append(slave)
+
+        return self.slaves[address]
+
+    def run(self, records):
+        for record in records:
+            kind = record['k']
+            if kind not in ('sample', 'decision', 'correction'):
+                continue
+
+            slave = self.slave(record['slave'])
+            stats = self.stats[slave.address]
+
+            if kind == 'decision':
+                stats['recordedDecisions'] += 1
+                if record['reseek']:
+                    stats['recordedReseeks'] += 1
+
+            elif kind == 'correction':
+                if record['ok']:
+                    stats['recordedCorrections'] += 1
+
+            elif record['source'] == 'seeker':
+                # The Seeker measured, so it's time for it to decide
+                self.seeker.currentRecord = record
+                if self.seeker._reseek_necessary(slave):
+                    stats['replayedReseeks'] += 1
+
+                    actuator = self.seeker._choose_actuator(slave)
+                    if actuator.name == 'seek':
+                        adjustBy = self.seeker._calc_adjustment(slave)
+                    else:
+                        adjustBy = -slave.currentSongDifferences.average
+                    self.adjustments[slave.address].append(round(adjustBy, 6))
+
+                    self.seeker._corrected(slave, actuator, adjustBy)
+
+                if record['elapsed']:
+                    stats['samples'] += 1
+
+            else:
+                # Measured by the master when playing the slave, or
+                # in a burst (see mpdsync.Master._burst)
+                self.seeker.currentRecord = record
+                self.seeker._average_difference(slave)
+
+    def results(self):
+        return dict((address, dict(self.stats[address], adjustments=self.adjustments[address]))
+                    for address in self.slaves)
+
+
+class SimulatedSlave(object):
+    '''Model of a slave's playback relative to the master, and of how
+    noisy measuring it is.  All times are in seconds.
+
+    offset is how far behind the master the slave really is.  Measured
+    differences are the offset plus gaussian noise, minus occasional
+    spikes in the slave's status latency (like Wi-Fi hiccups), which
+    delay its reply after it took its position.  Seeking leaves the
+    slave behind by seekLatency (with seekError), and starting a song
+    leaves it off by up to startError.  Drift is in seconds per
+    second.'''
+
+    defaults = {'ping': 0.002,
+                'noise': 0.010,
+                'spikeRate': 0.05,
+                'spikeSize': 0.050,
+                'seekLatency': 0.040,
+                'seekError': 0.015,
+                'startError': 0.100,
+                'drift': 0.0}
+
+    def __init__(self, songLength=240.0, **model):
+        for param, default in self.defaults.items():
+            setattr(self, param, float(model.pop(param, default)))
+
+        if model:
+            raise ValueError('Unknown model parameters: %s' % ', '.join(sorted(model)))
+
+        self.songLength = songLength
+
+    def __repr__(self):
+        return 'SimulatedSlave(%s)' % ', '.join('%s=%s' % (param, round(getattr(self, param), 6))
+                                                for param in sorted(self.defaults))
+
+    def toDict(self):
+        return dict((param, round(getattr(self, param), 6)) for param in self.defaults)
+
+    @classmethod
+    def fromRecords(cls, records):
+        '''Return model fitted to trace RECORDS for one slave.  Parameters
+        that can't be estimated from them keep their defaults.'''
+
+        model = {}
+
+        samples = [r for r in records
+                   if r['k'] == 'sample' and r['elapsed'] and r['masterElapsed'] is not None]
+        if not samples:
+            return cls()
+
+        latencies = sorted(r['slaveStatusLatency'] for r in samples)
+        model['ping'] = median(sorted(r['slavePing'] for r in samples))
+
+        # Spikes are status latencies far above the usual ones
+        usual = median(latencies)
+        mad = median(sorted(abs(l - usual) for l in latencies)) or 0.001
+        spikes = [l - usual for l in latencies if l > usual + 3 * mad]
+        model['spikeRate'] = len(spikes) / float(len(latencies))
+        if spikes:
+            model['spikeSize'] = sum(spikes) / len(spikes)
+
+        # Split samples into runs between song changes and
+        # corrections, during which only noise and drift change the
+        # difference
+        runs = []
+        afterCorrection = []
+        run = None
+        lastSong = None
+        corrected = None
+        sampleIds = set(id(r) for r in samples)
+        for record in records:
+            if record['k'] == 'correction' and record['ok']:
+                run = None
+                corrected = record.get('adjustBy')
+            elif id(record) in sampleIds:
+                difference = (record['masterElapsed']
+                              - (record['elapsed'] + record['slaveStatusLatency'])
+                              + record.get('upstreamOffset', 0))
+
+                if record['song'] != lastSong:
+                    lastSong = record['song']
+                    run = None
+                if run is None:
+                    run = []
+                    runs.append(run)
+                    if corrected is not None:
+                        # Seeking by adjustBy leaves the slave behind by
+                        # adjustBy + seekLatency
+                        afterCorrection.append(difference - corrected)
+                        corrected = None
+
+                run.append((record['masterElapsed'], difference))
+
+        steps = [b[1] - a[1] for run in runs for a, b in zip(run, run[1:])]
+        if len(steps) > 1:
+            # Each step has the noise of two measurements
+            model['noise'] = stdev(steps) / math.sqrt(2)
+
+        if afterCorrection:
+            model['seekLatency'] = sum(afterCorrection) / len(afterCorrection)
+            if len(afterCorrection) > 1:
+                model['seekError'] = stdev(afterCorrection)
+
+        starts = [abs(run[0][1]) for run in runs]
+        if starts:
+            model['startError'] = max(starts)
+
+        slopes = sorted(slope(run) for run in runs if len(run) >= 5)
+        if slopes:
+            model['drift'] = median(slopes)
+
+        return cls(**model)
+
+    def start(self, rand, songs):
+        "Start playing SONGS songs, with RAND as the source of noise."
+
+        self.rand = rand
+        self.songs = songs
+        self.now = 0.0
+        self.song = 0
+        self.songStart = 0.0
+        self.offset = rand.uniform(-self.startError, self.startError)
+
+        # Integral of the absolute offset over time
+        self.skewTime = 0.0
+
+    @property
+    def playing(self):
+        return self.song < self.songs
+
+    @property
+    def masterElapsed(self):
+        return self.now - self.songStart
+
+    def advance(self, seconds):
+        "Advance time by SECONDS, changing songs as they end."
+
+        while seconds > 0 and self.playing:
+            step = min(seconds, self.songLength - self.masterElapsed)
+
+            # The offset changes linearly, so the mean of its absolute
+            # value is exact unless it crosses zero
+            before = self.offset
+            self.offset += self.drift * step
+            if (before < 0) == (self.offset < 0):
+                self.skewTime += step * (abs(before) + abs(self.offset)) / 2
+            else:
+                self.skewTime += step * (before ** 2 + self.offset ** 2) / (2 * abs(self.offset - before))
+
+            self.now += step
+            seconds -= step
+
+            if self.masterElapsed >= self.songLength:
+                # Next song
+                self.song += 1
+                self.songStart = self.now
+                self.offset = self.rand.uniform(-self.startError, self.startError)
+
+    def measure(self):
+        '''Return (master elapsed, slave elapsed, slave status latency,
+        master ping, slave ping) for a measurement made now.'''
+
+        latency = self.ping / 2
+        spike = 0.0
+        if self.rand.random() < self.spikeRate:
+            spike = self.rand.expovariate(1 / self.spikeSize)
+
+        error = self.rand.gauss(0, self.noise)
+
+        # So that master - (slave + latency) = offset + error - spike:
+        # a spike delays the slave's reply after it took its position,
+        # so mpdsync overcompensates for it
+        slaveElapsed = self.masterElapsed - self.offset - latency - error
+        latency += spike
+
+        return (self.masterElapsed, slaveElapsed, latency,
+                self.ping * self.rand.uniform(0.8, 1.2), self.ping * self.rand.uniform(0.8, 1.2))
+
+    def seek(self, position):
+        "Seek slave to POSITION in the current song."
+
+        self.offset = (self.masterElapsed - position + self.seekLatency
+                       + self.rand.gauss(0, self.seekError))
+
+
+class SimulationMixin(object):
+    '''Makes a Seeker measure and correct SimulatedSlaves instead of
+    servers.'''
+
+    def status(self):
+        pass
+
+    def checkConnection(self):
+        return True
+
+    def syncPlayer(self, slave):
+        return True
+
+    def _measure(self, slave):
+        masterElapsed, slaveElapsed, latency, masterPing, slavePing = slave.model.measure()
+
+        self.playing = True
+        self.song = slave.song = str(slave.model.song % len(slave.playlist))
+        slave.currentSongFiletype = slave.currentFile.rsplit('.', 1)[-1]
+        self.elapsed = mpdsync.MyFloat(masterElapsed)
+        slave.elapsed = mpdsync.MyFloat(slaveElapsed)
+        slave.duration = slave.model.songLength
+
+        self.pings.insert(0, masterPing)
+        slave.pings.insert(0, slavePing)
+
+        return {'masterPing': masterPing, 'slavePing': slavePing,
+                'masterStatusLatency': mpdsync.MyFloat(latency),
+                'slaveStatusLatency': mpdsync.MyFloat(latency)}
+
+
+class SimulatedClient(ReplayClient):
+    '''Slave whose playback is a SimulatedSlave, playing a queue of
+    QUEUELENGTH songs of mixed file types in a loop.'''
+
+    queueLength = 100
+    fileTypes = ['flac', 'mp3', 'ogg']
+
+    def __init__(self, model, *args, **kwargs):
+        super(SimulatedClient, self).__init__(*args, **kwargs)
+
+        self.model = model
+        self.playlist = ['simulated/%05d.%s' % (i, self.fileTypes[i % len(self.fileTypes)])
+                         for i in range(self.queueLength)]
+
+    def seek(self, song, elapsed):
+        self.model.seek(elapsed)
+
+
+class Autotune(object):
+    '''Searches for the SeekerParams that minimize the cost of simulating
+    MODEL: the mean absolute skew plus RESEEKCOST seconds for each
+    reseek per minute.'''
+
+    # Ranges to search, and whether the parameter is a count
+    bounds = {'maxAdjustments': (1, 15, int),
+              'maxAdjustment': (0.050, 1.0, float),
+              'minDifference': (0.005, 0.100, float),
+              'pingMultiplier': (1.0, 100.0, float),
+              'maxPingDifference': (0.030, 0.500, float),
+              'wideningAfter': (0, 10, int),
+              'widening': (0.0, 0.100, float)}
+
+    def __init__(self, model, songs=10, reseekCost=0.005, seed=0):
+        self.log = logging.getLogger('mpdtools').getChild(self.__class__.__name__)
+
+        self.model = model
+        self.songs = songs
+        self.reseekCost = reseekCost
+        self.seed = seed
+
+        self.evaluations = 0
+
+    def simulate(self, params):
+        '''Return (mean absolute skew, reseeks per minute) of simulating
+        the model with PARAMS.'''
+
+        # Every simulation gets the same noise, so differences in
+        # cost are only from the parameters
+        self.model.start(random.Random(self.seed), self.songs)
+
+        seeker, slave = simulation(self.model, self.log)
+        slave.params = params
+
+        while self.model.playing:
+            self.model.advance(seeker.tick())
+
+        reseeks = sum(slave.corrections.values())
+        minutes = self.model.now / 60
+
+        self.evaluations += 1
+
+        return self.model.skewTime / self.model.now, reseeks / minutes
+
+    def cost(self, params):
+        skew, reseeks = self.simulate(params)
+
+        return skew + self.reseekCost * reseeks
+
+    def search(self, iterations=100):
+        '''Return the best SeekerParams found in ITERATIONS simulations,
+        starting from the defaults.  Each iteration changes every
+        parameter randomly by up to STEP of its range, and keeps the
+        change if it lowers the cost; the step shrinks when changes
+        keep failing.'''
+
+        rand = random.Random(self.seed)
+
+        best = mpdsync.SeekerParams()
+        bestCost = self.cost(best)
+        step = 0.25
+        failures = 0
+
+        for i in range(iterations):
+            candidate = {}
+            for param, (low, high, kind) in self.bounds.items():
+                value = getattr(best, param) + rand.gauss(0, step * (high - low))
+                value = min(high, max(low, value))
+                candidate[param] = int(round(value)) if kind is int else round(value, 4)
+
+            params = mpdsync.SeekerParams(**candidate)
+            cost = self.cost(params)
+
+            if cost < bestCost:
+                self.log.debug("Iteration %s: cost %s -> %s with %s", i, bestCost, cost, params)
+
+                best, bestCost = params, cost
+                failures = 0
+            else:
+                failures += 1
+                if failures >= 10:
+                    step = max(0.01, step / 2)
+                    failures = 0
+
+        return best
+
+
+# ** Functions
+
+def simulation(model, log, memoryBudget=False):
+    '''Return (seeker, slave) for simulating MODEL, a started
+    SimulatedSlave.  Each seeker.tick() measures and corrects the slave;
+    advance the model by the time it returns between ticks.'''
+
+    master = mpdsync.Master(host='simulated', memoryBudget=memoryBudget, logger=log)
+    master.playing = True
+    seeker = type('Simulated' + mpdsync.Seeker.__name__,
+                  (SimulationMixin, mpdsync.Seeker), {})(master)
+
+    slave = SimulatedClient(model, 'simulated', memoryBudget=memoryBudget, logger=log)
+    master.slaves.append(slave)
+
+    return seeker, slave
+
+def median(values):
+    "Return median of sorted VALUES."
+
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    else:
+        return (values[middle - 1] + values[middle]) / 2.0
+
+def stdev(values):
+    mean = sum(values) / float(len(values))
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+def slope(points):
+    "Return least-squares slope of (x, y) POINTS."
+
+    n = float(len(points))
+    meanX = sum(x for x, y in points) / n
+    meanY = sum(y for x, y in points) / n
+    variance = sum((x - meanX) ** 2 for x, y in points)
+
+    if not variance:
+        return 0.0
+
+    return sum((x - meanX) * (y - meanY) for x, y in points) / variance
+
+
+def readTrace(path):
+    "Yield records from trace file at PATH."
+
+    with open(path) as f:
+        for num, line in enumerate(f):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last line may be partial if mpdsync was killed
+                logging.getLogger('mpdtools').warning("Skipping bad line %s in %s", num + 1, path)
+
+def loadClass(name):
+    "Return class from NAME in MODULE:CLASS format."
+
+    module, cls = name.split(':')
+    return getattr(importlib.import_module(module), cls)
+
+def replay(args):
+    seekerClass = loadClass(args.seeker) if args.seeker else mpdsync.Seeker
+
+    replay = Replay(seekerClass, pauseCorrection=args.pauseCorrection)
+    if args.profile:
+        replay.master.profile = mpdsync.SeekerProfile.load(args.profile)
+    replay.run(readTrace(args.trace))
+
+    return replay.results()
+
+def autotune(args):
+    '''Tune Seeker parameters for each slave in the trace, or for a
+    default model without one.'''
+
+    if args.trace:
+        records = defaultdict(list)
+        for record in readTrace(args.trace):
+            if 'slave' in record:
+                records[record['slave']].append(record)
+        models = dict((address, SimulatedSlave.fromRecords(slaveRecords))
+                      for address, slaveRecords in records.items())
+    else:
+        # Slaves not in a trace get the default parameters, so only
+        # tune those without one
+        models = {None: SimulatedSlave()}
+
+    profile = mpdsync.SeekerProfile()
+    results = {}
+
+    for address, model in models.items():
+        tuner = Autotune(model, songs=args.songs, reseekCost=args.reseekCost, seed=args.seed)
+
+        before = tuner.simulate(mpdsync.SeekerParams())
+        params = tuner.search(args.iterations)
+        after = tuner.simulate(params)
+
+        if address is None:
+            profile.default = params
+        else:
+            profile.slaves[address] = params
+
+        results[address or 'default'] = {
+            'model': model.toDict(),
+            'params': params.toDict(),
+            'before': {'skew': round(before[0], 6), 'reseeksPerMinute': round(before[1], 3)},
+            'after': {'skew': round(after[0], 6), 'reseeksPerMinute': round(after[1], 3)},
+            'evaluations': tuner.evaluations}
+
+    if args.output:
+        profile.save(args.output)
+
+    return {'profile': profile.toDict(), 'results': results}
+
+def main():
+
+    # Parse args
+    parser = argparse.ArgumentParser(
+        description='Offline tools for mpdsync.')
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose",
+                        help="Be verbose")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    replayParser = subparsers.add_parser('replay', help='Replay a trace recorded with --record')
+    replayParser.add_argument('trace', metavar='TRACE', help='Trace file')
+    replayParser.add_argument('--seeker', metavar='MODULE:CLASS',
+                              help='Seeker subclass to replay through (default: mpdsync.Seeker)')
+    replayParser.add_argument('--pause-correct', dest='pauseCorrection', action='store_true',
+                              help='Replay with pause correction enabled')
+    replayParser.add_argument('--profile', metavar='FILE',
+                              help='Replay with Seeker parameters from FILE (see autotune)')
+    replayParser.set_defaults(function=replay)
+
+    autotuneParser = subparsers.add_parser('autotune', help='Tune Seeker parameters in simulation')
+    autotuneParser.add_argument('trace', metavar='TRACE', nargs='?',
+                                help='Trace to fit each slave\'s simulation to (default: tune one default model)')
+    autotuneParser.add_argument('-o', '--output', metavar='FILE',
+                                help='Write profile for "mpdsync.py --profile" to FILE')
+    autotuneParser.add_argument('-n', '--iterations', type=int, default=100,
+                                help='Simulations to try for each slave (default: 100)')
+    autotuneParser.add_argument('--songs', type=int, default=10,
+                                help='Songs to play in each simulation (default: 10)')
+    autotuneParser.add_argument('--reseek-cost', type=float, default=0.005, dest='reseekCost',
+                                metavar='SECONDS',
+                                help='Skew that one reseek per minute is worth (default: 0.005)')
+    autotuneParser.add_argument('--seed', type=int, default=0,
+                                help='Random seed for the simulation (default: 0)')
+    autotuneParser.set_defaults(function=autotune)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(levelname)s: %(name)s: %(message)s")
+
+    print(json.dumps(args.function(args), indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    sys.exit(main())